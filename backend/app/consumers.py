@@ -1,297 +1,256 @@
-import json
+import hashlib
 import logging
 
 from channels.generic.websocket import AsyncWebsocketConsumer
-
-from app.services.db_service import (
-    add_visitor_to_game,
-    check_end_game,
-    clear_table,
-    create_player,
-    end_game,
-    get_active_player_names,
-    get_allowed_actions,
-    get_current_player,
-    get_current_player_user_name,
-    get_game_visitors_participants_names,
-    get_next_player,
-    get_or_create_game,
-    get_participants,
-    get_phase,
-    get_player_by_channel_name,
-    get_player_by_user,
-    get_player_hand,
-    get_table,
-    get_user_by_token,
-    init_current_player,
-    init_participants,
-    is_player_in_active_players,
-    is_player_participant,
-    play_card_to_table,
-    prepare_end_game_message,
-    remove_player,
-    set_active_players,
-    set_allowed_actions,
-    set_current_player,
-    set_game_state,
-    set_phase,
-    take_cards_from_table,
-    toggle_active_players,
-    toggle_phase,
-    update_player_user,
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+
+from app.services.auth import get_scope_user
+from app.services import room_ops  # noqa: F401 - registers the room operations
+from app.services.cluster import call_room, node
+from app.services.codec import DEFAULT_CODEC, negotiate_codec
+from app.services.game_service import join_game
+from app.services.helpers import GameError
+from app.services.inbound import (
+    InboundError,
+    InboundQueue,
+    TokenBucket,
+    check_frame_size,
+    count_rejected,
+    is_ack,
+    validate_message,
 )
-from app.services.game_service import (
-    check_stop_attack,
-    generate_deck,
-    start_new_turn,
+from app.services.matchmaking import (
+    DEFAULT_RATING,
+    DEFAULT_TABLE_SIZE,
+    MATCHMAKING_ROOM,
+    MAX_TABLE_SIZE,
+    MIN_TABLE_SIZE,
 )
-from app.services.helpers import GameError
-from app.services.lock import LockException, acquire_redis_lock, release_redis_lock
-
-from app.models import Game
+from app.services.metrics import OUTBOUND_SLOW_DISCONNECTS, count_channel_sends, measure_action
+from app.services.outbound import OutboundQueue
+from app.services.presence import add_connection, remove_connection
+from app.services.rooms import get_room_group_name
+from app.services.sessions import cancel_forfeit, schedule_forfeit
+from app.services.spectators import get_spectators_group_name
 
 
 logger = logging.getLogger('django_vue_multiplayer')
 
 
 class BroadcastMixin(AsyncWebsocketConsumer):
-    async def broadcast_data(self, data):
+    async def broadcast_data(self, data, version=None):
+        # Encoded by every receiver with its own codec
         await self.channel_layer.group_send(
-            'all',
+            self.room_group_name,
             {
-                'type': 'send_message_to_group',
-                'message': json.dumps(data),
+                'type': 'send_data',
+                'data': data,
+                'version': version,
             },
         )
+        count_channel_sends()
 
-    async def send_message_to_player(self, player, message):
-        await self.channel_layer.group_send(
-            self.get_user_group_name(player.channel_name),
-            {
-                'type': 'send_message_to_group',
-                'message': message,
-            },
-        )
+    async def send_data(self, event):
+        await self.send_frame(self.codec.encode(event['data']), event.get('version'))
 
     async def send_message_to_group(self, event):
-        message = event['message']
-        await self.send(text_data=message)
-
-    @staticmethod
-    def get_user_short_name(channel_name):
-        return channel_name[-4:]
-
-    def get_user_group_name(self, channel_name):
-        return f'group_{self.get_user_short_name(channel_name)}'
-
-
-class ActionHandlerMixin(BroadcastMixin, AsyncWebsocketConsumer):
-    async def handle_authenticate(self, data, game):
-        token_key = data['token']
-        user = await get_user_by_token(token_key)
-        logger.debug(user)
+        # Already encoded frame (see Outbox)
+        await self.send_frame(event['message'], event.get('version'))
 
-        if user and not await get_player_by_user(game, user):
-            self.scope['user'] = user
-            player = await get_player_by_channel_name(game, self.channel_name)
-            logger.debug(player)
-            await update_player_user(player, user)
-            await self.send(json.dumps({'action': 'authenticated'}))
-            await self.broadcast_server_state(game)
+    async def send_frame(self, frame, version=None):
+        # version - of the game state in the frame, if it is about the state (see GameConsumer.send_frame)
+        await self.write_frame(frame)
 
-        elif not user:
-            await self.send_error('Invalid token. Please re-login')
-            await self.close()
+    async def write_frame(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
         else:
-            await self.send_error('User is already connected')
-            await self.close()
-    #==========================================#
-
-    async def handle_start(self, data, game):
-        if game.state != Game.States.NOT_STARTED:
-            await self.send_error('Game has been already started')
-            return
+            await self.send(text_data=frame)
 
-        await set_game_state(game, Game.States.GAME)
-        await init_participants(game)
-        await self.broadcast_server_state(game)
+    async def get_user(self, token_key):
+        # The token of the message, otherwise the user of the handshake (see TokenAuthMiddleware)
+        if token_key:
+            return await get_scope_user(token_key)
+        return self.scope.get('user') or AnonymousUser()
 
-        await generate_deck(game)
-        await init_current_player(game)
-        await start_new_turn(game)
+    def get_subprotocol(self):
+        # The token subprotocol is accepted if the codec has none - the client has offered a subprotocol
+        return self.codec.subprotocol or self.scope.get('token_subprotocol')
 
-        await self.broadcast_game_state(game)
-        await self.send_all_player_hands(game)
-    #==========================================#
+    @staticmethod
+    def get_connection_id(channel_name):
+        # Shown to the other clients instead of the channel name, unique in practice
+        return hashlib.blake2b(channel_name.encode(), digest_size=8).hexdigest()
 
-    async def handle_play(self, data, game):
-        # Try to acquire the lock
-        try:
-            lock = await acquire_redis_lock('play', game.id)
-        except LockException as e:
-            await self.send_error(str(e))
-            return
 
+class InboundMixin(AsyncWebsocketConsumer):
+    """
+    Everything a frame can be refused for is checked before any work is done for it (see app.services.inbound),
+    the frame is only decoded to tell the acks, which are not rate-limited.
+    The consumer has action_handler_funcs and send_error.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limit = TokenBucket(settings.INBOUND_MESSAGES_PER_SECOND, settings.INBOUND_BURST)
+        # Set while the messages are refused by the rate limit - the error is sent once
+        self.throttled = False
+
+    async def read_message(self, text_data=None, bytes_data=None):
+        """
+        Returns the validated message of the frame, None if it is refused (the client gets the error).
+        """
         try:
-            active_player = await get_player_by_channel_name(game, self.channel_name)
-            if not await self.check_action_allowed(game, active_player):
-                return
-
-            card_dict = data['card']
+            check_frame_size(text_data, bytes_data)
             try:
-                await play_card_to_table(game, active_player, card_dict)
-            except GameError as e:
+                data = self.codec.decode(text_data, bytes_data)
+            except (ValueError, TypeError):
+                data = InboundError('decode', 'Bad message - cannot decode')
+            # A client acks every state frame, the acks would eat up the rate limit of its actions
+            if not is_ack(data) and not self.rate_limit.take():
+                raise InboundError('rate', 'Too many messages')
+            if isinstance(data, InboundError):
+                raise data
+            message = validate_message(data, self.action_handler_funcs)
+        except InboundError as e:
+            count_rejected(e.reason)
+            if e.reason != 'rate' or not self.throttled:
                 await self.send_error(str(e))
-                return
-
-            current_player = await get_current_player(game)
-            defender = await get_next_player(game, current_player)
-            next_player = await get_next_player(game, defender)
-
-            # If all allowed cards were played in the round
-            if await check_stop_attack(game, defender):
-                if game.phase == Game.Phases.DEFENSE:
-                    await clear_table(game)
-                    await set_current_player(game, defender)
-                elif game.phase == Game.Phases.ADDITION:
-                    await take_cards_from_table(game, defender)
-                    await set_current_player(game, next_player)
-
-                await self.process_end_of_turn(game)
-
-            # Attackers add cards to defender's hand
-            elif game.phase == Game.Phases.ADDITION:
-                pass
-
-            # Usual cases
-            else:
-                phase = await toggle_phase(game)
-                if phase == Game.Phases.ATTACK:
-                    await toggle_active_players(game)
-                    await set_allowed_actions(game, [Game.Actions.PLAY, Game.Actions.PASS])
-                else:
-                    await set_active_players(game, [defender])
-                    await set_allowed_actions(game, [Game.Actions.PLAY, Game.Actions.TAKE])
-
-            await self.broadcast_game_state(game)
-            await self.send_all_player_hands(game)
-
-        finally:
-            # Ensure the lock is always released
-            await release_redis_lock(lock)
-    #==========================================#
-
-    async def handle_take(self, data, game):
-        active_player = await get_player_by_channel_name(game, self.channel_name)
-        if not await self.check_action_allowed(game, active_player):
-            return
+            self.throttled = e.reason == 'rate'
+            return None
+        self.throttled = False
+        return message
 
-        await toggle_active_players(game)
-        await set_phase(game, Game.Phases.ADDITION)
-        await set_allowed_actions(game, [Game.Actions.PLAY, Game.Actions.PASS])
 
-        await self.broadcast_game_state(game)
-        await self.send_all_player_hands(game)
-    #==========================================#
+class ActionHandlerMixin(BroadcastMixin, AsyncWebsocketConsumer):
+    # The room operations run on the worker owning the room (see app.services.room_ops)
 
-    async def handle_pass(self, data, game):
-        active_player = await get_player_by_channel_name(game, self.channel_name)
-        if not await self.check_action_allowed(game, active_player):
+    async def handle_authenticate(self, data):
+        user = await self.get_user(data.get('token'))
+        if not user.is_authenticated:
+            await self.send_error('Invalid token. Please re-login')
+            await self.close()
             return
+        # In the room queue - a resume must not race with the forfeit
+        player_id = await call_room(
+            self.room_name,
+            'authenticate',
+            game_id=self.game_id,
+            channel_name=self.channel_name,
+            codec=self.codec.name,
+            user_id=user.id,
+            username=user.username,
+        )
+        logger.debug(user)
 
-        current_player = await get_current_player(game)
-        defender = await get_next_player(game, current_player)
-        next_player = await get_next_player(game, defender)
+        if player_id:
+            self.scope['user'] = user
+            self.player_id = player_id
+            # Refreshed by this worker as long as the connection lives (see PresenceRegistry.heartbeat)
+            await add_connection(self.channel_name, self.room_name, self.codec.name, user.id, player_id)
+            # Reconnected to the player held since the disconnect
+            cancel_forfeit(player_id)
+        else:
+            await self.send_error('User is already connected')
+            await self.close()
+    #==========================================#
 
-        # TODO: Logic. Make more wise handling - count number of passes
-        # Current defender takes cards
-        if game.phase == Game.Phases.ADDITION:
-            await take_cards_from_table(game, defender)
-            current_player = await set_current_player(game, next_player)
+    async def handle_start(self, data):
+        await self.apply_action(data)
+    #==========================================#
 
-        # Current attacker passes
-        else:
-            await clear_table(game)
-            # TODO: Refactoring. Make function to move current_player for 1 or 2 positions
-            # (next or next after the next)
-            await set_current_player(game, defender)
+    async def handle_play(self, data):
+        await self.apply_action(data)
+    #==========================================#
 
-        await self.process_end_of_turn(game)
+    async def handle_take(self, data):
+        await self.apply_action(data)
+    #==========================================#
 
-        await self.broadcast_game_state(game)
-        await self.send_all_player_hands(game)
+    async def handle_pass(self, data):
+        await self.apply_action(data)
     #==========================================#
 
-    async def handle_end(self, data, game):
-        active_player = await get_player_by_channel_name(game, self.channel_name)
-        if not is_player_participant(game, active_player):
-            await self.send_error('Game is already in progress. Please wait for the end of the game.')
-            return
+    async def handle_end(self, data):
+        await self.apply_action(data)
+    #==========================================#
 
-        await end_game(game)
-        await self.broadcast_server_state(game)
+    async def handle_resync(self, data):
+        # Client has missed some deltas
+        frame, version = await self.get_full_state()
+        await self.send_frame(frame, version)
     #==========================================#
 
     # Action helpers
 
-    async def process_end_of_turn(self, game):
-        await self.send_all_player_hands(game)
-        await start_new_turn(game)
-        await self.check_and_process_end_game(game)
-        await self.broadcast_server_state(game)
-
-    async def check_and_process_end_game(self, game):
-        if await check_end_game(game):
-            end_game_message = await prepare_end_game_message(game)
-            # await self.broadcast_game_state(game)
-            await self.broadcast_data({'action': 'info', 'message': end_game_message})
-            await end_game(game)
-
-    async def check_action_allowed(self, game, active_player):
-        if not await is_player_participant(game, active_player):
-            await self.send_error('Game is already in progress. Please wait for the end of the game.')
-            return False
-        if not await is_player_in_active_players(game, active_player):
-            await self.send_error('Please wait for your turn')
-            return False
-        return True
+    async def apply_action(self, data):
+        if self.player_id is None:
+            await self.send_error('Please authenticate first')
+            return
+        # Actions of the room are queued and applied one by one (see RoomActor)
+        action = {**data, 'player': self.player_id}
+        try:
+            await call_room(self.room_name, 'apply', game_id=self.game_id, action=action)
+        except GameError as e:
+            await self.send_error(str(e))
 
-    # Messaging helpers
+    async def disconnect_player(self):
+        try:
+            held = await call_room(
+                self.room_name,
+                'disconnect',
+                game_id=self.game_id,
+                player_id=self.player_id,
+            )
+        except GameError:
+            self.retry_later(self.disconnect_player)
+            return
+        if held:
+            # The participant is waited for to reconnect (see handle_authenticate)
+            schedule_forfeit(self.player_id, self.forfeit)
 
-    async def send_player_hand(self, player):
-        cards = await get_player_hand(player)
-        data = {'action': 'hand', 'cards': cards}
-        await self.send_message_to_player(player, json.dumps(data))
-
-    async def send_all_player_hands(self, game):
-        players = await get_participants(game)
-        for player in players:
-            await self.send_player_hand(player)
-
-    async def broadcast_game_state(self, game):
-        current_player_user_name = await get_current_player_user_name(game)
-        phase = await get_phase(game)
-        active_player_names = await get_active_player_names(game)
-        allowed_actions = await get_allowed_actions(game)
-        table = await get_table(game)
-        response_data = {
-            'action': 'game_state',
-            'current_player': current_player_user_name,
-            'phase': phase,
-            'active_players': active_player_names,
-            'allowed_actions': allowed_actions,
-            'table': table,
-        }
-        await self.broadcast_data(response_data)
+    async def forfeit(self):
+        try:
+            await call_room(self.room_name, 'forfeit', game_id=self.game_id, player_id=self.player_id)
+        except GameError:
+            self.retry_later(self.forfeit)
+
+    def retry_later(self, callback):
+        # The room is moving or its owner does not answer - the seat must not be kept forever.
+        # Tried again (with the next owner) unless the player reconnects meanwhile.
+        if self.player_id is None:
+            return
+        logger.warning('Room %s not available for player %s, retrying', self.room_name, self.player_id)
+        schedule_forfeit(self.player_id, callback, settings.ROOM_CALL_TIMEOUT_SECONDS)
+
+    async def get_full_state(self):
+        # Encoded frame and its version
+        return await call_room(
+            self.room_name,
+            'full_state',
+            game_id=self.game_id,
+            channel_name=self.channel_name,
+            codec=self.codec.name,
+            player_id=self.player_id,
+        )
+
+    # Messaging helpers
 
     async def send_error(self, error_message):
         data = {'action': 'error', 'message': error_message}
-        await self.send(json.dumps(data))
+        await self.send_frame(self.codec.encode(data))
 
 
-class GameConsumer(ActionHandlerMixin, BroadcastMixin, AsyncWebsocketConsumer):
+class GameConsumer(ActionHandlerMixin, InboundMixin, BroadcastMixin, AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.room_name = None
+        self.codec = DEFAULT_CODEC
+        self.room_group_name = None
+        self.joined = False
+        # Resolved once on connect, dropped on the "invalidate_cache" channel-layer event
+        self.game_id = None
+        self.player_id = None
         self.action_handler_funcs = {
             'authenticate': self.handle_authenticate,
             'start': self.handle_start,
@@ -299,83 +258,286 @@ class GameConsumer(ActionHandlerMixin, BroadcastMixin, AsyncWebsocketConsumer):
             'take': self.handle_take,
             'pass': self.handle_pass,
             'end': self.handle_end,
+            'resync': self.handle_resync,
+            'ack': self.handle_ack,
         }
+        self.inbound = InboundQueue(self.handle_message, settings.INBOUND_QUEUE_SIZE)
+        self.outbound = OutboundQueue(
+            self.write_frame,
+            self.make_full_state,
+            self.close_slow,
+            settings.OUTBOUND_QUEUE_SIZE,
+            settings.OUTBOUND_SLOW_SECONDS,
+        )
 
     async def connect(self):
-        logger.debug(f'=====> Connected player: {self.channel_name}')
-        logger.debug(f'=====> Group: {self.get_user_group_name(self.channel_name)}')
+        self.room_name = self.scope['url_route']['kwargs']['room_name']
+        self.room_group_name = get_room_group_name(self.room_name)
+        self.codec = negotiate_codec(self.scope.get('subprotocols', []))
+        # Any worker takes the players - the room operations are forwarded to the owner of the room
+        await node.start()
 
-        response_data = {'action': 'connected', 'player': self.get_user_short_name(self.channel_name)}
+        logger.debug('=====> Connected player: %s', self.channel_name)
+        logger.debug('=====> Room: %s', self.room_name)
+
+        response_data = {'action': 'connected', 'player': self.get_connection_id(self.channel_name)}
         await self.broadcast_data(response_data)
 
-        game = await get_or_create_game()
-        player = await create_player(self.channel_name)
-        await add_visitor_to_game(game, player)
+        await self.resolve_game()
         # TODO: Add check if participant connected (if not - don't change state)
         # TODO: If yes - restart the game
 
         # Broadcast not needed here, because it is called on "authenticate" action
 
+        # Private messages are sent to the channel directly (see Outbox), no group per connection
         await self.channel_layer.group_add(
-            self.get_user_group_name(self.channel_name),
-            self.channel_name,
-        )
-        await self.channel_layer.group_add(
-            'all',
+            self.room_group_name,
             self.channel_name,
         )
 
-        await self.accept()
+        await self.accept(subprotocol=self.get_subprotocol())
+        self.joined = True
 
     async def disconnect(self, close_code, auth_failed=False):
-        game = await get_or_create_game()
-        player = await get_player_by_channel_name(game, self.channel_name)
-        is_end_game = (game.state == Game.States.GAME) and await is_player_participant(game, player)
-        await remove_player(player)
-
-        if is_end_game:
-            await end_game(game)
+        # Connection was rejected in connect()
+        if not self.joined:
+            return
 
-        await self.broadcast_server_state(game)
+        await self.inbound.close()
+        self.outbound.close()
+        async with measure_action('leave'):
+            try:
+                if self.game_id is None:
+                    await self.resolve_game()
+                await self.disconnect_player()
+            finally:
+                await remove_connection(self.channel_name)
 
         await self.channel_layer.group_discard(
-            self.get_user_group_name(self.channel_name),
-            self.channel_name,
-        )
-        await self.channel_layer.group_discard(
-            'all',
+            self.room_group_name,
             self.channel_name,
         )
 
         # TODO: Beautify. Send real player's name
-        response_data = {'action': 'disconnected', 'player': self.get_user_short_name(self.channel_name)}
+        response_data = {'action': 'disconnected', 'player': self.get_connection_id(self.channel_name)}
         await self.broadcast_data(response_data)
         # TODO: Beautify. Think, maybe we need to send a special message to notify users
-        logger.debug(f'=====> Disconnected')
+        logger.debug('=====> Disconnected')
         return
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        game = await get_or_create_game()
+    async def receive(self, text_data=None, bytes_data=None):
+        if self.inbound.closed:
+            return
+        message = await self.read_message(text_data, bytes_data)
+        if message is None:
+            return
+        if message['action'] == 'ack':
+            # Not queued behind the actions - the client would look slower than it is
+            await self.handle_ack(message)
+            return
+        if self.inbound.put(message):
+            return
+        count_rejected('queue')
+        if settings.INBOUND_OVERFLOW == 'drop':
+            await self.send_error('Too many messages - dropped')
+        else:
+            await self.close(code=4029)
+            await self.inbound.close()
+
+    async def handle_message(self, message):
+        # Messages of the connection are handled one by one (see InboundQueue)
+        action = message['action']
+        async with measure_action(action):
+            if self.game_id is None:
+                await self.resolve_game()
+            await self.action_handler_funcs[action](message)
+
+    async def send_frame(self, frame, version=None):
+        # Sent by the outbound queue of the connection, in the order they come
+        if not self.outbound.put(frame, version):
+            await self.close_slow()
+
+    async def handle_ack(self, data):
+        self.outbound.ack(data['version'])
+
+    async def close_slow(self):
+        OUTBOUND_SLOW_DISCONNECTS.inc()
+        logger.warning('Client %s is too slow, disconnected', self.channel_name)
+        await self.close(code=4008)
+
+    async def close(self, code=None, reason=None):
+        await self.outbound.drain()
+        await super().close(code, reason)
+
+    async def resync_state(self, event):
+        # The game has been rebased on another write (see LiveGames.rebase), the deltas sent do not add up
+        await self.handle_resync(event)
+
+    async def make_full_state(self):
+        if self.game_id is None:
+            await self.resolve_game()
+        return await self.get_full_state()
+
+    async def resolve_game(self):
+        self.game_id = await join_game(self.room_name, self.channel_name, self.codec.name)
+
+    async def invalidate_cache(self, event):
+        self.game_id = None
+        self.player_id = None
+
+
+class SpectatorConsumer(BroadcastMixin, AsyncWebsocketConsumer):
+    """
+    Watches a room: no player is created, only the rate-limited public state is received
+    (see app.services.spectators).
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.room_name = None
+        self.codec = DEFAULT_CODEC
+        self.spectators_group_name = None
+        self.joined = False
 
-        action = data.get('action', None)
-        if not action:
-            # TODO: Refactoring. Make list of actions to response
-            await self.send_error('Bad message - no "action" field')
+    async def connect(self):
+        self.room_name = self.scope['url_route']['kwargs']['room_name']
+        self.codec = negotiate_codec(self.scope.get('subprotocols', []))
+        # Any worker takes the spectators - the updates come through the group, the owner of the room sends them
+        await node.start()
+
+        self.spectators_group_name = get_spectators_group_name(self.room_name, self.codec.name)
+        await self.channel_layer.group_add(self.spectators_group_name, self.channel_name)
+        await self.accept(subprotocol=self.get_subprotocol())
+        self.joined = True
+        await self.watch()
+
+    async def watch(self):
+        # Registered with the owner of the room, the first frame is the current state
+        try:
+            frame = await call_room(self.room_name, 'watch', channel_name=self.channel_name, codec=self.codec.name)
+        except GameError as e:
+            await self.send_frame(self.codec.encode({'action': 'error', 'message': str(e)}))
+            await self.close()
             return
-        handler_func = self.action_handler_funcs.get(action, None)
-        if not handler_func:
-            await self.send_error('Bad message - unknown action: {action}')
+        await self.send_frame(frame)
+
+    async def room_moved(self, event):
+        # The room has been handed off to another worker (see WorkerNode.hand_off) - watched there
+        await self.watch()
+
+    async def disconnect(self, close_code):
+        if not self.joined:
             return
+        await self.channel_layer.group_discard(self.spectators_group_name, self.channel_name)
+        try:
+            await call_room(self.room_name, 'unwatch', channel_name=self.channel_name, codec=self.codec.name)
+        except GameError:
+            # The owner keeps publishing to the group until its last spectator leaves or the room moves
+            logger.warning('Failed to unwatch room %s', self.room_name)
 
-        await handler_func(data, game)
+    async def receive(self, text_data=None, bytes_data=None):
+        await self.send_frame(self.codec.encode({'action': 'error', 'message': 'Spectators cannot take actions'}))
 
-    async def broadcast_server_state(self, game):
-        visitor_names, participant_names = await get_game_visitors_participants_names(game)
-        response_data = {
-            'action': 'server_state',
-            'state': game.state,
-            'visitors': visitor_names,
-            'participants': participant_names,
+
+class MatchmakingConsumer(InboundMixin, BroadcastMixin, AsyncWebsocketConsumer):
+    """
+    Waits in the matchmaking queue: {"action": "queue", "token", "size", "rating"} (size and rating are optional).
+    When the table is formed, "match_found" with the room to connect to is sent and the connection is closed.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.codec = DEFAULT_CODEC
+        self.joined = False
+        # (user id, rating, size) while in the queue
+        self.ticket = None
+        self.action_handler_funcs = {
+            'queue': self.handle_queue,
+            'leave': self.handle_leave,
         }
-        await self.broadcast_data(response_data)
+
+    async def connect(self):
+        self.codec = negotiate_codec(self.scope.get('subprotocols', []))
+        # Any worker takes the players - the queue is run by the owner of its room (see app.services.room_ops)
+        await node.start()
+        await self.accept(subprotocol=self.get_subprotocol())
+        self.joined = True
+
+    async def disconnect(self, close_code):
+        if self.joined and self.ticket:
+            await self.leave_queue()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        message = await self.read_message(text_data, bytes_data)
+        if message is None:
+            return
+        if message['action'] == 'queue':
+            async with measure_action('queue'):
+                await self.handle_queue(message)
+        else:
+            await self.action_handler_funcs[message['action']](message)
+
+    async def handle_queue(self, data):
+        size = DEFAULT_TABLE_SIZE if data['size'] is None else data['size']
+        rating = DEFAULT_RATING if data['rating'] is None else data['rating']
+        if not MIN_TABLE_SIZE <= size <= MAX_TABLE_SIZE:
+            await self.send_error(f'Table size must be from {MIN_TABLE_SIZE} to {MAX_TABLE_SIZE}')
+            return
+        if rating < 0:
+            await self.send_error('Rating must be a non-negative integer')
+            return
+        user = await self.get_user(data.get('token'))
+        if not user.is_authenticated:
+            await self.send_error('Invalid token. Please re-login')
+            await self.close()
+            return
+        try:
+            joined = await self.join_queue(user.id, rating, size)
+        except GameError as e:
+            await self.send_error(str(e))
+            return
+        if not joined:
+            await self.send_error('Already in the queue')
+            return
+        await self.send_frame(self.codec.encode({'action': 'queued', 'size': size, 'rating': rating}))
+
+    async def handle_leave(self, data):
+        await self.leave_queue()
+
+    async def join_queue(self, user_id, rating, size, waited=0):
+        joined = await call_room(
+            MATCHMAKING_ROOM,
+            'join_queue',
+            channel_name=self.channel_name,
+            user_id=user_id,
+            rating=rating,
+            size=size,
+            waited=waited,
+        )
+        if joined:
+            self.ticket = (user_id, rating, size)
+        return joined
+
+    async def leave_queue(self):
+        self.ticket = None
+        try:
+            await call_room(MATCHMAKING_ROOM, 'leave_queue', channel_name=self.channel_name)
+        except GameError:
+            logger.warning('Failed to leave the matchmaking queue: %s', self.channel_name)
+
+    async def room_moved(self, event):
+        # The queue has been handed off to another worker (see Matchmaker.close) - queued there again
+        if not self.ticket:
+            return
+        try:
+            await self.join_queue(*self.ticket, waited=event['waited'])
+        except GameError as e:
+            self.ticket = None
+            await self.send_error(str(e))
+
+    async def match_found(self, event):
+        # Out of the queue already
+        self.ticket = None
+        await self.send_frame(self.codec.encode({'action': 'match_found', 'room': event['room']}))
+        await self.close()
+
+    async def send_error(self, error_message):
+        await self.send_frame(self.codec.encode({'action': 'error', 'message': error_message}))
@@ -0,0 +1,227 @@
+import asyncio
+import json
+import time
+from collections import Counter
+
+from django.conf import settings
+
+from app.services.inbound import TokenBucket
+
+
+# A bot whose action has been refused tries again after this many seconds
+RETRY_SECONDS = 0.2
+
+
+class LoadStats:
+    def __init__(self):
+        # Move latencies in seconds: from sending the move to the next game version
+        self.latencies = []
+        # Error messages from the server by text
+        self.errors = Counter()
+        self.resyncs = 0
+        self.frames = 0
+        self.messages = 0
+        # Full states got instead of the deltas (a bot behind, see OutboundQueue), not asked for by a resync
+        self.full_states = 0
+        # Most frames waiting to be read by a bot, close codes from the server
+        self.max_buffered = 0
+        self.close_codes = Counter()
+
+
+class BotRoom:
+    def __init__(self, name, usernames, moves, watchers=()):
+        self.name = name
+        self.usernames = usernames
+        # Throttled bots in the room during the games, not playing (see Bot.watch)
+        self.watchers = list(watchers)
+        self.moves_left = moves
+        self.done = asyncio.Event()
+        # Set by the leader while a game is on
+        self.playing = asyncio.Event()
+        self.bots = []
+        # (bot, action, sent at, version) - one action of the room at a time, so the next version
+        # of the game is the answer to it (concurrent moves can't be told apart by the deltas)
+        self.pending = None
+
+    def count_move(self):
+        self.moves_left -= 1
+        if self.moves_left <= 0:
+            self.done.set()
+
+    async def resolve(self, bot):
+        self.pending = None
+        # The bots that have already seen the new version may act now
+        for other in self.bots:
+            if other is not bot and other.version == bot.version:
+                await other.act()
+
+
+class Bot:
+    """
+    Simulated player: keeps the game state up to date with the deltas (as the frontend does)
+    and plays random legal moves when it is its turn.
+    The first bot of the room (leader) starts the games.
+    A watcher only watches the games, waiting read_delay seconds before reading every frame
+    as a client on a slow link: the room does not wait for it, its frames pile up.
+    """
+    def __init__(self, username, token, room, transport, stats, rnd, leader=False, watcher=False, read_delay=0):
+        self.username = username
+        self.token = token
+        self.room = room
+        self.transport = transport
+        self.stats = stats
+        self.rnd = rnd
+        self.leader = leader
+        self.watcher = watcher
+        self.read_delay = read_delay
+
+        self.server_state = None
+        self.visitors = []
+        self.game_state = None
+        self.version = None
+        self.legal_moves = []
+        self.resyncing = False
+        # As the server limits the actions - the ones over the limit would be dropped without an answer
+        self.rate_limit = TokenBucket(settings.INBOUND_MESSAGES_PER_SECOND, settings.INBOUND_BURST)
+        self.retry_task = None
+        if not watcher:
+            room.bots.append(self)
+
+    async def run(self):
+        if self.watcher:
+            await self.watch()
+            return
+        await self.transport.connect()
+        await self.send({'action': 'authenticate', 'token': self.token})
+        await self.read_frames()
+
+    async def watch(self):
+        # Joins when a game has started (as a visitor, not a participant) and leaves when it is over,
+        # the next game is started without it. Joins again if closed by the server.
+        while True:
+            await self.room.playing.wait()
+            self.server_state = None
+            self.version = None
+            await self.transport.connect()
+            await self.send({'action': 'authenticate', 'token': self.token})
+            await self.read_frames()
+            if self.transport.close_code is None:
+                await self.transport.close()
+            else:
+                # As the frontend does - the server is done with the old connection meanwhile
+                await asyncio.sleep(1)
+
+    async def read_frames(self):
+        while True:
+            if self.read_delay:
+                await asyncio.sleep(self.read_delay)
+            self.stats.max_buffered = max(self.stats.max_buffered, self.transport.buffered())
+            frame = await self.transport.receive()
+            if frame is None:
+                self.stats.close_codes[self.transport.close_code] += 1
+                return
+            self.stats.frames += 1
+            data = json.loads(frame)
+            messages = data['messages'] if data.get('action') == 'batch' else [data]
+            for message in messages:
+                self.stats.messages += 1
+                await self.handle_message(message)
+            # The server sends the next state frames only as far as they are acked
+            versions = [message['version'] for message in messages if 'version' in message]
+            if versions:
+                await self.send({'action': 'ack', 'version': max(versions)})
+            if self.watcher:
+                if self.server_state not in (None, 'game'):
+                    return
+                continue
+            await self.act()
+
+    async def send(self, data):
+        await self.transport.send(json.dumps(data))
+
+    async def handle_message(self, message):
+        action = message['action']
+        if action == 'server_state':
+            self.server_state = message['state']
+            self.visitors = message['visitors']
+            if self.leader and self.server_state == 'game':
+                self.room.playing.set()
+            elif self.leader:
+                self.room.playing.clear()
+        elif action == 'game_state':
+            if self.version is not None and not self.resyncing:
+                self.stats.full_states += 1
+            self.resyncing = False
+            self.game_state = message
+            self.version = message['version']
+            await self.check_pending()
+        elif action == 'game_delta':
+            await self.apply_game_delta(message)
+        elif action == 'legal_moves':
+            self.legal_moves = message['cards']
+        elif action == 'error':
+            self.stats.errors[message['message']] += 1
+            if self.room.pending and self.room.pending[0] is self:
+                await self.room.resolve(self)
+                # It may be nobody else's turn - no frame would come to act on
+                self.retry_task = asyncio.create_task(self.act_later())
+
+    async def apply_game_delta(self, delta):
+        if self.version is None or delta['version'] <= self.version:
+            return
+        if delta['base_version'] != self.version:
+            self.stats.resyncs += 1
+            self.resyncing = True
+            await self.send({'action': 'resync'})
+            return
+        changes = dict(delta['changes'])
+        table = changes.pop('table', None)
+        self.game_state = {**self.game_state, **changes, 'version': delta['version']}
+        if table:
+            self.game_state['table'] = table['set'] if 'set' in table else self.game_state['table'] + table['append']
+        self.version = delta['version']
+        await self.check_pending()
+
+    async def check_pending(self):
+        # The game has moved on - the action is applied
+        pending = self.room.pending
+        if pending and pending[0] is self and self.version > pending[3]:
+            _, action, sent_at, _ = pending
+            if action != 'start':
+                self.stats.latencies.append(time.perf_counter() - sent_at)
+                self.room.count_move()
+            await self.room.resolve(self)
+
+    async def act(self):
+        if self.room.pending or self.room.done.is_set() or self.version is None:
+            return
+        if self.server_state != 'game':
+            # All the bots are in the room and the watchers have left - start the next game
+            visitors = set(self.visitors)
+            if self.leader and set(self.room.usernames) <= visitors and not visitors & set(self.room.watchers):
+                await self.send_action({'action': 'start'})
+            return
+        if self.username not in self.game_state['active_players']:
+            return
+
+        actions = list(self.game_state['allowed_actions'])
+        if 'play' in actions and not self.legal_moves:
+            actions.remove('play')
+        if not actions:
+            return
+        action = self.rnd.choice(actions)
+        data = {'action': action}
+        if action == 'play':
+            data['card'] = self.rnd.choice(self.legal_moves)
+        await self.send_action(data)
+
+    async def act_later(self, delay=RETRY_SECONDS):
+        await asyncio.sleep(delay)
+        await self.act()
+
+    async def send_action(self, data):
+        if not self.rate_limit.take():
+            self.retry_task = asyncio.create_task(self.act_later(1 / self.rate_limit.rate))
+            return
+        self.room.pending = (self, data['action'], time.perf_counter(), self.version)
+        await self.send(data)
@@ -0,0 +1,96 @@
+import asyncio
+import ssl
+
+from autobahn.asyncio.websocket import WebSocketClientFactory, WebSocketClientProtocol
+from channels.testing import WebsocketCommunicator
+
+
+class CommunicatorTransport:
+    """
+    In-process websocket: the ASGI application is called directly, no network.
+    """
+    def __init__(self, application, path):
+        self.application = application
+        self.path = path
+        self.communicator = None
+        self.close_code = None
+
+    async def connect(self):
+        self.communicator = WebsocketCommunicator(self.application, self.path)
+        self.close_code = None
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise ConnectionError(f'Connection rejected: {self.communicator.scope["path"]}')
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def receive(self):
+        # Read the output queue directly - receive_from() cancels the application on timeout
+        while True:
+            message = await self.communicator.output_queue.get()
+            if message['type'] == 'websocket.send':
+                return message.get('text') or message.get('bytes')
+            if message['type'] == 'websocket.close':
+                self.close_code = message.get('code')
+                return None
+
+    def buffered(self):
+        # Frames sent by the server and not read yet
+        return self.communicator.output_queue.qsize()
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class QueueClientProtocol(WebSocketClientProtocol):
+    def onOpen(self):
+        self.factory.opened.set_result(self)
+
+    def onMessage(self, payload, isBinary):
+        self.factory.queue.put_nowait(payload if isBinary else payload.decode())
+
+    def onClose(self, wasClean, code, reason):
+        self.factory.close_code = code
+        if not self.factory.opened.done():
+            self.factory.opened.set_exception(ConnectionError(f'Connection rejected: {code} {reason}'))
+        self.factory.queue.put_nowait(None)
+
+
+class DaphneTransport:
+    """
+    Real websocket to a running server (daphne), autobahn comes with daphne. ws:// and wss:// urls.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.factory = None
+        self.protocol = None
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        self.factory = WebSocketClientFactory(self.url)
+        self.factory.protocol = QueueClientProtocol
+        self.factory.queue = asyncio.Queue()
+        self.factory.opened = loop.create_future()
+        self.factory.close_code = None
+        # Host, port (80 or 443 by default) and TLS as the factory has parsed them from the url
+        ssl_context = ssl.create_default_context() if self.factory.isSecure else None
+        await loop.create_connection(self.factory, self.factory.host, self.factory.port, ssl=ssl_context)
+        self.protocol = await self.factory.opened
+
+    async def send(self, text):
+        self.protocol.sendMessage(text.encode())
+
+    async def receive(self):
+        return await self.factory.queue.get()
+
+    def buffered(self):
+        # Frames read off the socket and not by the bot - the kernel buffers are not counted
+        return self.factory.queue.qsize()
+
+    @property
+    def close_code(self):
+        return self.factory.close_code
+
+    async def close(self):
+        self.protocol.sendClose()
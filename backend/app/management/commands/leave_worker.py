@@ -0,0 +1,19 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from app.services.cluster import get_worker_channel_name
+
+
+class Command(BaseCommand):
+    help = (
+        'Take a worker out of the ring before stopping it: its rooms are written to the DB '
+        'and handed off to the other workers.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('worker', help='GAME_WORKER_ID of the worker')
+
+    def handle(self, *args, **options):
+        async_to_sync(get_channel_layer().send)(get_worker_channel_name(options['worker']), {'type': 'room.leave'})
+        self.stdout.write(f'Worker {options["worker"]} is leaving')
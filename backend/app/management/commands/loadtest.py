@@ -0,0 +1,255 @@
+import asyncio
+import json
+import random
+import statistics
+import time
+import urllib.request
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.backends.signals import connection_created
+from django.test import override_settings
+from rest_framework.test import APIRequestFactory
+
+from app.loadtest.bots import Bot, BotRoom, LoadStats
+from app.loadtest.transports import CommunicatorTransport, DaphneTransport
+from app.models import Game, GameCheckpoint, GameEvent
+from app.services.live_games import live_games
+from app.services.rooms import room_registry
+from user_auth.views import RegisterView
+
+
+REGISTER_PATH = '/api/user_auth/register/'
+BOT_PASSWORD = 'loadtest-bot'
+# Compared with the previous run of the same mode, rooms and players
+COMPARED_METRICS = ('duration_s', 'p50_ms', 'p95_ms', 'p99_ms', 'moves_per_s', 'messages_per_s', 'queries_per_move')
+
+
+class QueryCounter:
+    """
+    Counts the SQL queries of all the connections opened after install().
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        connection_created.connect(self.on_connection_created, weak=False)
+
+    def on_connection_created(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+def get_percentiles(values):
+    if len(values) < 2:
+        return values * 3 or [None] * 3
+    percentiles = statistics.quantiles(values, n=100, method='inclusive')
+    return [percentiles[49], percentiles[94], percentiles[98]]
+
+
+class Command(BaseCommand):
+    help = (
+        'Load test: bot players join rooms, authenticate with user_auth tokens and play random legal moves. '
+        'Reports move latency, messages/sec and DB queries per move, results are appended to a file. '
+        'The bot users and their games are deleted at the end (with --url, from the database of this command).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--players', type=int, default=2, help='Bots per room')
+        parser.add_argument('--moves', type=int, default=100, help='Moves per room')
+        parser.add_argument('--timeout', type=float, default=120, help='Seconds')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument(
+            '--slow-bots',
+            type=int,
+            default=0,
+            help='Throttled bots per room: they watch the games without playing and wait --read-delay '
+                 'before reading every frame',
+        )
+        parser.add_argument('--read-delay', type=float, default=0.1, help='Seconds')
+        parser.add_argument(
+            '--url',
+            default=None,
+            help='Websocket url of a running server, e.g. ws://localhost:8000/ws/game/ '
+                 '(by default the ASGI application is called in-process)',
+        )
+        parser.add_argument('--results', default='loadtest_results.jsonl', help='File the results are appended to')
+
+    def handle(self, *args, **options):
+        run_id = uuid.uuid4().hex[:8]
+        rooms = []
+        tokens = {}
+        try:
+            if options['url']:
+                result = self.run_load(run_id, rooms, tokens, options)
+            else:
+                with self.own_worker(f'loadtest-{run_id}'):
+                    result = self.run_load(run_id, rooms, tokens, options)
+        finally:
+            self.clean_up(rooms, tokens)
+        self.report(result, options['results'])
+
+    @contextmanager
+    def own_worker(self, worker_id):
+        # In-process the rooms are served by a worker of this command only, out of the ring of the running workers
+        static_workers = room_registry.static_workers
+        room_registry.static_workers = [worker_id]
+        try:
+            with override_settings(GAME_WORKER_ID=worker_id):
+                yield
+        finally:
+            room_registry.static_workers = static_workers
+
+    def run_load(self, run_id, rooms, tokens, options):
+        rnd = random.Random(options['seed'])
+        url = options['url']
+        query_counter = None
+        if not url:
+            query_counter = QueryCounter()
+            query_counter.install()
+
+        for room_idx in range(options['rooms']):
+            room_name = f'bench-{run_id}-{room_idx}'
+            usernames = [f'bot-{run_id}-{room_idx}-{player_idx}' for player_idx in range(options['players'])]
+            watchers = [f'bot-{run_id}-{room_idx}-slow-{watcher_idx}' for watcher_idx in range(options['slow_bots'])]
+            rooms.append(BotRoom(room_name, usernames, options['moves'], watchers))
+            for username in usernames + watchers:
+                tokens[username] = self.register_bot(username, url)
+
+        queries_before = query_counter.count if query_counter else 0
+        stats, duration, timed_out = asyncio.run(self.run_bots(rooms, tokens, url, rnd, options))
+        queries = query_counter.count - queries_before if query_counter else None
+
+        moves = len(stats.latencies)
+        p50, p95, p99 = get_percentiles(sorted(stats.latencies))
+        result = {
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'mode': 'daphne' if url else 'in-process',
+            'rooms': options['rooms'],
+            'players': options['players'],
+            'moves': moves,
+            'timed_out': timed_out,
+            'duration_s': round(duration, 3),
+            'p50_ms': p50 and round(p50 * 1000, 2),
+            'p95_ms': p95 and round(p95 * 1000, 2),
+            'p99_ms': p99 and round(p99 * 1000, 2),
+            'moves_per_s': round(moves / duration, 1),
+            'messages_per_s': round(stats.messages / duration, 1),
+            'frames_per_s': round(stats.frames / duration, 1),
+            # Includes the queries of connecting, authenticating and disconnecting
+            'queries_per_move': round(queries / moves, 2) if queries is not None and moves else None,
+            'errors': sum(stats.errors.values()),
+            'error_messages': dict(stats.errors.most_common(5)),
+            'resyncs': stats.resyncs,
+            'slow_bots': options['slow_bots'],
+            # Bounded by the acks (OUTBOUND_QUEUE_SIZE) however slow the bot
+            'max_buffered': stats.max_buffered,
+            'full_states': stats.full_states,
+            'close_codes': dict(stats.close_codes),
+        }
+        return result
+
+    def clean_up(self, rooms, tokens):
+        # Nothing of the run is left: the bot users (with their tokens and players), games, journal and backups
+        game_ids = list(Game.objects.filter(name__in=[room.name for room in rooms]).values_list('id', flat=True))
+        for game_id in game_ids:
+            live_games.drop(game_id)
+        GameEvent.objects.filter(game_id__in=game_ids).delete()
+        GameCheckpoint.objects.filter(game_id__in=game_ids).delete()
+        Game.objects.filter(id__in=game_ids).delete()
+        User.objects.filter(username__in=list(tokens)).delete()
+        for room in rooms:
+            room_registry.release_room(room.name)
+
+    def register_bot(self, username, url):
+        data = {'username': username, 'password': BOT_PASSWORD, 'email': f'{username}@example.com'}
+        if url:
+            parsed = urlparse(url)
+            scheme = 'https' if parsed.scheme == 'wss' else 'http'
+            request = urllib.request.Request(
+                f'{scheme}://{parsed.netloc}{REGISTER_PATH}',
+                data=json.dumps(data).encode(),
+                headers={'Content-Type': 'application/json'},
+            )
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())['token']
+
+        request = APIRequestFactory().post(REGISTER_PATH, data, format='json')
+        response = RegisterView.as_view()(request)
+        if response.status_code != 201:
+            raise CommandError(f'Cannot register {username}: {response.data}')
+        return response.data['token']
+
+    async def run_bots(self, rooms, tokens, url, rnd, options):
+        application = None
+        if not url:
+            from django_vue_multiplayer.asgi import application
+
+        stats = LoadStats()
+        bots = []
+        for room in rooms:
+            for idx, username in enumerate(room.usernames + room.watchers):
+                if url:
+                    transport = DaphneTransport(f'{url.rstrip("/")}/{room.name}/')
+                else:
+                    transport = CommunicatorTransport(application, f'/ws/game/{room.name}/')
+                bot_rnd = random.Random(rnd.random())
+                if username in room.watchers:
+                    bot = Bot(
+                        username, tokens[username], room, transport, stats, bot_rnd,
+                        watcher=True, read_delay=options['read_delay'],
+                    )
+                else:
+                    bot = Bot(username, tokens[username], room, transport, stats, bot_rnd, leader=idx == 0)
+                bots.append(bot)
+
+        started_at = time.perf_counter()
+        tasks = [asyncio.create_task(bot.run()) for bot in bots]
+        all_done = asyncio.gather(*(room.done.wait() for room in rooms))
+        await asyncio.wait([all_done, *tasks], timeout=options['timeout'], return_when=asyncio.FIRST_COMPLETED)
+        duration = time.perf_counter() - started_at
+        timed_out = not all_done.done()
+        all_done.cancel()
+
+        for task in tasks:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*(bot.transport.close() for bot in bots), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise CommandError(f'Bot failed: {errors[0]!r}')
+        return stats, duration, timed_out
+
+    def report(self, result, results_path):
+        previous = None
+        try:
+            with open(results_path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if all(entry.get(key) == result[key] for key in ('mode', 'rooms', 'players')):
+                        previous = entry
+        except FileNotFoundError:
+            pass
+
+        with open(results_path, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+        for key, value in result.items():
+            line = f'{key:>16}: {value}'
+            if previous and key in COMPARED_METRICS and value is not None and previous.get(key):
+                change = (value - previous[key]) / previous[key] * 100
+                line += f'  ({change:+.1f}% vs {previous["date"]})'
+            self.stdout.write(line)
+        if result['timed_out']:
+            self.stderr.write(self.style.WARNING('Timed out before all the moves were played'))
+        if result['close_codes']:
+            self.stderr.write(self.style.WARNING(f'Bots closed by the server: {result["close_codes"]}'))
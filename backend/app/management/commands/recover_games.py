@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from app.services.live_games import live_games
+
+
+class Command(BaseCommand):
+    help = (
+        'Write to the DB the game states backed up in Redis but not flushed (e.g. by a dead worker). '
+        'Run it when no worker is serving the games.'
+    )
+
+    def handle(self, *args, **options):
+        recovered = live_games.recover_all()
+        self.stdout.write(f'{len(recovered)} games recovered: {recovered}')
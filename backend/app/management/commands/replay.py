@@ -0,0 +1,76 @@
+import json
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from app.models import GameEvent
+from app.services.helpers import GameError
+from app.services.journal import ReplayError, replay_game, state_to_dict, verify_game
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild a game from the journal at any version: replay <game_id> [--at VERSION]. '
+        'Bulk regression check of the engine: replay --verify [--since YYYY-MM-DD] [--until YYYY-MM-DD].'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('game_id', type=int, nargs='?')
+        parser.add_argument('--at', type=int, default=None, help='Version to rebuild, the last one by default')
+        parser.add_argument('--verify', action='store_true', help='Replay all the games of the period')
+        parser.add_argument('--since', default=None, help='Date, yesterday by default')
+        parser.add_argument('--until', default=None, help='Date, now by default')
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            self.verify(options['since'], options['until'])
+            return
+        if options['game_id'] is None:
+            raise CommandError('game_id or --verify is required')
+        try:
+            state = replay_game(options['game_id'], options['at'])
+        except (ReplayError, GameError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(json.dumps(state_to_dict(state), indent=2))
+
+    @staticmethod
+    def parse_date(value, default):
+        if not value:
+            return default
+        return timezone.make_aware(datetime.fromisoformat(value))
+
+    def verify(self, since, until):
+        since = self.parse_date(since, timezone.now() - timedelta(days=1))
+        until = self.parse_date(until, timezone.now())
+        game_ids = (
+            GameEvent.objects.filter(created_at__gte=since, created_at__lt=until)
+            .values_list('game_id', flat=True)
+            .distinct()
+            .order_by('game_id')
+        )
+
+        started_at = time.perf_counter()
+        games = events = 0
+        failed = []
+        for game_id in game_ids.iterator():
+            games += 1
+            try:
+                count, mismatches = verify_game(game_id)
+            except (ReplayError, GameError) as e:
+                failed.append(game_id)
+                self.stderr.write(f'Game {game_id}: {e}')
+                continue
+            events += count
+            if mismatches:
+                failed.append(game_id)
+                self.stderr.write(f'Game {game_id}: state differs from the checkpoints at versions {mismatches}')
+        duration = time.perf_counter() - started_at
+
+        self.stdout.write(
+            f'{games} games, {events} events in {duration:.2f} s ({events / duration if duration else 0:.0f} events/s)'
+        )
+        if failed:
+            raise CommandError(f'{len(failed)} games failed: {failed}')
+        self.stdout.write(self.style.SUCCESS('All the games replay the same'))
@@ -0,0 +1,34 @@
+from urllib.parse import parse_qs
+
+from channels.middleware import BaseMiddleware
+
+from app.services.auth import get_scope_user
+
+
+# The token can also be offered as the websocket subprotocol "durak.token.<key>" (browsers cannot set headers)
+TOKEN_SUBPROTOCOL_PREFIX = 'durak.token.'
+
+
+def get_scope_token(scope):
+    """
+    Token of the handshake: ?token=<key> or the subprotocol. Returns (token key, subprotocol).
+    """
+    for subprotocol in scope.get('subprotocols', []):
+        if subprotocol.startswith(TOKEN_SUBPROTOCOL_PREFIX):
+            return subprotocol[len(TOKEN_SUBPROTOCOL_PREFIX):], subprotocol
+    tokens = parse_qs(scope.get('query_string', b'').decode()).get('token')
+    return (tokens[0] if tokens else None), None
+
+
+class TokenAuthMiddleware(BaseMiddleware):
+    """
+    scope['user'] - the user of the handshake token (AnonymousUser without one), set before connect().
+    Tokens are resolved through the token cache (see app.services.auth).
+    """
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        token_key, subprotocol = get_scope_token(scope)
+        scope['user'] = await get_scope_user(token_key)
+        # Sent back on accept if no other subprotocol is chosen - a browser fails the handshake otherwise
+        scope['token_subprotocol'] = subprotocol
+        return await self.inner(scope, receive, send)
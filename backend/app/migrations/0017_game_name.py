@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+
+def set_room_names(apps, schema_editor):
+    Game = apps.get_model('app', 'Game')
+    for game in Game.objects.all():
+        game.name = f'room-{game.pk}'
+        game.save(update_fields=['name'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_alter_game_phase'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='name',
+            # No index yet - the unique constraint below creates it (on Postgres the *_like index too)
+            field=models.SlugField(null=True, db_index=False),
+        ),
+        migrations.RunPython(set_room_names, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='game',
+            name='name',
+            field=models.SlugField(unique=True),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_game_name'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='player',
+            name='channel_name',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+    ]
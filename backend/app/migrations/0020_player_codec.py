@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_game_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='codec',
+            field=models.CharField(default='json', max_length=15),
+        ),
+    ]
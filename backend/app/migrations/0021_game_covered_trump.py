@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0020_player_codec'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='covered',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='trump',
+            field=models.CharField(blank=True, max_length=1),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0021_game_covered_trump'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='disconnected_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
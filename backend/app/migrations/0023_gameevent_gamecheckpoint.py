@@ -0,0 +1,43 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0022_player_disconnected_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('game_id', models.BigIntegerField()),
+                ('version', models.PositiveBigIntegerField()),
+                ('state', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'constraints': [
+                    models.UniqueConstraint(fields=('game_id', 'version'), name='unique_game_checkpoint_version'),
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name='GameEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('game_id', models.BigIntegerField()),
+                ('room_name', models.SlugField()),
+                ('version', models.PositiveBigIntegerField()),
+                ('action', models.JSONField()),
+                ('visitors', models.JSONField(default=list)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'constraints': [
+                    models.UniqueConstraint(fields=('game_id', 'version'), name='unique_game_event_version'),
+                ],
+            },
+        ),
+    ]
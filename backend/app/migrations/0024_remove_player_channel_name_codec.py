@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0023_gameevent_gamecheckpoint'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='player',
+            name='channel_name',
+        ),
+        migrations.RemoveField(
+            model_name='player',
+            name='codec',
+        ),
+    ]
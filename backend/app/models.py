@@ -6,12 +6,17 @@ from app.services.helpers import get_player_user_name
 
 
 class Card:
+    __slots__ = ('rank', 'suit')
+
     class SUITS:
         HEARTS = 'H'
         DIAMONDS = 'D'
         CLUBS = 'C'
         SPADES = 'S'
 
+    # Suit index in the integer card code
+    SUITS_ORDER = (SUITS.HEARTS, SUITS.DIAMONDS, SUITS.CLUBS, SUITS.SPADES)
+
     def __init__(self, rank, suit):
         self.rank = rank
         self.suit = suit
@@ -22,6 +27,15 @@ class Card:
             'suit': self.suit
         }
 
+    @property
+    def code(self):
+        # Fits into one byte: rank * 4 + suit index
+        return self.rank * 4 + self.SUITS_ORDER.index(self.suit)
+
+    @classmethod
+    def from_code(cls, code):
+        return cls(code // 4, cls.SUITS_ORDER[code % 4])
+
     @staticmethod
     def suit_to_emoji(suit):
         suit_emoji_dict = {
@@ -36,14 +50,23 @@ class Card:
     def from_dict(cls, data):
         return cls(data['rank'], data['suit'])
 
+    def __eq__(self, other):
+        return isinstance(other, Card) and self.rank == other.rank and self.suit == other.suit
+
+    def __hash__(self):
+        return self.code
+
     def __str__(self):
         return f'{self.rank}{self.suit_to_emoji(self.suit)}'
 
 
 class Player(models.Model):
+    # One player per user, kept between the games.
+    # Its connections (channel, codec) are in the presence registry (see app.services.presence)
     user = models.OneToOneField(User, on_delete=models.CASCADE, null=True)
-    channel_name = models.CharField(max_length=255)
     hand = models.JSONField(default=list)
+    # disconnected_at - set while a participant is waited for to reconnect (see app.services.sessions)
+    disconnected_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return get_player_user_name(self)
@@ -64,6 +87,8 @@ class Game(models.Model):
         TAKE = 'take', 'Take'
         PASS = 'pass', 'Pass'
 
+    # name - room id, used in the websocket route and the channel-layer group name
+    name = models.SlugField(max_length=50, unique=True)
     state = models.CharField(max_length=15, choices=States.choices, default=States.NOT_STARTED)
     visitors = models.ManyToManyField(Player, blank=True, related_name="games_as_visitors")
     participants = models.ManyToManyField(Player, blank=True, related_name="games_as_participants")
@@ -89,3 +114,44 @@ class Game(models.Model):
     )
     deck = models.JSONField(default=list)
     table = models.JSONField(default=list)
+    # covered - number of attack cards on the table beaten by the defender (pairs go first)
+    covered = models.PositiveSmallIntegerField(default=0)
+    trump = models.CharField(max_length=1, blank=True)
+    # version - incremented on every applied action, clients use it to detect missed deltas
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return self.name
+
+
+class GameEvent(models.Model):
+    """
+    Append-only journal of the applied actions (see app.services.journal).
+    No foreign key to Game - the journal outlives the game rows.
+    """
+    game_id = models.BigIntegerField()
+    room_name = models.SlugField(max_length=50)
+    # version - version of the game after the action
+    version = models.PositiveBigIntegerField()
+    action = models.JSONField()
+    # visitors - Player ids in the game when the action was applied (joins are not actions)
+    visitors = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['game_id', 'version'], name='unique_game_event_version'),
+        ]
+
+
+class GameCheckpoint(models.Model):
+    # Full engine state of the game at the version, replay starts from the nearest one
+    game_id = models.BigIntegerField()
+    version = models.PositiveBigIntegerField()
+    state = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['game_id', 'version'], name='unique_game_checkpoint_version'),
+        ]
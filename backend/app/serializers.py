@@ -0,0 +1,28 @@
+from rest_framework import serializers
+
+from app.models import Game
+from app.services.rooms import room_registry
+
+
+class RoomSerializer(serializers.ModelSerializer):
+    visitors_count = serializers.IntegerField(read_only=True, default=0)
+    # Live connections, anonymous ones included (see app.services.presence)
+    online_count = serializers.IntegerField(read_only=True, default=0)
+    # One of the live workers (see RoomRegistry), picked by the ring if not given
+    worker = serializers.CharField(required=False)
+
+    class Meta:
+        model = Game
+        fields = ('name', 'state', 'visitors_count', 'online_count', 'worker')
+        read_only_fields = ('state',)
+
+    def validate_worker(self, value):
+        if value not in room_registry.get_ring().workers:
+            raise serializers.ValidationError(f'"{value}" is not a live worker.')
+        return value
+
+    def create(self, validated_data):
+        worker = validated_data.pop('worker', None)
+        game = Game.objects.create(**validated_data)
+        game.worker = room_registry.place_room(game.name, worker)
+        return game
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django_redis import get_redis_connection
+from rest_framework.authtoken.models import Token
+
+from app.services.metrics import database_sync_to_async
+
+
+class TokenUserCache:
+    """
+    Token key -> user, so that a reconnect does not query the DB.
+    Two levels: an LRU of this process (AUTH_LOCAL_CACHE_SIZE entries, AUTH_LOCAL_CACHE_SECONDS)
+    and Redis shared by the workers (AUTH_CACHE_SECONDS). Only the id and the username of the user are kept -
+    the users are not full model instances.
+    A deleted token (logout, rotation) is dropped from Redis and the LRU of the process at once,
+    the LRUs of the other processes keep it for AUTH_LOCAL_CACHE_SECONDS at most.
+    """
+    key_prefix = 'auth:token'
+
+    def __init__(self):
+        # token key -> (user id, username, expiry time)
+        self.local = OrderedDict()
+        # The LRU is used by the event loop and the database_sync_to_async thread
+        self.lock = threading.Lock()
+        self._redis = None
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = get_redis_connection()
+        return self._redis
+
+    def get_key(self, token_key):
+        # Token keys are not stored in Redis as they are
+        return f'{self.key_prefix}:{hashlib.sha256(token_key.encode()).hexdigest()}'
+
+    @staticmethod
+    def make_user(user_id, username):
+        return User(id=user_id, username=username)
+
+    def get_local(self, token_key):
+        with self.lock:
+            entry = self.local.get(token_key)
+            if entry is None:
+                return None
+            user_id, username, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.local[token_key]
+                return None
+            self.local.move_to_end(token_key)
+        return self.make_user(user_id, username)
+
+    def set_local(self, token_key, user_id, username):
+        with self.lock:
+            self.local[token_key] = (user_id, username, time.monotonic() + settings.AUTH_LOCAL_CACHE_SECONDS)
+            self.local.move_to_end(token_key)
+            while len(self.local) > settings.AUTH_LOCAL_CACHE_SIZE:
+                self.local.popitem(last=False)
+
+    def get_user(self, token_key):
+        """
+        User of the token or None. One Redis round trip if not in the LRU, one query if not in Redis.
+        """
+        user = self.get_local(token_key)
+        if user is not None:
+            return user
+        cached = self.redis.get(self.get_key(token_key))
+        if cached:
+            user_id, username = json.loads(cached)
+        else:
+            token = Token.objects.select_related('user').filter(key=token_key).first()
+            if token is None:
+                return None
+            user_id, username = token.user.id, token.user.username
+            self.redis.set(self.get_key(token_key), json.dumps([user_id, username]), ex=settings.AUTH_CACHE_SECONDS)
+        self.set_local(token_key, user_id, username)
+        return self.make_user(user_id, username)
+
+    def invalidate(self, token_key):
+        with self.lock:
+            self.local.pop(token_key, None)
+        self.redis.delete(self.get_key(token_key))
+
+
+token_user_cache = TokenUserCache()
+get_token_user = database_sync_to_async(token_user_cache.get_user)
+
+
+async def get_scope_user(token_key):
+    # The LRU is checked without a thread hop
+    if not token_key:
+        return AnonymousUser()
+    user = token_user_cache.get_local(token_key)
+    if user is None:
+        user = await get_token_user(token_key)
+    return user or AnonymousUser()
@@ -0,0 +1,91 @@
+from app.models import Card
+
+
+# Card codes are precomputed - conversion is a dict lookup
+CARD_DICTS = {
+    rank * 4 + suit_idx: Card(rank, suit).to_dict()
+    for rank in range(2, 15)
+    for suit_idx, suit in enumerate(Card.SUITS_ORDER)
+}
+
+
+def card_to_code(card_dict):
+    return card_dict['rank'] * 4 + Card.SUITS_ORDER.index(card_dict['suit'])
+
+
+def code_to_card(code):
+    return dict(CARD_DICTS[code])
+
+
+def cards_from_dicts(card_dicts):
+    """
+    Ordered cards (deck, table) - one byte per card.
+    """
+    return bytearray(card_to_code(card_dict) for card_dict in card_dicts)
+
+
+def cards_to_dicts(codes):
+    return [code_to_card(code) for code in codes]
+
+
+class Hand:
+    """
+    Set of cards as an integer bitset: bit N is set if the hand has the card with code N.
+    Membership is O(1), taking several cards is one OR.
+    """
+    __slots__ = ('bits',)
+
+    def __init__(self, bits=0):
+        self.bits = bits
+
+    @staticmethod
+    def get_mask(codes):
+        mask = 0
+        for code in codes:
+            mask |= 1 << code
+        return mask
+
+    @classmethod
+    def from_codes(cls, codes):
+        return cls(cls.get_mask(codes))
+
+    @classmethod
+    def from_dicts(cls, card_dicts):
+        return cls.from_codes(card_to_code(card_dict) for card_dict in card_dicts)
+
+    def copy(self):
+        return Hand(self.bits)
+
+    def add(self, code):
+        self.bits |= 1 << code
+
+    def add_all(self, codes):
+        self.bits |= self.get_mask(codes)
+
+    def remove(self, code):
+        self.bits &= ~(1 << code)
+
+    def __contains__(self, code):
+        return bool(self.bits >> code & 1)
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+    def __iter__(self):
+        bits = self.bits
+        while bits:
+            lowest = bits & -bits
+            yield lowest.bit_length() - 1
+            bits ^= lowest
+
+    def __sub__(self, other):
+        return Hand(self.bits & ~other.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, Hand) and self.bits == other.bits
+
+    def __repr__(self):
+        return f'Hand({", ".join(str(Card.from_code(code)) for code in self)})'
+
+    def to_dicts(self):
+        return cards_to_dicts(self)
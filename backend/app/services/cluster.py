@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import uuid
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from app.services.helpers import GameError
+from app.services.live_games import live_games
+from app.services.metrics import count_channel_sends
+from app.services.presence import presence
+from app.services.rooms import room_registry, run_in_room
+
+
+logger = logging.getLogger('django_vue_multiplayer')
+
+
+# A call is redirected this many times at most while its room is moving between the workers
+MAX_CALL_ATTEMPTS = 5
+
+# name -> async function run by the owner of the room (see app.services.room_ops)
+room_ops = {}
+# async functions (room_name) run by the owner before the room is handed off to another worker
+hand_off_callbacks = []
+
+
+def room_op(func):
+    room_ops[func.__name__] = func
+    return func
+
+
+def on_hand_off(func):
+    hand_off_callbacks.append(func)
+    return func
+
+
+def get_worker_channel_name(worker):
+    return f'room-worker.{worker}'
+
+
+class RoomMoved(Exception):
+    pass
+
+
+class WorkerNode:
+    """
+    This worker process in the cluster of the game workers.
+    - Registers itself in the live workers (see RoomRegistry) and refreshes the entry every WORKER_TTL_SECONDS / 3.
+    - Owns the rooms placed on it: their operations run here, in the room actor, so every room has one writer
+      with its state in memory (see app.services.live_games). The operations of the rooms of other workers
+      are forwarded to their owners over the channel layer (channel room-worker.<id>), the results come back.
+    - Hands its rooms off when the ring changes (a worker has joined or left): the game is written to the DB,
+      then the placement is moved, so the next owner loads the latest state.
+    """
+    def __init__(self):
+        # Rooms served by this worker
+        self.owned = set()
+        # room -> worker, owners of the rooms of the other workers seen so far
+        self.owners = {}
+        # room -> future, rooms being handed off
+        self.moving = {}
+        # call id -> future of the reply
+        self.calls = {}
+        self.channel_layer = None
+        self.starting = None
+        self.tasks = []
+        self.leaving = False
+
+    @property
+    def worker_id(self):
+        return settings.GAME_WORKER_ID
+
+    @property
+    def channel_name(self):
+        return get_worker_channel_name(self.worker_id)
+
+    async def start(self):
+        # The first connection starts the node, the ones coming meanwhile wait for it
+        if self.starting is None:
+            self.starting = asyncio.ensure_future(self.join())
+        await self.starting
+
+    async def join(self):
+        self.channel_layer = get_channel_layer()
+        # In the ring before the first room is placed
+        await sync_to_async(room_registry.heartbeat)(self.worker_id)
+        self.tasks = [asyncio.create_task(self.run_heartbeat()), asyncio.create_task(self.run_receiver())]
+        # Tasks of the process, not of a connection: the owner of a room may have no sockets of its own
+        presence.start_heartbeat()
+        live_games.start_flusher()
+
+    async def run_heartbeat(self):
+        while not self.leaving:
+            await asyncio.sleep(settings.WORKER_TTL_SECONDS / 3)
+            try:
+                if await sync_to_async(room_registry.heartbeat)(self.worker_id):
+                    await self.rebalance()
+            except Exception:
+                logger.exception('Worker heartbeat failed')
+
+    async def run_receiver(self):
+        while True:
+            message = await self.channel_layer.receive(self.channel_name)
+            if message['type'] == 'room.call':
+                asyncio.create_task(self.serve_call(message))
+            elif message['type'] == 'room.reply':
+                future = self.calls.get(message['id'])
+                if future is not None and not future.done():
+                    future.set_result(message)
+            elif message['type'] == 'room.leave':
+                asyncio.create_task(self.leave())
+
+    # Owners
+
+    async def get_owner(self, room_name):
+        if room_name in self.owned:
+            return self.worker_id
+        if room_name in self.moving:
+            await self.moving[room_name]
+        owner = self.owners.get(room_name)
+        if owner is None:
+            owner = await sync_to_async(room_registry.get_room_worker)(room_name)
+            if owner == self.worker_id and not self.leaving:
+                self.owned.add(room_name)
+            else:
+                self.owners[room_name] = owner
+        return owner
+
+    def forget(self, room_name):
+        self.owners.pop(room_name, None)
+
+    # Calls
+
+    async def call(self, room_name, op, kwargs):
+        for attempt in range(MAX_CALL_ATTEMPTS):
+            owner = await self.get_owner(room_name)
+            try:
+                if owner == self.worker_id:
+                    return await run_in_room(room_name, self.run_op, room_name, op, kwargs)
+                return await self.forward(owner, room_name, op, kwargs)
+            except RoomMoved:
+                self.forget(room_name)
+                await asyncio.sleep(0.05 * attempt)
+        raise GameError('The room is moving to another server, please try again')
+
+    async def run_op(self, room_name, op, kwargs):
+        # In the room actor - the calls queued before a hand-off are redirected
+        if room_name not in self.owned:
+            raise RoomMoved(room_name)
+        return await room_ops[op](room_name=room_name, **kwargs)
+
+    async def forward(self, owner, room_name, op, kwargs):
+        call_id = uuid.uuid4().hex
+        future = self.calls[call_id] = asyncio.get_running_loop().create_future()
+        try:
+            await self.channel_layer.send(get_worker_channel_name(owner), {
+                'type': 'room.call',
+                'id': call_id,
+                'reply': self.channel_name,
+                'room': room_name,
+                'op': op,
+                'kwargs': kwargs,
+            })
+            count_channel_sends()
+            reply = await asyncio.wait_for(future, settings.ROOM_CALL_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            # The owner may be dead - looked up again next time
+            self.forget(room_name)
+            raise GameError('The room is not available, please try again')
+        finally:
+            self.calls.pop(call_id, None)
+        if reply.get('moved'):
+            raise RoomMoved(room_name)
+        if 'error' in reply:
+            raise GameError(reply['error'])
+        return reply['result']
+
+    async def serve_call(self, message):
+        reply = {'type': 'room.reply', 'id': message['id']}
+        try:
+            if await self.get_owner(message['room']) != self.worker_id:
+                raise RoomMoved(message['room'])
+            reply['result'] = await run_in_room(
+                message['room'], self.run_op, message['room'], message['op'], message['kwargs'],
+            )
+        except RoomMoved:
+            reply['moved'] = True
+        except GameError as e:
+            reply['error'] = str(e)
+        except Exception as e:
+            logger.exception('Room call %s failed', message['op'])
+            reply['error'] = f'Server error: {e}'
+        await self.channel_layer.send(message['reply'], reply)
+        count_channel_sends()
+
+    # Hand-off
+
+    async def rebalance(self):
+        self.owners.clear()
+        for room_name in list(self.owned):
+            worker = room_registry.choose_worker(room_name)
+            if worker != self.worker_id:
+                await run_in_room(room_name, self.hand_off, room_name, worker)
+
+    async def hand_off(self, room_name, worker):
+        # In the room actor: after the calls queued before, the ones after are redirected to the new owner
+        if room_name not in self.owned:
+            return
+        self.owned.discard(room_name)
+        done = self.moving[room_name] = asyncio.get_running_loop().create_future()
+        try:
+            for callback in hand_off_callbacks:
+                await callback(room_name)
+            await sync_to_async(room_registry.move_room)(room_name, worker)
+            self.owners[room_name] = worker
+            logger.info('Room %s handed off to %s', room_name, worker)
+        except Exception:
+            # Kept - tried again on the next change of the ring
+            self.owned.add(room_name)
+            logger.exception('Failed to hand off room %s', room_name)
+        finally:
+            del self.moving[room_name]
+            done.set_result(None)
+
+    async def leave(self):
+        # Graceful stop of the worker: its rooms go to the ring of the other workers
+        self.leaving = True
+        await sync_to_async(room_registry.leave)(self.worker_id)
+        await self.rebalance()
+        logger.info('Worker %s has left, %s rooms kept', self.worker_id, len(self.owned))
+
+
+node = WorkerNode()
+
+
+async def call_room(room_name, op, **kwargs):
+    """
+    Run the room operation op(room_name=room_name, **kwargs) by the owner of the room and return its result.
+    The arguments and the result cross the channel layer - plain data only.
+    """
+    await node.start()
+    return await node.call(room_name, op, kwargs)
+
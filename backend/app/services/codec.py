@@ -0,0 +1,91 @@
+import json
+
+import msgpack
+
+from app.services.cards import CARD_DICTS, card_to_code, code_to_card
+
+
+def is_card_dict(value):
+    return isinstance(value, dict) and len(value) == 2 and 'rank' in value and 'suit' in value
+
+
+def encode_cards(value):
+    """
+    Replace all the card dicts in the message with single-byte card codes.
+    """
+    if is_card_dict(value):
+        return card_to_code(value)
+    if isinstance(value, dict):
+        return {key: encode_cards(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_cards(item) for item in value]
+    return value
+
+
+class JsonCodec:
+    """
+    Default text protocol - cards are dicts.
+    """
+    name = 'json'
+    subprotocol = None
+
+    def encode(self, message):
+        return json.dumps(message)
+
+    def make_batch(self, parts):
+        return '{"action": "batch", "messages": [' + ', '.join(parts) + ']}'
+
+    def decode(self, text_data=None, bytes_data=None):
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+
+class MsgpackCodec:
+    """
+    Binary protocol - MessagePack, cards are single bytes (rank * 4 + suit).
+    """
+    name = 'msgpack'
+    subprotocol = 'durak.msgpack'
+
+    # fixmap with 2 keys: {'action': 'batch', 'messages': [...]}
+    batch_prefix = b'\x82' + msgpack.packb('action') + msgpack.packb('batch') + msgpack.packb('messages')
+
+    def encode(self, message):
+        return msgpack.packb(encode_cards(message))
+
+    @staticmethod
+    def pack_array_header(n):
+        if n < 16:
+            return bytes([0x90 | n])
+        if n < 2 ** 16:
+            return b'\xdc' + n.to_bytes(2, 'big')
+        return b'\xdd' + n.to_bytes(4, 'big')
+
+    def make_batch(self, parts):
+        # Already encoded messages are concatenated as they are
+        return self.batch_prefix + self.pack_array_header(len(parts)) + b''.join(parts)
+
+    def decode(self, text_data=None, bytes_data=None):
+        data = msgpack.unpackb(bytes_data if bytes_data is not None else text_data.encode())
+        # Not a card code - refused by the validation (see app.services.inbound)
+        if isinstance(data, dict) and isinstance(data.get('card'), int) and data['card'] in CARD_DICTS:
+            data['card'] = code_to_card(data['card'])
+        return data
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec(), MsgpackCodec())}
+DEFAULT_CODEC = CODECS[JsonCodec.name]
+
+
+def negotiate_codec(subprotocols):
+    """
+    Pick the codec by the websocket subprotocols offered by the client.
+    JSON is the fallback.
+    """
+    for codec in CODECS.values():
+        if codec.subprotocol and codec.subprotocol in subprotocols:
+            return codec
+    return DEFAULT_CODEC
+
+
+def get_codec(name):
+    return CODECS.get(name, DEFAULT_CODEC)
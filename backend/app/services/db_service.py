@@ -1,273 +1,203 @@
 import logging
 
-from channels.db import database_sync_to_async
-from rest_framework.authtoken.models import Token
+from django.db import connection
+from django.utils import timezone
 
-from app.models import Card, Game, Player
-from app.services.helpers import GameError, get_player_user_name
+from app.models import Game, Player
+from app.services.cards import Hand, cards_from_dicts, cards_to_dicts
+from app.services.engine import GameState
+from app.services.helpers import get_player_user_name
+from app.services.presence import presence
 
 
 logger = logging.getLogger('django_vue_multiplayer')
 
 
-@database_sync_to_async
-def get_user_by_token(token_key):
-    try:
-        token = Token.objects.get(key=token_key)
-        return token.user
-    except Token.DoesNotExist:
-        return None
+# Synchronous building blocks of the units of work in game_service -
+# every handler runs its whole unit in one database_sync_to_async hop.
 
-
-@database_sync_to_async
-def create_player(channel_name, user=None):
-    player = Player(channel_name=channel_name)
-    if user:
-        player.user = user
-    player.save()
+def get_or_create_player(user):
+    # One player per user, kept between the games
+    player, _ = Player.objects.get_or_create(user=user)
     return player
 
 
-@database_sync_to_async
-def get_or_create_game():
-    game, _ = Game.objects.get_or_create(pk=1)
+def get_or_create_game(room_name):
+    game, _ = Game.objects.get_or_create(name=room_name)
     return game
 
 
-@database_sync_to_async
-def add_visitor_to_game(game, player):
-    game.visitors.add(player)
-    game.save()
-
-
-@database_sync_to_async
-def update_player_user(player, user):
-    player.user = user
-    player.save()
-
-
-@database_sync_to_async
-def get_player_by_user(game, user):
-    for player in game.visitors.all():
-        if player.user == user:
-            return player
-
-
-@database_sync_to_async
-def get_player_by_channel_name(game, channel_name):
-    for player in game.visitors.all():
-        if player.channel_name == channel_name:
-            return player
-
-
-@database_sync_to_async
-def get_next_player(game, player):
-    players = list(game.participants.order_by('id').all())
-    idx = players.index(player)
-    return players[(idx + 1) % len(players)]
-
-
-@database_sync_to_async
-def get_game_visitors_participants_names(game):
-    visitor_names = [get_player_user_name(player) for player in game.visitors.all()]
-    participant_names = [get_player_user_name(player) for player in game.participants.all()]
-    return visitor_names, participant_names
-
-
-@database_sync_to_async
-def set_game_state(game, state):
-    game.state = state
-    game.save()
-
-
-@database_sync_to_async
-def init_participants(game):
-    for user in game.visitors.all():
-        game.participants.add(user)
-    game.save()
-
-
-@database_sync_to_async
-def remove_player(player):
-    player.delete()
-
-
-@database_sync_to_async
-def init_current_player(game):
-    game.current_player = game.participants.first()
-    game.save()
-    return game.current_player
-
-
-@database_sync_to_async
-def get_current_player(game):
-    return game.current_player
-
-
-@database_sync_to_async
-def set_current_player(game, player):
-    game.current_player = player
-    game.save()
-    return player
-
-
-@database_sync_to_async
-def get_current_player_user_name(game):
-    if game.current_player:
-        return get_player_user_name(game.current_player)
-    return None
-
-
-@database_sync_to_async
-def get_phase(game):
-    return game.phase
-
-
-@database_sync_to_async
-def get_active_player_names(game):
-    active_player_names = [player.user.username for player in game.active_players.all()]
-    return active_player_names
-
-
-@database_sync_to_async
-def get_allowed_actions(game):
-    return game.allowed_actions
-
-
-@database_sync_to_async
-def set_phase(game, phase):
-    game.phase = phase
-    game.save()
-
-
-@database_sync_to_async
-def set_active_players(game, players):
-    game.active_players.clear()
-    for player in players:
-        game.active_players.add(player)
-    game.save()
-
-
-@database_sync_to_async
-def set_allowed_actions(game, actions):
-    game.allowed_actions.clear()
-    for action in actions:
-        game.allowed_actions.append(action)
-    game.save()
-
-
-@database_sync_to_async
-def toggle_phase(game):
-    if game.phase == Game.Phases.ATTACK:
-        game.phase = Game.Phases.DEFENSE
-    elif game.phase == Game.Phases.DEFENSE:
-        game.phase = Game.Phases.ATTACK
-    else:
-        raise GameError(f'Current phase cannot be toggled: {game.phase}')
-    game.save()
-    return game.phase
-
-
-@database_sync_to_async
-def toggle_active_players(game):
-    active_players = list(game.participants.exclude(
-        id__in=game.active_players.values_list('id', flat=True)
-    ))
-    game.active_players.clear()
-    for player in active_players:
-        game.active_players.add(player)
-    game.save()
-
-
-# def _get_participants(game):
-#     return list(game.participants.order_by('id').all())
-
-
-@database_sync_to_async
-def get_participants(game):
-    return list(game.participants.order_by('id').all())
-
-
-@database_sync_to_async
-def get_player_hand(player):
-    player = Player.objects.get(id=player.id)
-    return player.hand
-
-
-@database_sync_to_async
-def play_card_to_table(game, player, card_dict):
-    if not card_dict in player.hand:
-        raise GameError(f'You have no such card in your hand: {str(Card(**card_dict))}')
-    player.hand.remove(card_dict)
-    game.table.append(card_dict)
-    player.save()
-    game.save()
-
-
-@database_sync_to_async
-def get_table(game):
-    return game.table
-
-
-@database_sync_to_async
-def take_cards_from_table(game, player):
-    player.hand += game.table
-    game.table = []
-    player.save()
-    game.save()
-
-
-@database_sync_to_async
-def clear_table(game):
-    game.table = []
-    game.save()
-
-
-@database_sync_to_async
-def is_player_participant(game, player):
-    return game.participants.filter(id=player.id).exists()
-
-
-@database_sync_to_async
-def end_game(game):
-    game.state = Game.States.NOT_STARTED
-    game.participants.update(hand=[])
-    game.participants.clear()
-    game.current_player = None
-    game.phase = Game.Phases.ATTACK
-    game.active_players.clear()
-    game.allowed_actions = []
-    game.deck = []
-    game.table = []
-    game.save()
-
-
-@database_sync_to_async
-def is_player_in_active_players(game, player):
-    return game.active_players.filter(id=player.id).exists()
-
-
-@database_sync_to_async
-def remove_player_from_participants(game, player):
-    game.participants.remove(player)
+def create_games(room_names):
+    Game.objects.bulk_create([Game(name=room_name) for room_name in room_names])
 
 
-@database_sync_to_async
-def get_deck(game):
-    return game.deck
+def add_visitor_to_game(game_id, player_id):
+    Game.visitors.through.objects.get_or_create(game_id=game_id, player_id=player_id)
 
 
-@database_sync_to_async
-def check_end_game(game):
-    return len(game.participants.all()) <= 1
+def is_player_in_other_game(game_id, player_id):
+    return Game.visitors.through.objects.filter(player_id=player_id).exclude(game_id=game_id).exists()
 
 
-@database_sync_to_async
-def prepare_end_game_message(game):
-    msg = 'End of game. '
-    participants = game.participants.all()
-    if len(participants) == 1:
-        msg += f'{participants[0].user.username} lost'
-    elif len(participants) == 0:
-        msg += 'Draw'
-    return msg
+def is_player_in_game(game_id, player_id):
+    return Game.visitors.through.objects.filter(game_id=game_id, player_id=player_id).exists()
+
+
+def release_player(game_id, player_id):
+    # The player has left the game - the row stays for the next one
+    Game.visitors.through.objects.filter(game_id=game_id, player_id=player_id).delete()
+    Player.objects.filter(id=player_id).update(hand=[], disconnected_at=None)
+
+
+def suspend_player(player_id):
+    Player.objects.filter(id=player_id).update(disconnected_at=timezone.now())
+
+
+def resume_player(player_id):
+    Player.objects.filter(id=player_id).update(disconnected_at=None)
+
+
+def is_player_disconnected(player_id):
+    return Player.objects.filter(id=player_id, disconnected_at__isnull=False).exists()
+
+
+# Persistence of the engine state
+
+def get_connections(room_name):
+    # Connections of the players are in the presence registry, not in the DB: player id -> (channel, codec)
+    return {
+        connection['player']: (channel_name, connection['codec'])
+        for channel_name, connection in presence.get_room(room_name).items()
+        if connection['player']
+    }
+
+
+def load_game_state(game):
+    visitors = list(game.visitors.select_related('user').order_by('id'))
+    participant_ids = set(game.participants.values_list('id', flat=True))
+    active_player_ids = set(game.active_players.values_list('id', flat=True))
+    connections = get_connections(game.name)
+    return GameState(
+        version=game.version,
+        state=game.state,
+        visitors=[player.id for player in visitors],
+        participants=[player.id for player in visitors if player.id in participant_ids],
+        current_player=game.current_player_id,
+        phase=game.phase,
+        active_players=[player.id for player in visitors if player.id in active_player_ids],
+        allowed_actions=list(game.allowed_actions),
+        deck=cards_from_dicts(game.deck),
+        table=cards_from_dicts(game.table),
+        covered=game.covered,
+        trump=game.trump or None,
+        hands={player.id: Hand.from_dicts(player.hand) for player in visitors},
+        names={player.id: get_player_user_name(player) for player in visitors},
+        # Disconnected players (waited for to reconnect) have no channel
+        channels={player.id: connections[player.id][0] for player in visitors if player.id in connections},
+        codecs={player.id: connections[player.id][1] for player in visitors if player.id in connections},
+    )
+
+
+# (Game field, GameState attribute, conversion to the stored value)
+GAME_FIELDS = (
+    ('state', 'state', None),
+    ('current_player_id', 'current_player', None),
+    ('phase', 'phase', None),
+    ('allowed_actions', 'allowed_actions', list),
+    # Stored in the readable dict format
+    ('deck', 'deck', cards_to_dicts),
+    ('table', 'table', cards_to_dicts),
+    ('covered', 'covered', None),
+    ('trump', 'trump', lambda trump: trump or ''),
+)
+
+
+# Rows of one UPDATE ... FROM (VALUES ...), Postgres limits the number of parameters of a query
+UPDATE_BATCH_SIZE = 1000
+
+
+def update_from_values(model, fields, rows, check_version=False):
+    """
+    Update many rows of the model with one UPDATE ... FROM (VALUES ...) per UPDATE_BATCH_SIZE rows.
+    rows: (pk, [old version,] values of the fields).
+    With check_version a row is updated only if its version is still the old one (compare-and-swap).
+    Returns the pks of the updated rows.
+    """
+    quote = connection.ops.quote_name
+    model_fields = [model._meta.get_field(field) for field in fields]
+    names = ['id', 'old_version'] if check_version else ['id']
+    names += [field.column for field in model_fields]
+    assignments = ', '.join(
+        f'{quote(field.column)} = v.{quote(field.column)}::{field.db_type(connection)}' for field in model_fields
+    )
+    condition = 't.id = v.id AND t.version = v.old_version' if check_version else 't.id = v.id'
+    row_placeholder = f'({", ".join(["%s"] * len(names))})'
+
+    updated = []
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), UPDATE_BATCH_SIZE):
+            batch = rows[start:start + UPDATE_BATCH_SIZE]
+            params = []
+            for row in batch:
+                keys, values = row[:len(names) - len(model_fields)], row[len(names) - len(model_fields):]
+                params += keys
+                params += [field.get_db_prep_save(value, connection) for field, value in zip(model_fields, values)]
+            cursor.execute(
+                f'UPDATE {quote(model._meta.db_table)} AS t SET {assignments} '
+                f'FROM (VALUES {", ".join([row_placeholder] * len(batch))}) '
+                f'AS v({", ".join(quote(name) for name in names)}) '
+                f'WHERE {condition} RETURNING t.id',
+                params,
+            )
+            updated += [pk for pk, in cursor.fetchall()]
+    return updated
+
+
+def set_game_players(through, game_players):
+    # game_players: game id -> player ids, replaces the relation of the games at once
+    through.objects.filter(game_id__in=list(game_players)).delete()
+    through.objects.bulk_create([
+        through(game_id=game_id, player_id=player_id)
+        for game_id, player_ids in game_players.items()
+        for player_id in player_ids
+    ])
+
+
+def save_game_states(saves):
+    """
+    Write the changed games at once (see app.services.live_games). Must be called inside transaction.atomic.
+    saves: (game id, state saved before, state to save).
+    A game is written only if its row is still at the version saved before, returns the ids of the written games.
+    """
+    rows = [
+        (game_id, old_state.version, new_state.version) + tuple(
+            convert(getattr(new_state, attr)) if convert else getattr(new_state, attr)
+            for _, attr, convert in GAME_FIELDS
+        )
+        for game_id, old_state, new_state in saves
+    ]
+    fields = ['version'] + [field for field, _, _ in GAME_FIELDS]
+    saved = set(update_from_values(Game, fields, rows, check_version=True))
+
+    participants = {}
+    active_players = {}
+    hands = []
+    for game_id, old_state, new_state in saves:
+        if game_id not in saved:
+            continue
+        if new_state.participants != old_state.participants:
+            participants[game_id] = new_state.participants
+        if new_state.active_players != old_state.active_players:
+            active_players[game_id] = new_state.active_players
+        hands += [
+            (player_id, hand.to_dicts())
+            for player_id, hand in new_state.hands.items()
+            if hand != old_state.hands.get(player_id)
+        ]
+    if participants:
+        set_game_players(Game.participants.through, participants)
+    if active_players:
+        set_game_players(Game.active_players.through, active_players)
+    if hands:
+        update_from_values(Player, ['hand'], hands)
+    return saved
@@ -0,0 +1,37 @@
+# Fields of the game_state message sent as is when changed
+GAME_STATE_FIELDS = ('current_player', 'phase', 'active_players', 'allowed_actions', 'trump')
+
+
+def diff_table(old_table, new_table):
+    if list(new_table[:len(old_table)]) == list(old_table):
+        return {'append': list(new_table[len(old_table):])}
+    return {'set': list(new_table)}
+
+
+def make_game_delta(old_snapshot, new_snapshot):
+    """
+    game_delta message: changes to apply to the game_state of base_version to get version.
+    """
+    old_message = old_snapshot.to_game_state_message()
+    new_message = new_snapshot.to_game_state_message()
+    changes = {
+        field: new_message[field]
+        for field in GAME_STATE_FIELDS
+        if new_message[field] != old_message[field]
+    }
+    if new_message['table'] != old_message['table']:
+        changes['table'] = diff_table(old_message['table'], new_message['table'])
+    return {
+        'action': 'game_delta',
+        'base_version': old_snapshot.version,
+        'version': new_snapshot.version,
+        'changes': changes,
+    }
+
+
+def make_hand_delta(version, old_hand, new_hand):
+    if old_hand == new_hand:
+        return None
+    added = (new_hand - old_hand).to_dicts()
+    removed = (old_hand - new_hand).to_dicts()
+    return {'action': 'hand_delta', 'version': version, 'add': added, 'remove': removed}
@@ -0,0 +1,352 @@
+import logging
+import random
+
+from app.models import Card, Game
+from app.services.cards import Hand, card_to_code
+from app.services.helpers import GameError
+from app.services.rules import CARDS_IN_HAND, check_move, check_stop_attack
+
+logger = logging.getLogger('django_vue_multiplayer')
+
+
+class Events:
+    SERVER_STATE = 'server_state'
+    GAME_STATE = 'game_state'
+    HANDS = 'hands'
+    INFO = 'info'
+
+
+class GameState:
+    """
+    In-memory copy of the whole game. Players are referenced by Player ids,
+    cards - by codes (see Card.code): deck and table are bytearrays, hands are Hand bitsets.
+    """
+
+    def __init__(
+        self,
+        state=Game.States.NOT_STARTED,
+        visitors=None,
+        participants=None,
+        current_player=None,
+        phase=Game.Phases.ATTACK,
+        active_players=None,
+        allowed_actions=None,
+        deck=None,
+        table=None,
+        covered=0,
+        trump=None,
+        hands=None,
+        names=None,
+        channels=None,
+        codecs=None,
+        version=0,
+    ):
+        self.version = version
+        self.state = state
+        self.visitors = visitors or []
+        # participants - always ordered by id (the order of turns)
+        self.participants = participants or []
+        self.current_player = current_player
+        self.phase = phase
+        self.active_players = active_players or []
+        self.allowed_actions = allowed_actions or []
+        self.deck = deck or bytearray()
+        self.table = table or bytearray()
+        # covered - number of attack cards on the table covered by the defender
+        self.covered = covered
+        self.trump = trump
+        self.hands = hands or {}
+        self.names = names or {}
+        # Channel names of the visitors - where to deliver the messages, not used by the rules
+        self.channels = channels or {}
+        self.codecs = codecs or {}
+
+    def copy(self):
+        return GameState(
+            version=self.version,
+            state=self.state,
+            visitors=list(self.visitors),
+            participants=list(self.participants),
+            current_player=self.current_player,
+            phase=self.phase,
+            active_players=list(self.active_players),
+            allowed_actions=list(self.allowed_actions),
+            deck=bytearray(self.deck),
+            table=bytearray(self.table),
+            covered=self.covered,
+            trump=self.trump,
+            hands={player: hand.copy() for player, hand in self.hands.items()},
+            names=dict(self.names),
+            channels=dict(self.channels),
+            codecs=dict(self.codecs),
+        )
+
+
+class GameEngine:
+    """
+    Reducer for the Durak game: apply(action) -> (new_state, events).
+    Doesn't touch the DB, so the whole move is one state transition.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.action_funcs = {
+            'start': self.start,
+            'play': self.play,
+            'take': self.take,
+            'pass': self.pass_,
+            'end': self.end,
+            'leave': self.leave,
+        }
+
+    def apply(self, action):
+        action_func = self.action_funcs.get(action['action'])
+        if not action_func:
+            raise GameError(f'Unknown action: {action["action"]}')
+
+        old_state = self.state
+        self.state = old_state.copy()
+        self.state.version += 1
+        self.events = []
+        try:
+            action_func(action)
+        except GameError:
+            self.state = old_state
+            raise
+        return self.state, self.events
+
+    def emit(self, event_type, **kwargs):
+        self.events.append({'type': event_type, **kwargs})
+
+    # Actions
+
+    def start(self, action):
+        if self.state.state != Game.States.NOT_STARTED:
+            raise GameError('Game has been already started')
+
+        self.state.state = Game.States.GAME
+        self.state.participants = sorted(self.state.visitors)
+        self.emit(Events.SERVER_STATE)
+
+        # seed - makes the deal reproducible on replay (see app.services.journal)
+        self.generate_deck(action.get('seed'))
+        self.state.current_player = self.state.participants[0] if self.state.participants else None
+        self.start_new_turn()
+
+        self.emit(Events.GAME_STATE)
+        self.emit(Events.HANDS)
+
+    def play(self, action):
+        player = action['player']
+        self.check_action_allowed(player)
+
+        card_dict = action['card']
+        card_code = card_to_code(card_dict)
+        hand = self.state.hands[player]
+        if card_code not in hand:
+            raise GameError(f'You have no such card in your hand: {str(Card.from_dict(card_dict))}')
+        check_move(self.state, player, card_code)
+        hand.remove(card_code)
+        self.state.table.append(card_code)
+        if self.state.phase == Game.Phases.DEFENSE:
+            self.state.covered += 1
+
+        defender = self.get_next_player(self.state.current_player)
+        next_player = self.get_next_player(defender)
+
+        # If all allowed cards were played in the round
+        if check_stop_attack(self.state, defender):
+            if self.state.phase == Game.Phases.DEFENSE:
+                self.clear_table()
+                self.state.current_player = defender
+            elif self.state.phase == Game.Phases.ADDITION:
+                self.take_cards_from_table(defender)
+                self.state.current_player = next_player
+
+            self.process_end_of_turn()
+
+        # Attackers add cards to defender's hand
+        elif self.state.phase == Game.Phases.ADDITION:
+            pass
+
+        # Usual cases
+        else:
+            self.toggle_phase()
+            if self.state.phase == Game.Phases.ATTACK:
+                self.toggle_active_players()
+                self.state.allowed_actions = [Game.Actions.PLAY, Game.Actions.PASS]
+            else:
+                self.state.active_players = [defender]
+                self.state.allowed_actions = [Game.Actions.PLAY, Game.Actions.TAKE]
+
+        self.emit(Events.GAME_STATE)
+        self.emit(Events.HANDS)
+
+    def take(self, action):
+        self.check_action_allowed(action['player'])
+
+        self.toggle_active_players()
+        self.state.phase = Game.Phases.ADDITION
+        self.state.allowed_actions = [Game.Actions.PLAY, Game.Actions.PASS]
+
+        self.emit(Events.GAME_STATE)
+        self.emit(Events.HANDS)
+
+    def pass_(self, action):
+        self.check_action_allowed(action['player'])
+
+        defender = self.get_next_player(self.state.current_player)
+        next_player = self.get_next_player(defender)
+
+        # TODO: Logic. Make more wise handling - count number of passes
+        # Current defender takes cards
+        if self.state.phase == Game.Phases.ADDITION:
+            self.take_cards_from_table(defender)
+            self.state.current_player = next_player
+
+        # Current attacker passes
+        else:
+            self.clear_table()
+            self.state.current_player = defender
+
+        self.process_end_of_turn()
+
+        self.emit(Events.GAME_STATE)
+        self.emit(Events.HANDS)
+
+    def end(self, action):
+        if action['player'] not in self.state.participants:
+            raise GameError('Game is already in progress. Please wait for the end of the game.')
+
+        self.end_game()
+        self.emit(Events.SERVER_STATE)
+        self.emit(Events.GAME_STATE)
+        self.emit(Events.HANDS)
+
+    def leave(self, action):
+        player = action['player']
+        if self.state.state == Game.States.GAME and player in self.state.participants:
+            self.end_game()
+        if player in self.state.visitors:
+            self.state.visitors.remove(player)
+        self.state.hands.pop(player, None)
+        self.state.channels.pop(player, None)
+        self.state.codecs.pop(player, None)
+        self.emit(Events.SERVER_STATE)
+        self.emit(Events.GAME_STATE)
+        self.emit(Events.HANDS)
+
+    # Action helpers
+
+    def check_action_allowed(self, player):
+        if player not in self.state.participants:
+            raise GameError('Game is already in progress. Please wait for the end of the game.')
+        if player not in self.state.active_players:
+            raise GameError('Please wait for your turn')
+
+    def process_end_of_turn(self):
+        self.start_new_turn()
+        self.check_and_process_end_game()
+        self.emit(Events.SERVER_STATE)
+
+    def check_and_process_end_game(self):
+        if len(self.state.participants) <= 1:
+            self.emit(Events.INFO, message=self.prepare_end_game_message())
+            self.end_game()
+
+    def prepare_end_game_message(self):
+        msg = 'End of game. '
+        if len(self.state.participants) == 1:
+            msg += f'{self.state.names.get(self.state.participants[0], "???")} lost'
+        elif len(self.state.participants) == 0:
+            msg += 'Draw'
+        return msg
+
+    def end_game(self):
+        for player in self.state.participants:
+            self.state.hands[player] = Hand()
+        self.state.state = Game.States.NOT_STARTED
+        self.state.participants = []
+        self.state.current_player = None
+        self.state.phase = Game.Phases.ATTACK
+        self.state.active_players = []
+        self.state.allowed_actions = []
+        self.state.deck = bytearray()
+        self.clear_table()
+        self.state.trump = None
+
+    def get_next_player(self, player):
+        participants = self.state.participants
+        idx = participants.index(player)
+        return participants[(idx + 1) % len(participants)]
+
+    def toggle_phase(self):
+        if self.state.phase == Game.Phases.ATTACK:
+            self.state.phase = Game.Phases.DEFENSE
+        elif self.state.phase == Game.Phases.DEFENSE:
+            self.state.phase = Game.Phases.ATTACK
+        else:
+            raise GameError(f'Current phase cannot be toggled: {self.state.phase}')
+
+    def toggle_active_players(self):
+        self.state.active_players = [
+            player for player in self.state.participants if player not in self.state.active_players
+        ]
+
+    def take_cards_from_table(self, player):
+        self.state.hands[player].add_all(self.state.table)
+        self.clear_table()
+
+    def clear_table(self):
+        self.state.table = bytearray()
+        self.state.covered = 0
+
+    # Deck and turns
+
+    def generate_deck(self, seed=None):
+        logger.debug('generate deck')
+        RANKS = list(range(6, 15))
+        SUITS = [
+            Card.SUITS.SPADES,
+            Card.SUITS.CLUBS,
+            Card.SUITS.HEARTS,
+            Card.SUITS.DIAMONDS,
+        ]
+
+        # Generate all combinations of RANKS and SUITS
+        all_cards = [(rank, suit) for rank in RANKS for suit in SUITS]
+        shuffler = random.Random(seed) if seed is not None else random
+        shuffler.shuffle(all_cards)
+        self.state.deck = bytearray(Card(card[0], card[1]).code for card in all_cards)
+        # The bottom card (drawn the last) defines the trump
+        self.state.trump = Card.from_code(self.state.deck[0]).suit
+
+    def draw_cards(self, player, n):
+        if n == 0:
+            return
+        card_codes = self.state.deck[-n:]
+        del self.state.deck[-n:]
+        logger.debug('cards to draw: %s', list(card_codes))
+        # If the deck is empty, nothing is drawn
+        self.state.hands[player].add_all(card_codes)
+
+    def replenish_all_player_hands(self):
+        for player in self.state.participants:
+            num_cards_to_draw = max(CARDS_IN_HAND - len(self.state.hands[player]), 0)
+            self.draw_cards(player, num_cards_to_draw)
+
+    def start_new_turn(self):
+        self.replenish_all_player_hands()
+        logger.debug('Cards left: %s', len(self.state.deck))
+        current_player = self.state.current_player
+
+        # Remove players with no cards
+        while self.state.participants and not self.state.hands[current_player]:
+            next_player = self.get_next_player(current_player)
+            self.state.participants.remove(current_player)
+            current_player = self.state.current_player = next_player
+        self.state.participants = [player for player in self.state.participants if self.state.hands[player]]
+
+        self.state.phase = Game.Phases.ATTACK
+        self.state.active_players = [current_player]
+        self.state.allowed_actions = [Game.Actions.PLAY]
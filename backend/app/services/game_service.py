@@ -1,101 +1,121 @@
 import logging
-import random
 
-from channels.db import database_sync_to_async
-
-from app.models import Card, Game
+from app.models import Game
 from app.services.db_service import (
-    get_current_player,
-    get_deck,
-    get_next_player,
-    get_player_hand,
-    get_participants,
-    get_table,
-    remove_player_from_participants,
-    set_active_players,
-    set_allowed_actions,
-    set_current_player,
-    set_phase,
+    add_visitor_to_game,
+    get_or_create_game,
+    get_or_create_player,
+    is_player_disconnected,
+    is_player_in_game,
+    is_player_in_other_game,
+    release_player,
+    resume_player,
+    suspend_player,
 )
+from app.services.engine import GameEngine
+from app.services.journal import make_replayable
+from app.services.live_games import live_games
+from app.services.metrics import database_sync_to_async
+from app.services.presence import presence
 
 
-CARDS_IN_HAND = 6
-
 logger = logging.getLogger('django_vue_multiplayer')
 
 
+# Units of work: everything a handler needs from the DB in one database_sync_to_async hop
+
+@database_sync_to_async
+def apply_game_action(game_id, action):
+    return apply_action(game_id, action)
+
+
+def apply_action(game_id, action):
+    """
+    Apply the action to the live state of the game, the DB is written behind (see live_games).
+    Returns the states before and after the action (for deltas) and the events.
+    Raises GameError (and changes nothing) if the action is not allowed.
+    """
+    action = make_replayable(action)
+    live = live_games.get(game_id)
+    old_state = live.state
+    new_state, events = GameEngine(old_state).apply(action)
+    live_games.commit(live, old_state, new_state, action)
+    logger.debug('Applied %s, events: %s', action['action'], events)
+    return old_state, new_state, events
+
+
+@database_sync_to_async
+def get_game_state(game_id):
+    return live_games.get(game_id).state
+
+
 @database_sync_to_async
-def generate_deck(game):
-    logger.debug('generate deck')
-    RANKS = list(range(6, 15))
-    SUITS = [
-        Card.SUITS.SPADES,
-        Card.SUITS.CLUBS,
-        Card.SUITS.HEARTS,
-        Card.SUITS.DIAMONDS,
-    ]
-
-    # Generate all combinations of RANKS and SUITS
-    all_cards = [(rank, suit) for rank in RANKS for suit in SUITS]
-    random.shuffle(all_cards)
-    game.deck = [Card(card[0], card[1]).to_dict() for card in all_cards]
-    game.save()
+def get_room_game_state(room_name):
+    game = get_or_create_game(room_name)
+    return game.id, live_games.get(game.id, game).state
 
 
 @database_sync_to_async
-def draw_cards(game, player, n):
-    if n == 0:
-        return
-    card_dicts = game.deck[-n:]
-    del game.deck[-n:]
-    logger.debug(f'cards to draw: {card_dicts}')
-
-    if card_dicts:
-        player.hand += card_dicts
-        game.save()
-        player.save()
+def join_game(room_name, channel_name, codec):
+    """
+    Get or create the game of the room and register the connection in the presence registry
+    (nothing is written to the DB until the user authenticates). Returns game_id.
+    """
+    game = get_or_create_game(room_name)
+    presence.add(channel_name, room_name, codec)
+    return game.id
+
+
+@database_sync_to_async
+def authenticate_player(game_id, channel_name, codec, user):
+    """
+    Seat the player of the user (resolved from the token, see app.services.auth) in the game,
+    the player becomes a visitor.
+    If the player is already in the game and has no live connection (disconnected or its worker died),
+    the connection is bound to it - the session is resumed.
+    Returns (player_id, game_state), both None if the user is connected elsewhere.
+    The connection is registered in the presence registry by the worker holding it (see GameConsumer).
+    """
+    player = get_or_create_player(user)
+    if is_player_in_game(game_id, player.id):
+        if presence.get_user_channel(user.id) not in (None, channel_name):
+            return None, None
+        resume_player(player.id)
+    elif is_player_in_other_game(game_id, player.id):
+        return None, None
     else:
-        # The deck is empty, handle according to your game's rules
-        pass
-
-
-async def replenish_hand(game, player):
-    logger.debug('replenish_hand')
-    num_cards_to_draw = max(CARDS_IN_HAND - len(await get_player_hand(player)), 0)
-    await draw_cards(game, player, num_cards_to_draw)
-
-
-async def replenish_all_player_hands(game):
-    logger.debug('replenish_all_player_hands')
-    participants = await get_participants(game)
-    for player in participants:
-        await replenish_hand(game, player)
-
-
-async def start_new_turn(game):
-    await replenish_all_player_hands(game)
-    logger.debug(f'Cards left: {len(await get_deck(game))}')
-    current_player = await get_current_player(game)
-
-    # Remove players with no cards
-    while not await get_player_hand(current_player) and await get_participants(game):
-        next_player = await get_next_player(game, current_player)
-        await remove_player_from_participants(game, current_player)
-        current_player = await set_current_player(game, next_player)
-    for player in await get_participants(game):
-        if not await get_player_hand(player):
-            await remove_player_from_participants(game, player)
-
-    await set_phase(game, Game.Phases.ATTACK)
-    await set_active_players(game, [current_player])
-    await set_allowed_actions(game, [Game.Actions.PLAY])
-
-
-async def check_stop_attack(game, defender):
-    if not await get_player_hand(defender):
-        return True
-    # TOOD: Logic. Change condition (not more than 6 attacker's cards)
-    # And attacker's cards not more than cards in the defender's hand
-    if len(await get_table(game)) >= CARDS_IN_HAND * 2:
-        return True
-    return False
+        add_visitor_to_game(game_id, player.id)
+    presence.bind_player(channel_name, user.id, player.id)
+    live = live_games.get(game_id)
+    live_games.add_visitor(live, player.id, user.username, channel_name, codec)
+    return player.id, live.state
+
+
+@database_sync_to_async
+def disconnect_player(game_id, player_id):
+    """
+    An anonymous connection has nothing to clean up (returns None).
+    A participant of a running game is kept to reconnect (returns None),
+    others leave the game at once (returns the result of the leave action).
+    """
+    if player_id is None:
+        return None
+    state = live_games.get(game_id).state
+    if state.state == Game.States.GAME and player_id in state.participants:
+        suspend_player(player_id)
+        return None
+    return leave(game_id, player_id)
+
+
+@database_sync_to_async
+def forfeit_player(game_id, player_id):
+    # Not reconnected in time - leaves the game. None if has reconnected meanwhile
+    if not is_player_disconnected(player_id):
+        return None
+    return leave(game_id, player_id)
+
+
+def leave(game_id, player_id):
+    result = apply_action(game_id, {'action': 'leave', 'player': player_id})
+    release_player(game_id, player_id)
+    return result
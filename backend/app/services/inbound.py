@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+
+from app.models import Card
+from app.services.cards import CARD_DICTS, card_to_code
+from app.services.codec import is_card_dict
+from app.services.metrics import INBOUND_REJECTED
+
+
+logger = logging.getLogger('django_vue_multiplayer')
+
+
+class InboundError(Exception):
+    """
+    Frame refused before any work is done for it. reason - label of the rejection metric.
+    """
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+def is_card(value):
+    return (
+        is_card_dict(value)
+        and isinstance(value['rank'], int)
+        and isinstance(value['suit'], str)
+        and value['suit'] in Card.SUITS_ORDER
+        and card_to_code(value) in CARD_DICTS
+    )
+
+
+def is_token(value):
+    # Key of a DRF token, may be left out if given on the handshake (see TokenAuthMiddleware)
+    return value is None or isinstance(value, str) and 0 < len(value) <= 40
+
+
+def is_optional_int(value):
+    return value is None or isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_version(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+# action -> {field: check}, the fields not listed are dropped
+ACTION_SCHEMAS = {
+    'authenticate': {'token': is_token},
+    'start': {},
+    'play': {'card': is_card},
+    'take': {},
+    'pass': {},
+    'end': {},
+    'resync': {},
+    # Last version the client has got (see OutboundQueue.ack)
+    'ack': {'version': is_version},
+    # Matchmaking (see MatchmakingConsumer), the ranges are checked by the handler
+    'queue': {'token': is_token, 'size': is_optional_int, 'rating': is_optional_int},
+    'leave': {},
+}
+
+
+def check_frame_size(text_data=None, bytes_data=None):
+    size = len(text_data) if text_data is not None else len(bytes_data or b'')
+    if size > settings.INBOUND_MAX_FRAME_BYTES:
+        raise InboundError('size', f'Bad message - longer than {settings.INBOUND_MAX_FRAME_BYTES} bytes')
+
+
+def is_ack(data):
+    # Acks are cumulative and cost nothing to handle, they are not rate-limited (see InboundMixin.read_message)
+    return isinstance(data, dict) and data.get('action') == 'ack'
+
+
+def validate_message(data, actions):
+    """
+    Check the decoded message against the schema of its action (one of actions).
+    Returns the message with only the known fields.
+    """
+    if not isinstance(data, dict):
+        raise InboundError('schema', 'Bad message - not an object')
+    action = data.get('action')
+    if not action:
+        raise InboundError('schema', 'Bad message - no "action" field')
+    if not isinstance(action, str) or action not in actions or action not in ACTION_SCHEMAS:
+        raise InboundError('action', f'Bad message - unknown action: {action}')
+    message = {'action': action}
+    for field, check in ACTION_SCHEMAS[action].items():
+        if not check(data.get(field)):
+            raise InboundError('schema', f'Bad message - invalid "{field}" field')
+        message[field] = data.get(field)
+    return message
+
+
+def count_rejected(reason):
+    INBOUND_REJECTED.labels(reason).inc()
+
+
+class TokenBucket:
+    """
+    Rate limit of a connection: rate tokens a second, up to burst at once.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated_at')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class InboundQueue:
+    """
+    Bounded queue of the validated messages of a connection, handled one by one by its own task,
+    so a slow action does not make the frames pile up unbounded in the server.
+    put() returns False when the queue is full (see INBOUND_OVERFLOW).
+    """
+    def __init__(self, handler, maxsize):
+        self.handler = handler
+        self.queue = asyncio.Queue(maxsize)
+        self.task = None
+        self.closed = False
+
+    def put(self, message):
+        if self.queue.full():
+            return False
+        self.queue.put_nowait(message)
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return True
+
+    async def run(self):
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                return
+            try:
+                await self.handler(message)
+            except Exception:
+                # The next messages are still handled
+                logger.exception('Failed to handle %s', message['action'])
+
+    async def close(self):
+        # The messages not handled yet are dropped, the one being handled is finished
+        self.closed = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        if self.task is not None:
+            self.queue.put_nowait(None)
+            await self.task
+            self.task = None
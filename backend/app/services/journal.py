@@ -0,0 +1,159 @@
+import random
+
+from app.models import GameCheckpoint, GameEvent
+from app.services.cards import Hand
+from app.services.engine import GameEngine, GameState
+
+
+# A checkpoint of the state is saved before every CHECKPOINT_EVERY-th action
+CHECKPOINT_EVERY = 50
+# Fields of an action needed to apply it again
+ACTION_FIELDS = ('action', 'player', 'card', 'seed')
+
+
+class ReplayError(Exception):
+    pass
+
+
+def make_replayable(action):
+    """
+    The only random part of the engine is the deal - 'start' gets the seed of the shuffle
+    (never taken from the client).
+    """
+    action = {key: value for key, value in action.items() if key in ACTION_FIELDS}
+    if action['action'] == 'start':
+        action['seed'] = random.getrandbits(63)
+    return action
+
+
+def state_to_dict(state):
+    # Everything the engine needs, names and channels are not part of the game
+    return {
+        'version': state.version,
+        'state': state.state,
+        'visitors': list(state.visitors),
+        'participants': list(state.participants),
+        'current_player': state.current_player,
+        'phase': state.phase,
+        'active_players': list(state.active_players),
+        'allowed_actions': list(state.allowed_actions),
+        'deck': list(state.deck),
+        'table': list(state.table),
+        'covered': state.covered,
+        'trump': state.trump,
+        'hands': {str(player): list(hand) for player, hand in state.hands.items()},
+    }
+
+
+def state_from_dict(data):
+    return GameState(
+        version=data['version'],
+        state=data['state'],
+        visitors=list(data['visitors']),
+        participants=list(data['participants']),
+        current_player=data['current_player'],
+        phase=data['phase'],
+        active_players=list(data['active_players']),
+        allowed_actions=list(data['allowed_actions']),
+        deck=bytearray(data['deck']),
+        table=bytearray(data['table']),
+        covered=data['covered'],
+        trump=data['trump'],
+        hands={int(player): Hand.from_codes(codes) for player, codes in data['hands'].items()},
+    )
+
+
+def make_journal_entry(old_state, new_state, action):
+    """
+    Journal entry of the applied action, with the checkpoint of the state before every CHECKPOINT_EVERY-th one.
+    Kept with the state until it is flushed (see live_games), saved in the same transaction as the game -
+    the journal never has a move the game hasn't and vice versa.
+    """
+    return {
+        'version': new_state.version,
+        'action': action,
+        'visitors': list(old_state.visitors),
+        'checkpoint': state_to_dict(old_state) if old_state.version % CHECKPOINT_EVERY == 0 else None,
+    }
+
+
+def make_journal_rows(game_id, room_name, entries):
+    # (events, checkpoints) to bulk create
+    events = []
+    checkpoints = []
+    for entry in entries:
+        if entry['checkpoint']:
+            checkpoints.append(GameCheckpoint(game_id=game_id, version=entry['version'] - 1, state=entry['checkpoint']))
+        events.append(GameEvent(
+            game_id=game_id,
+            room_name=room_name,
+            version=entry['version'],
+            action=entry['action'],
+            visitors=entry['visitors'],
+        ))
+    return events, checkpoints
+
+
+def restore_visitors(state, event):
+    # Visitors join and leave without actions - restored from the event
+    state.visitors = list(event.visitors)
+    state.hands = {player: state.hands.get(player, Hand()) for player in state.visitors}
+
+
+def apply_event(state, event):
+    restore_visitors(state, event)
+    new_state, _ = GameEngine(state).apply(event.action)
+    if new_state.version != event.version:
+        raise ReplayError(f'Game {event.game_id}: version {new_state.version} after the event {event.version}')
+    return new_state
+
+
+def replay_game(game_id, version=None):
+    """
+    Rebuild the state of the game at the version (the last one by default)
+    from the nearest checkpoint and the journal.
+    """
+    checkpoints = GameCheckpoint.objects.filter(game_id=game_id).order_by('-version')
+    if version is not None:
+        checkpoints = checkpoints.filter(version__lte=version)
+    checkpoint = checkpoints.first()
+    if not checkpoint:
+        raise ReplayError(f'Game {game_id}: no checkpoint' + (f' before version {version}' if version else ''))
+
+    state = state_from_dict(checkpoint.state)
+    events = GameEvent.objects.filter(game_id=game_id, version__gt=checkpoint.version).order_by('version')
+    if version is not None:
+        events = events.filter(version__lte=version)
+    for event in events.iterator():
+        state = apply_event(state, event)
+    if version is not None and state.version != version:
+        raise ReplayError(f'Game {game_id}: the journal ends at version {state.version}')
+    return state
+
+
+def verify_game(game_id):
+    """
+    Replay the whole journal of the game from the first checkpoint through the current engine
+    and compare the result with every later checkpoint (regression check).
+    Returns (number of events, list of mismatches).
+    """
+    checkpoints = {
+        checkpoint.version: checkpoint.state
+        for checkpoint in GameCheckpoint.objects.filter(game_id=game_id).order_by('version')
+    }
+    if not checkpoints:
+        raise ReplayError(f'Game {game_id}: no checkpoint')
+    first_version = min(checkpoints)
+    state = state_from_dict(checkpoints[first_version])
+    mismatches = []
+    count = 0
+    events = GameEvent.objects.filter(game_id=game_id, version__gt=first_version).order_by('version')
+    for event in events.iterator():
+        # A checkpoint is the state before its event
+        restore_visitors(state, event)
+        expected = checkpoints.get(state.version)
+        if expected is not None and state_to_dict(state) != expected:
+            mismatches.append(state.version)
+        state = apply_event(state, event)
+        count += 1
+    return count, mismatches
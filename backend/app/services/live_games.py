@@ -0,0 +1,302 @@
+import asyncio
+import bisect
+import json
+import logging
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django_redis import get_redis_connection
+
+from app.models import Game, GameCheckpoint, GameEvent
+from app.services.cards import Hand
+from app.services.db_service import get_connections, load_game_state, save_game_states
+from app.services.engine import GameEngine
+from app.services.helpers import GameError
+from app.services.journal import make_journal_entry, make_journal_rows, state_from_dict, state_to_dict
+from app.services.metrics import WRITE_BEHIND_FLUSH_DURATION, WRITE_BEHIND_FLUSH_GAMES, database_sync_to_async
+from app.services.rooms import get_room_group_name
+
+
+logger = logging.getLogger('django_vue_multiplayer')
+
+
+class LiveGame:
+    __slots__ = ('game_id', 'room_name', 'state', 'saved', 'entries')
+
+    def __init__(self, game_id, room_name, state):
+        self.game_id = game_id
+        self.room_name = room_name
+        # state - the current one, saved - the one in the DB
+        self.state = state
+        self.saved = state
+        # Journal entries of the actions not in the DB yet
+        self.entries = []
+
+
+class LiveGames:
+    """
+    Write-behind store of the games played on this worker. The room actor is the only writer of a room,
+    so the state in memory is the current one: an action is applied to it and backed up to Redis
+    (one round trip, before the players get the result). The DB is written by the flusher:
+    all the changed games in one transaction every WRITE_BEHIND_FLUSH_MS, at once at the end of a turn or a game.
+    The DB lags by one flush at most; if the worker dies, the backup newer than the DB
+    is taken on the next load of the game (see recover). Joins and leaves are written to the DB at once.
+    """
+    key_prefix = 'live_game'
+    # Backups of the games nobody has loaded for a day are dropped
+    backup_ttl = 24 * 60 * 60
+
+    def __init__(self):
+        # game id -> LiveGame
+        self.games = {}
+        # ids of the games changed since the last flush
+        self.dirty = set()
+        self._redis = None
+        # Set by start_flusher - without the flusher every action is written at once
+        self.loop = None
+        self.wake = None
+        self.urgent = False
+        self.flush_task = None
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = get_redis_connection()
+        return self._redis
+
+    def get_state_key(self, game_id):
+        return f'{self.key_prefix}:{game_id}:state'
+
+    def get_entries_key(self, game_id):
+        return f'{self.key_prefix}:{game_id}:entries'
+
+    # Called in the database_sync_to_async thread (see game_service)
+
+    def get(self, game_id, game=None):
+        live = self.games.get(game_id)
+        if live is None:
+            game = game or Game.objects.get(id=game_id)
+            live = self.games[game_id] = LiveGame(game.id, game.name, load_game_state(game))
+            self.recover(live)
+        else:
+            # Connections change without actions
+            connections = get_connections(live.room_name)
+            visitors = [player for player in live.state.visitors if player in connections]
+            live.state.channels = {player: connections[player][0] for player in visitors}
+            live.state.codecs = {player: connections[player][1] for player in visitors}
+        return live
+
+    def recover(self, live):
+        # The worker has died before the flush - the backup is newer than the DB
+        pipe = self.redis.pipeline()
+        pipe.get(self.get_state_key(live.game_id))
+        pipe.lrange(self.get_entries_key(live.game_id), 0, -1)
+        backup, entries = pipe.execute()
+        if not backup:
+            return
+        backup = json.loads(backup)
+        if backup['version'] <= live.saved.version:
+            self.redis.delete(self.get_state_key(live.game_id), self.get_entries_key(live.game_id))
+            return
+        state = state_from_dict(backup)
+        # Joins and leaves are in the DB already
+        state.visitors = list(live.saved.visitors)
+        state.hands = {player: state.hands.get(player, Hand()) for player in state.visitors}
+        state.names = live.saved.names
+        state.channels = live.saved.channels
+        state.codecs = live.saved.codecs
+        live.state = state
+        live.entries = [entry for entry in map(json.loads, entries) if entry['version'] > live.saved.version]
+        self.dirty.add(live.game_id)
+        logger.warning('Game %s recovered from the backup: version %s -> %s', live.game_id, live.saved.version, state.version)
+
+    def commit(self, live, old_state, new_state, action):
+        entry = make_journal_entry(old_state, new_state, action)
+        live.state = new_state
+        live.entries.append(entry)
+        pipe = self.redis.pipeline()
+        pipe.set(self.get_state_key(live.game_id), json.dumps(state_to_dict(new_state)), ex=self.backup_ttl)
+        pipe.rpush(self.get_entries_key(live.game_id), json.dumps(entry))
+        pipe.expire(self.get_entries_key(live.game_id), self.backup_ttl)
+        pipe.execute()
+
+        if self.loop is None or not settings.WRITE_BEHIND_FLUSH_MS:
+            self.flush([live.game_id])
+            return
+        was_clean = not self.dirty
+        self.dirty.add(live.game_id)
+        # End of a turn or a game - the DB should have it at once
+        urgent = new_state.state != old_state.state or bool(old_state.table and not new_state.table)
+        if was_clean or urgent:
+            self.loop.call_soon_threadsafe(self.wake_flusher, urgent)
+
+    def add_visitor(self, live, player_id, name, channel_name, codec):
+        state = live.state
+        if player_id not in state.visitors:
+            state = live.state = state.copy()
+            bisect.insort(state.visitors, player_id)
+            state.names[player_id] = name
+            state.hands[player_id] = Hand()
+        state.channels[player_id] = channel_name
+        state.codecs[player_id] = codec
+
+    def flush(self, game_ids=None):
+        game_ids = list(self.dirty) if game_ids is None else game_ids
+        self.dirty.difference_update(game_ids)
+        lives = [self.games[game_id] for game_id in game_ids if game_id in self.games]
+        if not lives:
+            return
+        started_at = time.perf_counter()
+        try:
+            with transaction.atomic():
+                saved = save_game_states([(live.game_id, live.saved, live.state) for live in lives])
+                events = []
+                checkpoints = []
+                for live in lives:
+                    if live.game_id in saved:
+                        live_events, live_checkpoints = make_journal_rows(live.game_id, live.room_name, live.entries)
+                        events += live_events
+                        checkpoints += live_checkpoints
+                GameCheckpoint.objects.bulk_create(checkpoints)
+                GameEvent.objects.bulk_create(events)
+        except Exception:
+            # Tried again by the next flush
+            self.dirty.update(live.game_id for live in lives)
+            raise
+
+        pipe = self.redis.pipeline()
+        for live in lives:
+            if live.game_id not in saved:
+                continue
+            live.saved = live.state
+            live.entries = []
+            if not live.state.visitors:
+                # Nobody is in the room - loaded again when needed
+                del self.games[live.game_id]
+            pipe.delete(self.get_state_key(live.game_id), self.get_entries_key(live.game_id))
+        pipe.execute()
+        WRITE_BEHIND_FLUSH_GAMES.observe(len(lives))
+        WRITE_BEHIND_FLUSH_DURATION.observe(time.perf_counter() - started_at)
+
+        conflicting = [live for live in lives if live.game_id not in saved]
+        rebased = [live.game_id for live in conflicting if self.rebase(live)]
+        if rebased:
+            # Written by the next flush, at once without the flusher
+            self.dirty.update(rebased)
+            if self.loop is None or not settings.WRITE_BEHIND_FLUSH_MS:
+                self.flush(rebased)
+            else:
+                self.loop.call_soon_threadsafe(self.wake_flusher, True)
+
+    def rebase(self, live):
+        """
+        The game has been written by another writer since the last flush (e.g. the worker the room was handed off
+        from, recover_games). The actions not in the DB yet are applied again on top of the DB state,
+        so the moves the players have been told about are kept; an action the new state does not allow is dropped.
+        The backup is replaced, the players of the room get the full state again.
+        Returns False if the game has been deleted - it is dropped with its backup.
+        """
+        try:
+            game = Game.objects.get(id=live.game_id)
+        except Game.DoesNotExist:
+            logger.warning('Game %s has been deleted, dropped from memory', live.game_id)
+            self.drop(live.game_id)
+            return False
+        saved = load_game_state(game)
+        state = saved
+        entries = []
+        for entry in live.entries:
+            try:
+                new_state, _ = GameEngine(state).apply(entry['action'])
+            except GameError as e:
+                logger.error('Game %s: %s not applied again (%s)', live.game_id, entry['action'], e)
+                continue
+            entries.append(make_journal_entry(state, new_state, entry['action']))
+            state = new_state
+        logger.warning(
+            'Game %s has been changed by another writer: %s of %s actions applied again on version %s',
+            live.game_id, len(entries), len(live.entries), saved.version,
+        )
+        live.saved = saved
+        live.state = state
+        live.entries = entries
+        pipe = self.redis.pipeline()
+        pipe.set(self.get_state_key(live.game_id), json.dumps(state_to_dict(state)), ex=self.backup_ttl)
+        pipe.delete(self.get_entries_key(live.game_id))
+        if entries:
+            pipe.rpush(self.get_entries_key(live.game_id), *map(json.dumps, entries))
+            pipe.expire(self.get_entries_key(live.game_id), self.backup_ttl)
+        pipe.execute()
+        # The deltas the players have got do not add up to the new state
+        async_to_sync(get_channel_layer().group_send)(get_room_group_name(live.room_name), {'type': 'resync_state'})
+        return True
+
+    def drop(self, game_id):
+        # Forgotten with its backup, nothing is written
+        self.games.pop(game_id, None)
+        self.dirty.discard(game_id)
+        self.redis.delete(self.get_state_key(game_id), self.get_entries_key(game_id))
+
+    def release_room(self, room_name):
+        # The room is handed off to another worker (see WorkerNode.hand_off) - written and dropped from memory
+        game_ids = [game_id for game_id, live in self.games.items() if live.room_name == room_name]
+        self.flush([game_id for game_id in game_ids if game_id in self.dirty])
+        for game_id in game_ids:
+            self.games.pop(game_id, None)
+
+    def recover_all(self):
+        """
+        Write all the backups newer than the DB (e.g. of the rooms of a dead worker nobody has joined since).
+        Returns the ids of the recovered games.
+        """
+        recovered = []
+        for key in self.redis.scan_iter(match=self.get_state_key('*')):
+            game_id = int(key.decode().split(':')[1])
+            game = Game.objects.filter(id=game_id).first()
+            if game is None:
+                self.redis.delete(self.get_state_key(game_id), self.get_entries_key(game_id))
+                continue
+            if game_id not in self.games and self.get(game_id, game).state.version > game.version:
+                recovered.append(game_id)
+        self.flush()
+        return recovered
+
+    # Event loop side
+
+    def start_flusher(self):
+        if not settings.WRITE_BEHIND_FLUSH_MS or self.flush_task is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        self.flush_task = asyncio.create_task(self.run_flusher())
+
+    def wake_flusher(self, urgent):
+        self.urgent = self.urgent or urgent
+        self.wake.set()
+
+    async def run_flusher(self):
+        interval = settings.WRITE_BEHIND_FLUSH_MS / 1000
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            # Changes of the interval are written together, the end of a turn or a game cuts it short
+            if not self.urgent:
+                try:
+                    await asyncio.wait_for(self.wake.wait(), interval)
+                except asyncio.TimeoutError:
+                    pass
+            self.wake.clear()
+            self.urgent = False
+            try:
+                await flush_games()
+            except Exception:
+                logger.exception('Write-behind flush failed')
+                self.wake.set()
+
+
+live_games = LiveGames()
+flush_games = database_sync_to_async(live_games.flush)
+release_live_room = database_sync_to_async(live_games.release_room)
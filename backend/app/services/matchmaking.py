@@ -0,0 +1,200 @@
+import asyncio
+import itertools
+import logging
+import time
+import uuid
+from collections import Counter
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from app.services.db_service import create_games
+from app.services.metrics import (
+    MATCHMAKING_QUEUE_DEPTH,
+    MATCHMAKING_TABLES,
+    MATCHMAKING_TICK_DURATION,
+    MATCHMAKING_WAIT,
+    database_sync_to_async,
+)
+
+
+logger = logging.getLogger('django_vue_multiplayer')
+
+MIN_TABLE_SIZE = 2
+MAX_TABLE_SIZE = 6
+DEFAULT_TABLE_SIZE = 2
+DEFAULT_RATING = 1000
+# Players of one bucket are matched at once
+RATING_BUCKET_WIDTH = 100
+# How far (in buckets) the rating range of a player may widen
+MAX_SEARCH_RADIUS = 10
+# The queue is a singleton - it is placed on one worker like a room (see RoomRegistry, WorkerNode)
+MATCHMAKING_ROOM = 'matchmaking'
+
+
+class Ticket:
+    __slots__ = ('channel_name', 'user_id', 'rating', 'size', 'queued_at', 'key')
+
+    def __init__(self, channel_name, user_id, rating=DEFAULT_RATING, size=DEFAULT_TABLE_SIZE, queued_at=None):
+        self.channel_name = channel_name
+        self.user_id = user_id
+        self.rating = rating
+        self.size = size
+        self.queued_at = time.monotonic() if queued_at is None else queued_at
+        self.key = (size, rating // RATING_BUCKET_WIDTH)
+
+
+class MatchmakingQueue:
+    """
+    Players waiting for a table, bucketed by (table size, rating bucket).
+    A bucket is a dict - in the order of joining, removal by the channel name is O(1).
+    """
+    def __init__(self):
+        # (size, rating bucket) -> {channel name: ticket}
+        self.buckets = {}
+        # channel name -> ticket
+        self.tickets = {}
+        # user id -> channel name, a user waits in the queue once
+        self.users = {}
+        # table size -> number of tickets
+        self.depth = Counter()
+
+    def __len__(self):
+        return len(self.tickets)
+
+    def join(self, ticket):
+        if ticket.user_id in self.users or ticket.channel_name in self.tickets:
+            return False
+        self.buckets.setdefault(ticket.key, {})[ticket.channel_name] = ticket
+        self.tickets[ticket.channel_name] = ticket
+        self.users[ticket.user_id] = ticket.channel_name
+        self.depth[ticket.size] += 1
+        return True
+
+    def leave(self, channel_name):
+        ticket = self.tickets.pop(channel_name, None)
+        if ticket is None:
+            return None
+        del self.users[ticket.user_id]
+        self.depth[ticket.size] -= 1
+        bucket = self.buckets[ticket.key]
+        del bucket[channel_name]
+        if not bucket:
+            del self.buckets[ticket.key]
+        return ticket
+
+    def take(self, tickets):
+        for ticket in tickets:
+            self.leave(ticket.channel_name)
+        return tickets
+
+    def match(self, now=None):
+        """
+        Form the tables, returns the list of them (lists of tickets).
+        First the full tables of every bucket (the longest waiting first),
+        then the players left wait long enough to be seated with the neighbouring buckets.
+        Linear in the number of queued players - no pairwise comparison.
+        """
+        now = time.monotonic() if now is None else now
+        tables = []
+        for (size, _), bucket in list(self.buckets.items()):
+            while len(bucket) >= size:
+                tables.append(self.take(list(itertools.islice(bucket.values(), size))))
+        tables.extend(self.match_neighbours(now))
+        return tables
+
+    def get_search_radius(self, ticket, now):
+        return min(int((now - ticket.queued_at) / settings.MATCHMAKING_WIDEN_SECONDS), MAX_SEARCH_RADIUS)
+
+    def match_neighbours(self, now):
+        # Every bucket has less than a table left - the search goes around the longest waiting player
+        tables = []
+        for anchor in sorted(self.tickets.values(), key=lambda ticket: ticket.queued_at):
+            if anchor.channel_name not in self.tickets:
+                continue
+            radius = self.get_search_radius(anchor, now)
+            if not radius:
+                # The rest have waited less
+                break
+            size, rating_bucket = anchor.key
+            table = [anchor]
+            for distance in range(radius + 1):
+                for key in {(size, rating_bucket - distance), (size, rating_bucket + distance)}:
+                    for ticket in self.buckets.get(key, {}).values():
+                        if len(table) < size and ticket is not anchor:
+                            table.append(ticket)
+                if len(table) == size:
+                    tables.append(self.take(table))
+                    break
+        return tables
+
+
+seat_tables = database_sync_to_async(create_games)
+
+
+class Matchmaker:
+    """
+    Runs the queue: every MATCHMAKING_TICK_SECONDS the tables are matched in one batch,
+    their rooms are created (one query for all of them) and the players are sent the room to connect to.
+    The task stops when the queue is empty and is started again by the next player.
+    """
+    def __init__(self):
+        self.queue = MatchmakingQueue()
+        self.task = None
+
+    def join(self, ticket):
+        if not self.queue.join(ticket):
+            return False
+        self.update_depth()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return True
+
+    def leave(self, channel_name):
+        if self.queue.leave(channel_name):
+            self.update_depth()
+
+    async def close(self):
+        # The queue has moved to another worker (see WorkerNode.hand_off) - the players queue there again,
+        # keeping the time they have waited
+        channel_layer = get_channel_layer()
+        now = time.monotonic()
+        for channel_name, ticket in list(self.queue.tickets.items()):
+            self.queue.leave(channel_name)
+            await channel_layer.send(channel_name, {'type': 'room_moved', 'waited': now - ticket.queued_at})
+        self.update_depth()
+
+    def update_depth(self):
+        for size, depth in self.queue.depth.items():
+            MATCHMAKING_QUEUE_DEPTH.labels(size).set(depth)
+
+    async def run(self):
+        while self.queue:
+            await asyncio.sleep(settings.MATCHMAKING_TICK_SECONDS)
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception('Matchmaking tick failed')
+
+    async def tick(self):
+        started_at = time.perf_counter()
+        now = time.monotonic()
+        tables = self.queue.match(now)
+        self.update_depth()
+        if tables:
+            await self.seat(tables, now)
+        MATCHMAKING_TICK_DURATION.observe(time.perf_counter() - started_at)
+
+    async def seat(self, tables, now):
+        room_names = [f'table-{uuid.uuid4().hex[:12]}' for _ in tables]
+        await seat_tables(room_names)
+        channel_layer = get_channel_layer()
+        for room_name, table in zip(room_names, tables):
+            MATCHMAKING_TABLES.labels(len(table)).inc()
+            for ticket in table:
+                MATCHMAKING_WAIT.labels(ticket.size).observe(now - ticket.queued_at)
+                await channel_layer.send(ticket.channel_name, {'type': 'match_found', 'room': room_name})
+        logger.debug('Seated %s tables, %s players wait', len(tables), len(self.queue))
+
+
+matchmaker = Matchmaker()
@@ -0,0 +1,149 @@
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from channels.db import DatabaseSyncToAsync
+from django.db.backends.signals import connection_created
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+ACTION_DURATION = Histogram(
+    'game_action_duration_seconds', 'Wall time of an action handler', ['action'],
+)
+ACTION_DB_HOPS = Histogram(
+    'game_action_db_hops', 'database_sync_to_async calls per action', ['action'], buckets=COUNT_BUCKETS,
+)
+ACTION_QUERIES = Histogram(
+    'game_action_queries', 'SQL queries per action', ['action'], buckets=COUNT_BUCKETS,
+)
+ACTION_QUERY_DURATION = Histogram(
+    'game_action_query_duration_seconds', 'Total time of the SQL queries of an action', ['action'],
+)
+ACTION_CHANNEL_SENDS = Histogram(
+    'game_action_channel_sends', 'Channel-layer sends per action', ['action'], buckets=COUNT_BUCKETS,
+)
+ACTION_QUEUE_WAIT = Histogram(
+    'game_action_queue_wait_seconds', 'Time an action waits in the room queue (see RoomActor)', ['action'],
+)
+
+MATCHMAKING_QUEUE_DEPTH = Gauge(
+    'matchmaking_queue_depth', 'Players waiting for a table', ['size'],
+)
+MATCHMAKING_WAIT = Histogram(
+    'matchmaking_wait_seconds', 'Time from joining the queue to getting a table', ['size'],
+    buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300),
+)
+MATCHMAKING_TICK_DURATION = Histogram(
+    'matchmaking_tick_duration_seconds', 'Time to match the queue and seat the tables of a tick',
+)
+MATCHMAKING_TABLES = Counter(
+    'matchmaking_tables', 'Tables formed by the matchmaker', ['size'],
+)
+
+WRITE_BEHIND_FLUSH_DURATION = Histogram(
+    'write_behind_flush_duration_seconds', 'Time to write the changed games to the DB (see live_games)',
+)
+WRITE_BEHIND_FLUSH_GAMES = Histogram(
+    'write_behind_flush_games', 'Games written by one flush', buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+
+INBOUND_REJECTED = Counter(
+    'inbound_rejected_messages', 'Frames refused before handling (see app.services.inbound)', ['reason'],
+)
+
+OUTBOUND_QUEUE_DEPTH = Gauge(
+    'outbound_queue_depth', 'Frames waiting to be sent to the clients of this process (see app.services.outbound)',
+)
+OUTBOUND_RESYNCS = Counter(
+    'outbound_resyncs', 'Times the queued state frames of a slow client were replaced by the full state',
+)
+OUTBOUND_SLOW_DISCONNECTS = Counter(
+    'outbound_slow_disconnects', 'Clients disconnected for staying behind',
+)
+
+
+class ActionMetrics:
+    __slots__ = ('db_hops', 'queries', 'query_seconds', 'channel_sends', 'queue_wait_seconds')
+
+    def __init__(self):
+        self.db_hops = 0
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.channel_sends = 0
+        self.queue_wait_seconds = 0.0
+
+
+# Metrics of the action being handled. The object is shared with the copies of the context
+# (database_sync_to_async threads, room actor tasks), so they all add to it.
+current_action = ContextVar('current_action', default=None)
+
+
+@asynccontextmanager
+async def measure_action(action):
+    metrics = ActionMetrics()
+    token = current_action.set(metrics)
+    started_at = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        current_action.reset(token)
+        ACTION_DURATION.labels(action).observe(time.perf_counter() - started_at)
+        ACTION_DB_HOPS.labels(action).observe(metrics.db_hops)
+        ACTION_QUERIES.labels(action).observe(metrics.queries)
+        ACTION_QUERY_DURATION.labels(action).observe(metrics.query_seconds)
+        ACTION_CHANNEL_SENDS.labels(action).observe(metrics.channel_sends)
+        ACTION_QUEUE_WAIT.labels(action).observe(metrics.queue_wait_seconds)
+
+
+def count_channel_sends(n=1):
+    metrics = current_action.get()
+    if metrics is not None:
+        metrics.channel_sends += n
+
+
+def add_queue_wait(seconds):
+    metrics = current_action.get()
+    if metrics is not None:
+        metrics.queue_wait_seconds += seconds
+
+
+class MeteredDatabaseSyncToAsync(DatabaseSyncToAsync):
+    async def __call__(self, *args, **kwargs):
+        metrics = current_action.get()
+        if metrics is not None:
+            metrics.db_hops += 1
+        return await super().__call__(*args, **kwargs)
+
+
+# Drop-in replacement of channels.db.database_sync_to_async
+database_sync_to_async = MeteredDatabaseSyncToAsync
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = current_action.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started_at = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.query_seconds += time.perf_counter() - started_at
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def install():
+    connection_created.connect(install_query_wrapper)
+
+
+def export_metrics():
+    """
+    Metrics of this process in the Prometheus text format: (body, content type).
+    """
+    return generate_latest(), CONTENT_TYPE_LATEST
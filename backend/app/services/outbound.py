@@ -0,0 +1,129 @@
+import asyncio
+import time
+from collections import deque
+
+from app.services.metrics import OUTBOUND_QUEUE_DEPTH, OUTBOUND_RESYNCS
+
+
+# Queued instead of the state frames dropped for a slow client (see OutboundQueue.coalesce)
+RESYNC = object()
+
+
+class OutboundQueue:
+    """
+    Frames to one client, sent by their own task: a client that reads slowly holds up its own queue only,
+    the consumer keeps taking its events off the channel layer.
+    version - version of the game state in the frame, None for the frames not about the state (errors, notices).
+    Sending a frame does not wait for the client to read it (the server buffers it), so the client acks
+    the versions it has got (see ack): at most maxsize state frames are sent ahead of its ack, the next
+    ones wait in the queue. Over maxsize queued frames the state frames are dropped and a full state is sent
+    instead (make_full_state, built when its turn comes); a client that leaves a state frame unacked
+    for slow_seconds is given up on (on_slow).
+    """
+    def __init__(self, send_frame, make_full_state, on_slow, maxsize, slow_seconds):
+        self.send_frame = send_frame
+        self.make_full_state = make_full_state
+        self.on_slow = on_slow
+        self.maxsize = maxsize
+        self.slow_seconds = slow_seconds
+        # (frame, version)
+        self.frames = deque()
+        # (version, sent at) of the state frames sent and not acked yet
+        self.unacked = deque()
+        self.acked_version = -1
+        self.acked = asyncio.Event()
+        # Set when the state frames were dropped, cleared when the queue is empty again
+        self.behind = False
+        self.task = None
+        self.closed = False
+
+    def put(self, frame, version=None):
+        """
+        Returns False when the client has just been found too slow - the queue is closed, the client should be.
+        """
+        if self.closed:
+            return True
+        if len(self.frames) >= self.maxsize:
+            self.coalesce()
+            # Nothing left to drop - the frames not about the state pile up
+            if len(self.frames) >= self.maxsize:
+                self.close()
+                return False
+        self.frames.append((frame, version))
+        OUTBOUND_QUEUE_DEPTH.inc()
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return True
+
+    def ack(self, version):
+        # Everything up to the version has got to the client
+        self.acked_version = max(self.acked_version, version)
+        while self.unacked and self.unacked[0][0] <= version:
+            self.unacked.popleft()
+        self.acked.set()
+
+    def coalesce(self):
+        if not self.behind:
+            self.behind = True
+            OUTBOUND_RESYNCS.inc()
+        self.drop_state_frames()
+        self.frames.append((RESYNC, None))
+        OUTBOUND_QUEUE_DEPTH.inc()
+
+    def drop_state_frames(self, up_to_version=None):
+        kept = deque(
+            (frame, version) for frame, version in self.frames
+            if frame is not RESYNC and (version is None or (up_to_version is not None and version > up_to_version))
+        )
+        OUTBOUND_QUEUE_DEPTH.dec(len(self.frames) - len(kept))
+        self.frames = kept
+
+    async def wait_for_ack(self):
+        # False if the oldest state frame sent has not been acked for slow_seconds
+        timeout = self.unacked[0][1] + self.slow_seconds - time.monotonic()
+        self.acked.clear()
+        try:
+            await asyncio.wait_for(self.acked.wait(), max(timeout, 0))
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def run(self):
+        slow = False
+        try:
+            while self.frames:
+                frame, version = self.frames[0]
+                if (frame is RESYNC or version is not None) and len(self.unacked) >= self.maxsize:
+                    # The queued frames may be coalesced meanwhile - the head is taken again
+                    if not await self.wait_for_ack():
+                        slow = True
+                        break
+                    continue
+                self.frames.popleft()
+                OUTBOUND_QUEUE_DEPTH.dec()
+                if frame is RESYNC:
+                    frame, version = await self.make_full_state()
+                    # Everything queued so far is in the full state
+                    self.drop_state_frames(version)
+                if version is not None and version > self.acked_version:
+                    self.unacked.append((version, time.monotonic()))
+                await self.send_frame(frame)
+            self.behind = False
+        finally:
+            self.task = None
+        if slow:
+            self.close()
+            await self.on_slow()
+
+    async def drain(self):
+        # Wait for the queued frames to be sent (e.g. an error before closing the connection)
+        if self.task is not None:
+            await asyncio.wait([self.task])
+
+    def close(self):
+        self.closed = True
+        OUTBOUND_QUEUE_DEPTH.dec(len(self.frames))
+        self.frames.clear()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
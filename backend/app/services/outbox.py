@@ -0,0 +1,64 @@
+from app.services.codec import get_codec
+from app.services.metrics import count_channel_sends
+
+
+class Outbox:
+    """
+    Collects all the messages produced by one action and delivers them
+    as one envelope per recipient (one channel-layer call per recipient).
+    Public messages are serialized once per codec and shared by all the envelopes.
+    """
+
+    def __init__(self):
+        self.public = []
+        # channel_name -> list of messages
+        self.private = {}
+
+    @staticmethod
+    def add_message(messages, message, coalesce):
+        # State messages are full snapshots - only the latest one matters
+        if coalesce:
+            for idx, queued in enumerate(messages):
+                if queued['action'] == message['action']:
+                    messages[idx] = message
+                    return
+        messages.append(message)
+
+    def add_public(self, message, coalesce=True):
+        self.add_message(self.public, message, coalesce)
+
+    def add_private(self, channel_name, message, coalesce=True):
+        self.add_message(self.private.setdefault(channel_name, []), message, coalesce)
+
+    def build_envelopes(self, recipients):
+        """
+        recipients: channel_name -> codec name.
+        Public messages are encoded once per codec in use.
+        """
+        public_parts = {}
+        envelopes = {}
+        for channel_name, codec_name in recipients.items():
+            codec = get_codec(codec_name)
+            if codec.name not in public_parts:
+                public_parts[codec.name] = [codec.encode(message) for message in self.public]
+            private_parts = [codec.encode(message) for message in self.private.get(channel_name, [])]
+            parts = public_parts[codec.name] + private_parts
+            if not parts:
+                continue
+            envelopes[channel_name] = parts[0] if len(parts) == 1 else codec.make_batch(parts)
+        return envelopes
+
+    async def flush(self, channel_layer, recipients, version=None):
+        # version - of the game state the messages are about (see OutboundQueue)
+        for channel_name, frame in self.build_envelopes(recipients).items():
+            await channel_layer.send(
+                channel_name,
+                {
+                    'type': 'send_message_to_group',
+                    'message': frame,
+                    'version': version,
+                },
+            )
+            count_channel_sends()
+        self.public = []
+        self.private = {}
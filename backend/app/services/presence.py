@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django_redis import get_redis_connection
+
+
+logger = logging.getLogger('django_vue_multiplayer')
+
+
+class PresenceRegistry:
+    """
+    Live websocket connections in Redis, nothing about them is written to Postgres.
+    Every entry expires unless its worker refreshes it (see heartbeat), so the connections
+    of a dead process disappear by themselves. A connection is added, refreshed and removed
+    by the worker holding its socket, whichever worker owns its room.
+    - presence:conn:<channel> - hash {room, codec, user, player} of the connection
+    - presence:room:<room> - sorted set channel -> expiry time, "who is in the room" without a scan
+    - presence:user:<user id> - channel of the user's connection
+    """
+    key_prefix = 'presence'
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+        self._redis = None
+        # channel -> (room, user id) of the connections of this process, refreshed by the heartbeat
+        self.local = {}
+        self.heartbeat_task = None
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = get_redis_connection(self.alias)
+        return self._redis
+
+    @property
+    def ttl(self):
+        return settings.PRESENCE_TTL_SECONDS
+
+    def get_connection_key(self, channel_name):
+        return f'{self.key_prefix}:conn:{channel_name}'
+
+    def get_room_key(self, room_name):
+        return f'{self.key_prefix}:room:{room_name}'
+
+    def get_user_key(self, user_id):
+        return f'{self.key_prefix}:user:{user_id}'
+
+    def add(self, channel_name, room_name, codec, user_id=None, player_id=None):
+        # Also used to update the connection (e.g. on authenticate)
+        connection = {'room': room_name, 'codec': codec, 'user': user_id or '', 'player': player_id or ''}
+        pipe = self.redis.pipeline()
+        pipe.hset(self.get_connection_key(channel_name), mapping=connection)
+        self.refresh(pipe, channel_name, room_name, user_id)
+        pipe.execute()
+        self.local[channel_name] = (room_name, user_id)
+
+    def refresh(self, pipe, channel_name, room_name, user_id):
+        pipe.expire(self.get_connection_key(channel_name), self.ttl)
+        pipe.zadd(self.get_room_key(room_name), {channel_name: time.time() + self.ttl})
+        pipe.expire(self.get_room_key(room_name), self.ttl)
+        if user_id:
+            pipe.set(self.get_user_key(user_id), channel_name, ex=self.ttl)
+
+    def bind_player(self, channel_name, user_id, player_id):
+        # By the owner of the room on authenticate, so that the next action sees the player connected
+        # and a second login is refused at once. Refreshed (or removed) by the worker of the connection.
+        pipe = self.redis.pipeline()
+        pipe.hset(self.get_connection_key(channel_name), mapping={'user': user_id, 'player': player_id})
+        pipe.expire(self.get_connection_key(channel_name), self.ttl)
+        pipe.set(self.get_user_key(user_id), channel_name, ex=self.ttl)
+        pipe.execute()
+
+    def remove(self, channel_name):
+        self.local.pop(channel_name, None)
+        connection = self.get(channel_name)
+        if connection is None:
+            return
+        pipe = self.redis.pipeline()
+        pipe.delete(self.get_connection_key(channel_name))
+        pipe.zrem(self.get_room_key(connection['room']), channel_name)
+        pipe.execute()
+        if connection['user'] and self.get_user_channel(connection['user']) == channel_name:
+            self.redis.delete(self.get_user_key(connection['user']))
+
+    @staticmethod
+    def decode(connection):
+        connection = {key.decode(): value.decode() for key, value in connection.items()}
+        connection['user'] = int(connection['user']) if connection['user'] else None
+        connection['player'] = int(connection['player']) if connection['player'] else None
+        return connection
+
+    def get(self, channel_name):
+        connection = self.redis.hgetall(self.get_connection_key(channel_name))
+        return self.decode(connection) if connection else None
+
+    def get_user_channel(self, user_id):
+        channel_name = self.redis.get(self.get_user_key(user_id))
+        return channel_name.decode() if channel_name else None
+
+    def get_room(self, room_name):
+        """
+        Connections of the room: channel -> connection, the latest refreshed last. Two round trips.
+        """
+        room_key = self.get_room_key(room_name)
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(room_key, '-inf', time.time())
+        pipe.zrange(room_key, 0, -1)
+        _, channel_names = pipe.execute()
+        pipe = self.redis.pipeline()
+        for channel_name in channel_names:
+            pipe.hgetall(self.get_connection_key(channel_name.decode()))
+        return {
+            channel_name.decode(): self.decode(connection)
+            for channel_name, connection in zip(channel_names, pipe.execute())
+            if connection
+        }
+
+    def count_rooms(self, room_names):
+        # Live connections per room, one round trip for all the rooms
+        now = time.time()
+        pipe = self.redis.pipeline()
+        for room_name in room_names:
+            pipe.zcount(self.get_room_key(room_name), now, '+inf')
+        return dict(zip(room_names, pipe.execute()))
+
+    def heartbeat(self):
+        # All the connections of this process are refreshed in one round trip
+        pipe = self.redis.pipeline()
+        for channel_name, (room_name, user_id) in list(self.local.items()):
+            self.refresh(pipe, channel_name, room_name, user_id)
+        pipe.execute()
+
+    def start_heartbeat(self):
+        if self.heartbeat_task is None or self.heartbeat_task.done():
+            self.heartbeat_task = asyncio.create_task(self.run_heartbeat())
+
+    async def run_heartbeat(self):
+        # Runs as long as the worker (see WorkerNode)
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            if not self.local:
+                continue
+            try:
+                await sync_to_async(self.heartbeat)()
+            except Exception:
+                logger.exception('Presence heartbeat failed')
+
+
+presence = PresenceRegistry()
+add_connection = sync_to_async(presence.add)
+remove_connection = sync_to_async(presence.remove)
@@ -0,0 +1,192 @@
+import time
+
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+
+from app.services.cards import Hand
+from app.services.cluster import on_hand_off, room_op
+from app.services.codec import get_codec
+from app.services.delta import make_game_delta, make_hand_delta
+from app.services.engine import Events
+from app.services.game_service import (
+    apply_game_action,
+    authenticate_player,
+    disconnect_player,
+    forfeit_player,
+    get_game_state,
+    get_room_game_state,
+)
+from app.services.live_games import release_live_room
+from app.services.matchmaking import MATCHMAKING_ROOM, Ticket, matchmaker
+from app.services.metrics import count_channel_sends
+from app.services.outbox import Outbox
+from app.services.rooms import get_room_group_name
+from app.services.rules import make_legal_moves_message
+from app.services.snapshot import GameSnapshot
+from app.services.spectators import (
+    add_spectator,
+    get_spectators_group_name,
+    make_spectator_frame,
+    publish_to_spectators,
+    release_spectators,
+    remove_spectator,
+)
+
+
+# Operations on a room, run by the worker owning it (see app.services.cluster.call_room).
+# Everything the players get is sent from here through the channel layer.
+
+async def send_data(channel_layer, channel_name, data, version=None):
+    await channel_layer.send(channel_name, {'type': 'send_data', 'data': data, 'version': version})
+    count_channel_sends()
+
+
+async def broadcast_server_state(channel_layer, room_name, snapshot):
+    await channel_layer.group_send(
+        get_room_group_name(room_name),
+        {
+            'type': 'send_data',
+            'data': snapshot.to_server_state_message(),
+            'version': snapshot.version,
+        },
+    )
+    count_channel_sends()
+    publish_to_spectators(room_name, snapshot)
+
+
+async def publish_events(game_id, room_name, old_state, new_state, events):
+    # All the messages of the action are sent as one envelope per visitor.
+    # Game state and hands are sent as deltas to the previous version.
+    old_snapshot = GameSnapshot.from_game_state(game_id, room_name, old_state)
+    snapshot = GameSnapshot.from_game_state(game_id, room_name, new_state)
+    outbox = Outbox()
+    for event in events:
+        if event['type'] == Events.SERVER_STATE:
+            outbox.add_public(snapshot.to_server_state_message())
+        elif event['type'] == Events.GAME_STATE:
+            outbox.add_public(make_game_delta(old_snapshot, snapshot))
+        elif event['type'] == Events.HANDS:
+            for player, hand in new_state.hands.items():
+                hand_delta = make_hand_delta(new_state.version, old_state.hands.get(player, Hand()), hand)
+                if hand_delta and player in new_state.channels:
+                    outbox.add_private(new_state.channels[player], hand_delta)
+        elif event['type'] == Events.INFO:
+            outbox.add_public({'action': 'info', 'message': event['message']}, coalesce=False)
+    # Cards the players may play now - sent only when the set has changed
+    for player in set(old_state.participants) | set(new_state.participants):
+        if player not in new_state.channels:
+            continue
+        old_moves = make_legal_moves_message(old_state, player)
+        new_moves = make_legal_moves_message(new_state, player)
+        if new_moves['cards'] != old_moves['cards']:
+            outbox.add_private(new_state.channels[player], new_moves)
+    recipients = {new_state.channels[player]: new_state.codecs[player] for player in new_state.channels}
+    await outbox.flush(get_channel_layer(), recipients, new_state.version)
+    publish_to_spectators(room_name, snapshot)
+
+
+def make_full_state_outbox(game_id, room_name, game_state, channel_name, player_id):
+    # Full snapshot - on join, on resync and for a client behind (see OutboundQueue)
+    snapshot = GameSnapshot.from_game_state(game_id, room_name, game_state)
+    outbox = Outbox()
+    outbox.add_public(snapshot.to_server_state_message())
+    outbox.add_public(snapshot.to_game_state_message())
+    cards = game_state.hands.get(player_id, Hand()).to_dicts()
+    outbox.add_private(channel_name, {'action': 'hand', 'version': game_state.version, 'cards': cards})
+    if player_id in game_state.participants:
+        outbox.add_private(channel_name, make_legal_moves_message(game_state, player_id))
+    return outbox
+
+
+@room_op
+async def authenticate(game_id, room_name, channel_name, codec, user_id, username):
+    """
+    Returns the player id, None if the user is connected elsewhere.
+    """
+    user = User(id=user_id, username=username)
+    player_id, game_state = await authenticate_player(game_id, channel_name, codec, user)
+    if game_state is None:
+        return None
+    channel_layer = get_channel_layer()
+    await send_data(channel_layer, channel_name, {'action': 'authenticated'})
+    await broadcast_server_state(channel_layer, room_name, GameSnapshot.from_game_state(game_id, room_name, game_state))
+    outbox = make_full_state_outbox(game_id, room_name, game_state, channel_name, player_id)
+    await outbox.flush(channel_layer, {channel_name: codec}, game_state.version)
+    return player_id
+
+
+@room_op
+async def apply(game_id, room_name, action):
+    old_state, new_state, events = await apply_game_action(game_id, action)
+    # Published before the next action of the room - deltas go out in the version order
+    await publish_events(game_id, room_name, old_state, new_state, events)
+
+
+@room_op
+async def disconnect(game_id, room_name, player_id):
+    """
+    Returns True if the player is held to reconnect (see app.services.sessions).
+    """
+    result = await disconnect_player(game_id, player_id)
+    if result:
+        await publish_events(game_id, room_name, *result)
+        return False
+    return player_id is not None
+
+
+@room_op
+async def forfeit(game_id, room_name, player_id):
+    result = await forfeit_player(game_id, player_id)
+    if result:
+        await publish_events(game_id, room_name, *result)
+
+
+@room_op
+async def full_state(game_id, room_name, channel_name, codec, player_id):
+    """
+    Returns the encoded full state frame for the connection and its version.
+    """
+    game_state = await get_game_state(game_id)
+    outbox = make_full_state_outbox(game_id, room_name, game_state, channel_name, player_id)
+    return [outbox.build_envelopes({channel_name: codec})[channel_name], game_state.version]
+
+
+@room_op
+async def watch(room_name, channel_name, codec):
+    """
+    Returns the first frame of the spectator, the updates come to its group (see SpectatorStream).
+    """
+    add_spectator(get_channel_layer(), room_name, codec, channel_name)
+    game_id, game_state = await get_room_game_state(room_name)
+    return make_spectator_frame(GameSnapshot.from_game_state(game_id, room_name, game_state), get_codec(codec))
+
+
+@room_op
+async def unwatch(room_name, channel_name, codec):
+    remove_spectator(room_name, codec, channel_name)
+
+
+@room_op
+async def join_queue(room_name, channel_name, user_id, rating, size, waited=0):
+    """
+    Returns False if the user waits in the queue already.
+    waited - seconds in the queue of the previous owner (see Matchmaker.close).
+    """
+    return matchmaker.join(Ticket(channel_name, user_id, rating, size, queued_at=time.monotonic() - waited))
+
+
+@room_op
+async def leave_queue(room_name, channel_name):
+    matchmaker.leave(channel_name)
+
+
+@on_hand_off
+async def release_room(room_name):
+    # The next owner loads the game from the DB
+    await release_live_room(room_name)
+    # Spectators and the matchmaking queue register again with the next owner
+    channel_layer = get_channel_layer()
+    for codec_name in release_spectators(room_name):
+        await channel_layer.group_send(get_spectators_group_name(room_name, codec_name), {'type': 'room_moved'})
+    if room_name == MATCHMAKING_ROOM:
+        await matchmaker.close()
@@ -0,0 +1,184 @@
+import asyncio
+import bisect
+import contextvars
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from app.services.metrics import add_queue_wait
+
+
+def get_room_group_name(room_name):
+    return f'room_{room_name}'
+
+
+def get_ring_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of the rooms onto the workers: every worker has `replicas` points on the ring,
+    a room goes to the worker of the first point after the hash of its name.
+    When a worker joins or leaves, only the rooms of its arcs change the worker.
+    """
+    def __init__(self, workers, replicas=64):
+        self.workers = sorted(set(workers))
+        points = sorted((get_ring_hash(f'{worker}#{idx}'), worker) for worker in self.workers for idx in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.points = [worker for _, worker in points]
+
+    def get_worker(self, key):
+        if not self.points:
+            return None
+        return self.points[bisect.bisect(self.hashes, get_ring_hash(key)) % len(self.points)]
+
+
+class RoomRegistry:
+    """
+    Places rooms on worker processes.
+    The live workers are in Redis: every worker refreshes its entry (see WorkerNode), so a dead one drops out
+    after WORKER_TTL_SECONDS; settings.GAME_WORKERS is used until any worker has registered.
+    A room is placed on the worker the hash ring of the live workers picks. Placement is stored in the shared cache,
+    so every worker sees the same picture and a room stays on its worker until it is handed off
+    (see WorkerNode.hand_off), released or its worker is gone.
+    """
+    key_prefix = 'room_worker'
+    workers_key = 'room_workers'
+
+    def __init__(self, workers=None):
+        # Static workers - no registry of the live ones (e.g. tests)
+        self.static_workers = workers
+        self._redis = None
+        self.ring = None
+        self.ring_loaded_at = 0
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = get_redis_connection()
+        return self._redis
+
+    def get_key(self, room_name):
+        return f'{self.key_prefix}:{room_name}'
+
+    def set_workers(self, workers):
+        """
+        Returns True if the ring has changed.
+        """
+        ring = HashRing(workers or self.static_workers or settings.GAME_WORKERS)
+        changed = self.ring is not None and ring.workers != self.ring.workers
+        self.ring = ring
+        self.ring_loaded_at = time.monotonic()
+        return changed
+
+    def heartbeat(self, worker):
+        # Registers the worker (again) and loads the live ones, one round trip
+        if self.static_workers:
+            return self.load_workers()
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.workers_key, {worker: now + settings.WORKER_TTL_SECONDS})
+        pipe.zremrangebyscore(self.workers_key, '-inf', now)
+        pipe.zrange(self.workers_key, 0, -1)
+        workers = pipe.execute()[-1]
+        return self.set_workers([worker.decode() for worker in workers])
+
+    def leave(self, worker):
+        self.redis.zrem(self.workers_key, worker)
+        self.load_workers()
+
+    def load_workers(self):
+        if self.static_workers:
+            return self.set_workers(self.static_workers)
+        workers = self.redis.zrangebyscore(self.workers_key, time.time(), '+inf')
+        return self.set_workers([worker.decode() for worker in workers])
+
+    def get_ring(self):
+        # Kept fresh by the heartbeat in the workers, loaded when needed elsewhere (views, commands)
+        if self.ring is None or time.monotonic() - self.ring_loaded_at > settings.WORKER_TTL_SECONDS / 3:
+            self.load_workers()
+        return self.ring
+
+    def choose_worker(self, room_name):
+        return self.get_ring().get_worker(room_name)
+
+    def place_room(self, room_name, worker=None):
+        worker = worker or self.choose_worker(room_name)
+        # Only the first placement wins
+        cache.add(self.get_key(room_name), worker, timeout=None)
+        return cache.get(self.get_key(room_name))
+
+    def move_room(self, room_name, worker):
+        cache.set(self.get_key(room_name), worker, timeout=None)
+
+    def get_room_worker(self, room_name):
+        worker = cache.get(self.get_key(room_name))
+        if worker is not None and worker in self.get_ring().workers:
+            return worker
+        if worker is not None:
+            # Its worker is gone - the room goes to the ring (the game is recovered from its backup)
+            cache.delete(self.get_key(room_name))
+        return self.place_room(room_name)
+
+    def get_rooms_workers(self, room_names):
+        keys = {self.get_key(room_name): room_name for room_name in room_names}
+        placed = cache.get_many(list(keys))
+        return {room_name: placed.get(key) for key, room_name in keys.items()}
+
+    def release_room(self, room_name):
+        cache.delete(self.get_key(room_name))
+
+
+room_registry = RoomRegistry()
+
+
+class RoomActor:
+    """
+    Single writer of a room: the actions of the room are applied one by one
+    in the order they came, by one task of the worker the room is placed on.
+    The task stops when the queue is empty and is started again by the next action.
+    """
+    def __init__(self, room_name):
+        self.room_name = room_name
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def submit(self, func, *args):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((func, args, future, contextvars.copy_context(), time.perf_counter()))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return future
+
+    async def run(self):
+        while not self.queue.empty():
+            func, args, future, context, submitted_at = self.queue.get_nowait()
+            context.run(add_queue_wait, time.perf_counter() - submitted_at)
+            try:
+                # Run in the context of the submitter (e.g. its action metrics)
+                result = await context.run(asyncio.create_task, func(*args))
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+        # No await between the check of the queue and here - nothing can be lost
+        room_actors.pop(self.room_name, None)
+
+
+room_actors = {}
+
+
+async def run_in_room(room_name, func, *args):
+    """
+    Run func(*args) in the room actor and wait for the result (or the exception).
+    """
+    actor = room_actors.get(room_name)
+    if actor is None:
+        actor = room_actors[room_name] = RoomActor(room_name)
+    return await actor.submit(func, *args)
@@ -0,0 +1,120 @@
+from app.models import Card, Game
+from app.services.cards import Hand
+from app.services.helpers import GameError
+
+
+CARDS_IN_HAND = 6
+# Not more than 6 attack cards in one turn
+MAX_ATTACKS = CARDS_IN_HAND
+
+ALL_CODES = [Card(rank, suit).code for rank in range(2, 15) for suit in Card.SUITS_ORDER]
+
+
+def get_beats_mask(code, trump_idx):
+    rank, suit_idx = divmod(code, 4)
+    mask = 0
+    for other in ALL_CODES:
+        other_rank, other_suit_idx = divmod(other, 4)
+        if other_suit_idx == suit_idx and other_rank > rank:
+            mask |= 1 << other
+        elif other_suit_idx == trump_idx and suit_idx != trump_idx:
+            mask |= 1 << other
+    return mask
+
+
+# BEATS[trump index][card code] - bitset of the cards which beat the card
+BEATS = [
+    [get_beats_mask(code, trump_idx) if code in ALL_CODES else 0 for code in range(max(ALL_CODES) + 1)]
+    for trump_idx in range(len(Card.SUITS_ORDER))
+]
+
+# RANKS[rank] - bitset of all the cards of the rank
+RANKS = {
+    rank: Hand.get_mask(rank * 4 + suit_idx for suit_idx in range(len(Card.SUITS_ORDER)))
+    for rank in range(2, 15)
+}
+
+
+def get_trump_idx(state):
+    return Card.SUITS_ORDER.index(state.trump)
+
+
+def get_uncovered_count(state):
+    # Table: covered pairs (attack, defense) first, then not covered attack cards
+    return len(state.table) - 2 * state.covered
+
+
+def get_attack_count(state):
+    return len(state.table) - state.covered
+
+
+def get_table_ranks_mask(state):
+    mask = 0
+    for code in state.table:
+        mask |= RANKS[code // 4]
+    return mask
+
+
+def can_add_attack(state, defender):
+    # Defender must be able to cover all the attack cards
+    return (
+        get_attack_count(state) < MAX_ATTACKS
+        and get_uncovered_count(state) < len(state.hands[defender])
+    )
+
+
+def get_legal_mask(state, player, defender):
+    hand = state.hands[player]
+    if state.phase == Game.Phases.DEFENSE:
+        attack_card = state.table[-1]
+        return hand.bits & BEATS[get_trump_idx(state)][attack_card]
+    if not can_add_attack(state, defender):
+        return 0
+    # First card of the turn - any card, then only the ranks on the table
+    if not state.table:
+        return hand.bits
+    return hand.bits & get_table_ranks_mask(state)
+
+
+def legal_moves(state, player):
+    """
+    Generate codes of the cards the player may play now.
+    """
+    if (
+        state.state != Game.States.GAME
+        or player not in state.active_players
+        or Game.Actions.PLAY not in state.allowed_actions
+    ):
+        return
+    defender = get_defender(state)
+    yield from Hand(get_legal_mask(state, player, defender))
+
+
+def make_legal_moves_message(state, player):
+    cards = [Card.from_code(code).to_dict() for code in legal_moves(state, player)]
+    return {'action': 'legal_moves', 'version': state.version, 'cards': cards}
+
+
+def check_move(state, player, card_code):
+    defender = get_defender(state)
+    if get_legal_mask(state, player, defender) >> card_code & 1:
+        return
+    card = Card.from_code(card_code)
+    if state.phase == Game.Phases.DEFENSE:
+        raise GameError(f'{card} does not beat {Card.from_code(state.table[-1])}')
+    if not can_add_attack(state, defender):
+        raise GameError('No more cards can be added to the table')
+    raise GameError(f'Only cards of the ranks on the table can be added: {card}')
+
+
+def check_stop_attack(state, defender):
+    # After attack the defender has to answer
+    if state.phase == Game.Phases.ATTACK:
+        return False
+    return not can_add_attack(state, defender)
+
+
+def get_defender(state):
+    participants = state.participants
+    idx = participants.index(state.current_player)
+    return participants[(idx + 1) % len(participants)]
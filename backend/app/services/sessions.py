@@ -0,0 +1,26 @@
+import asyncio
+
+from django.conf import settings
+
+
+# player id: task forfeiting the game if the player does not reconnect in time
+forfeit_timers = {}
+
+
+def schedule_forfeit(player_id, callback, delay=None):
+    cancel_forfeit(player_id)
+    delay = settings.RECONNECT_GRACE_SECONDS if delay is None else delay
+
+    async def wait_and_forfeit():
+        await asyncio.sleep(delay)
+        # Not cancelled by a reconnect from now on
+        forfeit_timers.pop(player_id, None)
+        await callback()
+
+    forfeit_timers[player_id] = asyncio.create_task(wait_and_forfeit())
+
+
+def cancel_forfeit(player_id):
+    timer = forfeit_timers.pop(player_id, None)
+    if timer:
+        timer.cancel()
@@ -0,0 +1,65 @@
+from dataclasses import dataclass
+
+from app.services.cards import cards_to_dicts
+
+
+@dataclass(frozen=True)
+class GameSnapshot:
+    """
+    Read-only view of a game with everything the broadcasts need.
+    Players are represented by their user names.
+    """
+    game_id: int
+    room_name: str
+    version: int
+    state: str
+    phase: str
+    current_player: str
+    active_players: tuple
+    allowed_actions: tuple
+    table: tuple
+    trump: str
+    visitors: tuple
+    participants: tuple
+
+    @classmethod
+    def from_game_state(cls, game_id, room_name, game_state):
+        def get_names(players):
+            return tuple(game_state.names.get(player, '???') for player in players)
+
+        current_player = game_state.current_player
+        return cls(
+            game_id=game_id,
+            room_name=room_name,
+            version=game_state.version,
+            state=game_state.state,
+            phase=game_state.phase,
+            current_player=game_state.names.get(current_player, '???') if current_player else None,
+            active_players=get_names(game_state.active_players),
+            allowed_actions=tuple(game_state.allowed_actions),
+            table=tuple(cards_to_dicts(game_state.table)),
+            trump=game_state.trump,
+            visitors=get_names(game_state.visitors),
+            participants=get_names(game_state.participants),
+        )
+
+    def to_game_state_message(self):
+        return {
+            'action': 'game_state',
+            'version': self.version,
+            'current_player': self.current_player,
+            'phase': self.phase,
+            'active_players': list(self.active_players),
+            'allowed_actions': list(self.allowed_actions),
+            'table': list(self.table),
+            'trump': self.trump,
+        }
+
+    def to_server_state_message(self):
+        return {
+            'action': 'server_state',
+            'version': self.version,
+            'state': self.state,
+            'visitors': list(self.visitors),
+            'participants': list(self.participants),
+        }
@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+from django.conf import settings
+
+from app.services.codec import get_codec
+from app.services.metrics import count_channel_sends
+
+
+def get_spectators_group_name(room_name, codec_name):
+    return f'spectators_{room_name}_{codec_name}'
+
+
+def make_spectator_frame(snapshot, codec):
+    # Public state only, nothing private ever goes to the spectators
+    parts = [codec.encode(snapshot.to_server_state_message()), codec.encode(snapshot.to_game_state_message())]
+    return codec.make_batch(parts)
+
+
+class SpectatorStream:
+    """
+    Public state of a room for its spectators: sent at most SPECTATOR_UPDATES_PER_SECOND times a second,
+    the updates in between are coalesced (only the latest snapshot is sent).
+    Every update is serialized once per codec and sent to the group of the codec.
+    """
+    def __init__(self, channel_layer, room_name):
+        self.channel_layer = channel_layer
+        self.room_name = room_name
+        # codec name -> channels of the spectators, on any worker (see SpectatorConsumer)
+        self.spectators = {}
+        self.latest = None
+        self.sent_at = 0
+        self.flush_task = None
+
+    def publish(self, snapshot):
+        self.latest = snapshot
+        if self.flush_task:
+            return
+        interval = 1 / settings.SPECTATOR_UPDATES_PER_SECOND
+        delay = max(0, self.sent_at + interval - time.monotonic())
+        self.flush_task = asyncio.create_task(self.flush_later(delay))
+
+    async def flush_later(self, delay):
+        await asyncio.sleep(delay)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        snapshot, self.latest = self.latest, None
+        self.sent_at = time.monotonic()
+        for codec_name in list(self.spectators):
+            codec = get_codec(codec_name)
+            await self.channel_layer.group_send(
+                get_spectators_group_name(self.room_name, codec.name),
+                {
+                    'type': 'send_message_to_group',
+                    'message': make_spectator_frame(snapshot, codec),
+                },
+            )
+            count_channel_sends()
+
+    def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+
+
+# room name -> stream, only for the watched rooms owned by this worker
+spectator_streams = {}
+
+
+def add_spectator(channel_layer, room_name, codec_name, channel_name):
+    stream = spectator_streams.get(room_name)
+    if stream is None:
+        stream = spectator_streams[room_name] = SpectatorStream(channel_layer, room_name)
+    stream.spectators.setdefault(codec_name, set()).add(channel_name)
+
+
+def remove_spectator(room_name, codec_name, channel_name):
+    stream = spectator_streams.get(room_name)
+    if stream is None or channel_name not in stream.spectators.get(codec_name, ()):
+        return
+    stream.spectators[codec_name].discard(channel_name)
+    if not stream.spectators[codec_name]:
+        del stream.spectators[codec_name]
+    if not stream.spectators:
+        stream.close()
+        del spectator_streams[room_name]
+
+
+def release_spectators(room_name):
+    """
+    The room is handed off to another worker. Returns the codec names of its spectators - they watch it there.
+    """
+    stream = spectator_streams.pop(room_name, None)
+    if stream is None:
+        return []
+    stream.close()
+    return list(stream.spectators)
+
+
+def publish_to_spectators(room_name, snapshot):
+    # Nothing to do for a room nobody watches
+    stream = spectator_streams.get(room_name)
+    if stream:
+        stream.publish(snapshot)
@@ -0,0 +1,26 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from app.models import Game
+from app.services.auth import token_user_cache
+from app.services.rooms import get_room_group_name
+
+
+@receiver(post_delete, sender=Game)
+def invalidate_room_cache(sender, instance, **kwargs):
+    # Consumers of the room drop their cached game / player ids
+    async_to_sync(get_channel_layer().group_send)(
+        get_room_group_name(instance.name),
+        {'type': 'invalidate_cache'},
+    )
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_token_cache(sender, instance, **kwargs):
+    # Logout, token rotation or a deleted user - after the commit, so the cache is not filled again from the DB
+    token_key = instance.key
+    transaction.on_commit(lambda: token_user_cache.invalidate(token_key))
@@ -1,3 +1,370 @@
-from django.test import TestCase
+import asyncio
+import json
 
-# Create your tests here.
+import msgpack
+from django.contrib.auth.models import User
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from app.models import Card, Game, GameEvent
+from app.services.cards import Hand
+from app.services.codec import get_codec, negotiate_codec
+from app.services.db_service import add_visitor_to_game, get_or_create_game, get_or_create_player, load_game_state
+from app.services.engine import Events, GameEngine, GameState
+from app.services.game_service import apply_action
+from app.services.helpers import GameError
+from app.services.inbound import InboundError, TokenBucket, validate_message
+from app.services.journal import state_to_dict
+from app.services.live_games import live_games
+from app.services.matchmaking import MatchmakingQueue, Ticket
+from app.services.rooms import HashRing
+from app.services.rules import legal_moves
+
+
+class WriteBehindConflictTests(TestCase):
+    def setUp(self):
+        self.game_ids = []
+        self.game_id = self.create_game('conflict')
+        # The actions are kept in memory until the flush, as on a worker running the flusher
+        live_games.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        live_games.loop.close()
+        live_games.loop = None
+        for game_id in self.game_ids:
+            live_games.games.pop(game_id, None)
+            live_games.dirty.discard(game_id)
+            live_games.redis.delete(live_games.get_state_key(game_id), live_games.get_entries_key(game_id))
+
+    def create_game(self, room_name):
+        game_id = get_or_create_game(room_name).id
+        for name in ('alice', 'bob'):
+            player = get_or_create_player(User.objects.create_user(f'{name}-{room_name}'))
+            add_visitor_to_game(game_id, player.id)
+        self.game_ids.append(game_id)
+        return game_id
+
+    def test_acknowledged_actions_survive_a_conflicting_write(self):
+        apply_action(self.game_id, {'action': 'start'})
+        state = live_games.get(self.game_id).state
+        card = Card.from_code(next(legal_moves(state, state.current_player))).to_dict()
+        _, acknowledged, _ = apply_action(self.game_id, {'action': 'play', 'player': state.current_player, 'card': card})
+        self.assertEqual(Game.objects.get(id=self.game_id).version, 0)
+
+        # Another writer gets there before the flush
+        Game.objects.filter(id=self.game_id).update(version=F('version') + 1)
+        live_games.flush()
+
+        expected = {**state_to_dict(acknowledged), 'version': acknowledged.version + 1}
+        self.assertEqual(state_to_dict(live_games.get(self.game_id).state), expected)
+        # Rebased on the other write, written by the next flush
+        self.assertIn(self.game_id, live_games.dirty)
+        live_games.flush()
+        self.assertEqual(state_to_dict(load_game_state(Game.objects.get(id=self.game_id))), expected)
+        events = GameEvent.objects.filter(game_id=self.game_id).order_by('version')
+        self.assertEqual(list(events.values_list('version', 'action__action')), [(2, 'start'), (3, 'play')])
+        self.assertFalse(live_games.redis.exists(live_games.get_state_key(self.game_id)))
+
+    def test_deleted_game_does_not_stop_the_flush(self):
+        other_id = self.create_game('other')
+        apply_action(self.game_id, {'action': 'start'})
+        _, acknowledged, _ = apply_action(other_id, {'action': 'start'})
+
+        Game.objects.filter(id=self.game_id).delete()
+        Game.objects.filter(id=other_id).update(version=F('version') + 1)
+        live_games.flush()
+
+        self.assertNotIn(self.game_id, live_games.games)
+        self.assertFalse(live_games.redis.exists(live_games.get_state_key(self.game_id)))
+        # The other game is rebased as usual
+        self.assertIn(other_id, live_games.dirty)
+        live_games.flush()
+        game = Game.objects.get(id=other_id)
+        self.assertEqual(game.version, acknowledged.version + 1)
+        self.assertEqual(game.state, Game.States.GAME)
+
+
+def card(name):
+    # '7H' -> card dict
+    return Card(int(name[:-1]), name[-1]).to_dict()
+
+
+def codes(*names):
+    return [Card(int(name[:-1]), name[-1]).code for name in names]
+
+
+def make_state(hands, table=(), covered=0, phase=Game.Phases.ATTACK, active_players=(1,), allowed_actions=None):
+    # Two players, alice (1) attacks bob (2), the deck is empty
+    return GameState(
+        state=Game.States.GAME,
+        visitors=[1, 2],
+        participants=[1, 2],
+        current_player=1,
+        phase=phase,
+        active_players=list(active_players),
+        allowed_actions=allowed_actions or [Game.Actions.PLAY],
+        table=bytearray(codes(*table)),
+        covered=covered,
+        trump=Card.SUITS.SPADES,
+        hands={player: Hand.from_codes(codes(*names)) for player, names in hands.items()},
+        names={1: 'alice', 2: 'bob'},
+    )
+
+
+class GameEngineTests(SimpleTestCase):
+    def test_attack_with_any_card_first_then_the_ranks_on_the_table(self):
+        state = make_state({1: ['7H', '9C', '12D'], 2: ['8H', '10S']})
+        self.assertEqual(sorted(legal_moves(state, 1)), sorted(codes('7H', '9C', '12D')))
+
+        state, _ = GameEngine(state).apply({'action': 'play', 'player': 1, 'card': card('7H')})
+        self.assertEqual(state.phase, Game.Phases.DEFENSE)
+        self.assertEqual(state.active_players, [2])
+        self.assertEqual(list(state.table), codes('7H'))
+        self.assertNotIn(codes('7H')[0], state.hands[1])
+
+        state, _ = GameEngine(state).apply({'action': 'play', 'player': 2, 'card': card('8H')})
+        self.assertEqual(state.phase, Game.Phases.ATTACK)
+        self.assertEqual(state.covered, 1)
+        # 7 and 8 are on the table
+        self.assertEqual(list(legal_moves(state, 1)), [])
+        with self.assertRaisesMessage(GameError, 'Only cards of the ranks on the table can be added'):
+            GameEngine(state).apply({'action': 'play', 'player': 1, 'card': card('9C')})
+
+    def test_attack_with_a_rank_on_the_table(self):
+        state = make_state(
+            {1: ['9C', '8D'], 2: ['10S', '6H']}, table=['8H', '9H'], covered=1,
+            allowed_actions=[Game.Actions.PLAY, Game.Actions.PASS],
+        )
+        self.assertEqual(sorted(legal_moves(state, 1)), sorted(codes('9C', '8D')))
+        state, _ = GameEngine(state).apply({'action': 'play', 'player': 1, 'card': card('9C')})
+        self.assertEqual(list(state.table), codes('8H', '9H', '9C'))
+        self.assertEqual(state.phase, Game.Phases.DEFENSE)
+
+    def test_defense(self):
+        state = make_state(
+            {1: ['12D'], 2: ['7H', '9H', '14D', '6S']}, table=['8H'], phase=Game.Phases.DEFENSE,
+            active_players=[2], allowed_actions=[Game.Actions.PLAY, Game.Actions.TAKE],
+        )
+        # A higher card of the suit or any trump
+        self.assertEqual(sorted(legal_moves(state, 2)), sorted(codes('9H', '6S')))
+        with self.assertRaisesMessage(GameError, '7♥ does not beat 8♥'):
+            GameEngine(state).apply({'action': 'play', 'player': 2, 'card': card('7H')})
+        with self.assertRaisesMessage(GameError, 'does not beat'):
+            GameEngine(state).apply({'action': 'play', 'player': 2, 'card': card('14D')})
+
+        new_state, _ = GameEngine(state).apply({'action': 'play', 'player': 2, 'card': card('6S')})
+        self.assertEqual(list(new_state.table), codes('8H', '6S'))
+        self.assertEqual(new_state.covered, 1)
+        self.assertEqual(new_state.active_players, [1])
+        self.assertEqual(new_state.allowed_actions, [Game.Actions.PLAY, Game.Actions.PASS])
+
+    def test_higher_trump_beats_trump(self):
+        state = make_state(
+            {1: ['12D'], 2: ['7S', '9S']}, table=['8S'], phase=Game.Phases.DEFENSE, active_players=[2],
+        )
+        self.assertEqual(list(legal_moves(state, 2)), codes('9S'))
+
+    def test_refused_action_leaves_the_state(self):
+        state = make_state({1: ['7H'], 2: ['8H']})
+        with self.assertRaisesMessage(GameError, 'Please wait for your turn'):
+            GameEngine(state).apply({'action': 'play', 'player': 2, 'card': card('8H')})
+        with self.assertRaisesMessage(GameError, 'You have no such card in your hand'):
+            GameEngine(state).apply({'action': 'play', 'player': 1, 'card': card('8H')})
+        self.assertEqual(state.version, 0)
+        self.assertEqual(list(state.hands[1]), codes('7H'))
+        self.assertEqual(state.table, bytearray())
+
+    def test_attacks_are_limited_by_the_defender_hand(self):
+        # bob takes, alice adds cards until bob could not cover one more
+        state = make_state(
+            {1: ['7D', '7C', '7S'], 2: ['6H', '8C']}, table=['7H'], phase=Game.Phases.ADDITION,
+            allowed_actions=[Game.Actions.PLAY, Game.Actions.PASS],
+        )
+        state, _ = GameEngine(state).apply({'action': 'play', 'player': 1, 'card': card('7D')})
+        # Two attack cards on the table for the two cards in bob's hand - bob takes them at once
+        self.assertEqual(state.table, bytearray())
+        self.assertEqual(sorted(state.hands[2]), sorted(codes('6H', '8C', '7H', '7D')))
+        self.assertEqual(state.current_player, 1)
+        self.assertEqual(state.phase, Game.Phases.ATTACK)
+
+        state = make_state(
+            {1: ['7D'], 2: ['6H']}, table=['7H'], phase=Game.Phases.ADDITION,
+            allowed_actions=[Game.Actions.PLAY, Game.Actions.PASS],
+        )
+        self.assertEqual(list(legal_moves(state, 1)), [])
+        with self.assertRaisesMessage(GameError, 'No more cards can be added to the table'):
+            GameEngine(state).apply({'action': 'play', 'player': 1, 'card': card('7D')})
+
+    def test_attacks_are_limited_to_a_hand(self):
+        table = ['6H', '8H', '6D', '9D', '6C', '10C', '7H', '11H', '7D', '12D', '7C', '13C']
+        state = make_state(
+            {1: ['7S'], 2: ['14S', '13S']}, table=table, covered=6,
+            allowed_actions=[Game.Actions.PLAY, Game.Actions.PASS],
+        )
+        with self.assertRaisesMessage(GameError, 'No more cards can be added to the table'):
+            GameEngine(state).apply({'action': 'play', 'player': 1, 'card': card('7S')})
+
+    def test_the_last_player_with_cards_loses(self):
+        state = make_state(
+            {1: [], 2: ['13D', '8H']}, table=['12D'], phase=Game.Phases.DEFENSE, active_players=[2],
+        )
+        state, events = GameEngine(state).apply({'action': 'play', 'player': 2, 'card': card('13D')})
+        self.assertEqual(state.state, Game.States.GAME)
+        self.assertNotIn(Events.INFO, [event['type'] for event in events])
+
+        state, events = GameEngine(state).apply({'action': 'pass', 'player': 1})
+        self.assertIn({'type': Events.INFO, 'message': 'End of game. bob lost'}, events)
+        self.assertEqual(state.state, Game.States.NOT_STARTED)
+        self.assertEqual(state.participants, [])
+        self.assertEqual(state.table, bytearray())
+        self.assertFalse(state.hands[2])
+
+    def test_draw_when_nobody_has_cards(self):
+        state = make_state({1: [], 2: ['13D']}, table=['12D'], phase=Game.Phases.DEFENSE, active_players=[2])
+        state, events = GameEngine(state).apply({'action': 'play', 'player': 2, 'card': card('13D')})
+        self.assertIn({'type': Events.INFO, 'message': 'End of game. Draw'}, events)
+        self.assertEqual(state.state, Game.States.NOT_STARTED)
+
+    def test_hands_are_replenished_from_the_deck(self):
+        state = make_state({1: [], 2: ['13D']}, table=['12D'], phase=Game.Phases.DEFENSE, active_players=[2])
+        state.deck = bytearray(codes('6H', '7H', '8H', '9H', '10H', '11H', '12H', '13H'))
+        state, events = GameEngine(state).apply({'action': 'play', 'player': 2, 'card': card('13D')})
+        self.assertEqual(state.state, Game.States.GAME)
+        self.assertNotIn(Events.INFO, [event['type'] for event in events])
+        # The attacker draws first, bob beat the attack and attacks next
+        self.assertEqual(sorted(state.hands[1]), sorted(codes('8H', '9H', '10H', '11H', '12H', '13H')))
+        self.assertEqual(sorted(state.hands[2]), sorted(codes('6H', '7H')))
+        self.assertEqual(state.deck, bytearray())
+        self.assertEqual(state.current_player, 2)
+        self.assertEqual(state.active_players, [2])
+
+
+class HashRingTests(SimpleTestCase):
+    rooms = [f'room-{idx}' for idx in range(2000)]
+
+    def place(self, ring):
+        return {room: ring.get_worker(room) for room in self.rooms}
+
+    def test_rooms_are_spread_over_the_workers(self):
+        placement = self.place(HashRing(['w1', 'w2', 'w3']))
+        for worker in ('w1', 'w2', 'w3'):
+            self.assertGreater(list(placement.values()).count(worker), len(self.rooms) / 6)
+        self.assertIsNone(HashRing([]).get_worker('room-0'))
+
+    def test_joining_worker_takes_rooms_from_the_others_only(self):
+        before = self.place(HashRing(['w1', 'w2', 'w3']))
+        after = self.place(HashRing(['w1', 'w2', 'w3', 'w4']))
+        moved = [room for room in self.rooms if before[room] != after[room]]
+        self.assertTrue(all(after[room] == 'w4' for room in moved))
+        self.assertLess(len(moved), len(self.rooms) / 2)
+        self.assertEqual(len(moved), list(after.values()).count('w4'))
+
+    def test_rooms_of_a_leaving_worker_only_are_moved(self):
+        before = self.place(HashRing(['w1', 'w2', 'w3']))
+        after = self.place(HashRing(['w1', 'w3']))
+        for room in self.rooms:
+            if before[room] == 'w2':
+                self.assertIn(after[room], ('w1', 'w3'))
+            else:
+                self.assertEqual(after[room], before[room])
+
+    def test_placement_does_not_depend_on_the_order_of_workers(self):
+        self.assertEqual(self.place(HashRing(['w1', 'w2', 'w3'])), self.place(HashRing(['w3', 'w1', 'w2', 'w1'])))
+
+
+class CodecTests(SimpleTestCase):
+    message = {'action': 'hand', 'version': 3, 'cards': [card('7H'), card('14S')]}
+
+    def test_json(self):
+        codec = get_codec('json')
+        self.assertEqual(codec.decode(codec.encode(self.message)), self.message)
+        batch = codec.make_batch([codec.encode(self.message), codec.encode({'action': 'info'})])
+        self.assertEqual(json.loads(batch), {'action': 'batch', 'messages': [self.message, {'action': 'info'}]})
+
+    def test_msgpack_cards_are_codes(self):
+        codec = negotiate_codec(['other', 'durak.msgpack'])
+        self.assertEqual(codec.name, 'msgpack')
+        encoded = {'action': 'hand', 'version': 3, 'cards': codes('7H', '14S')}
+        self.assertEqual(msgpack.unpackb(codec.encode(self.message)), encoded)
+        batch = codec.make_batch([codec.encode(self.message)] * 20)
+        self.assertEqual(msgpack.unpackb(batch), {'action': 'batch', 'messages': [encoded] * 20})
+
+        play = codec.decode(bytes_data=msgpack.packb({'action': 'play', 'card': codes('7H')[0]}))
+        self.assertEqual(play, {'action': 'play', 'card': card('7H')})
+        # Not a card - left for the validation to refuse
+        self.assertEqual(codec.decode(bytes_data=msgpack.packb({'action': 'play', 'card': 255}))['card'], 255)
+
+    def test_json_is_the_fallback(self):
+        self.assertEqual(negotiate_codec([]).name, 'json')
+        self.assertEqual(get_codec('unknown').name, 'json')
+
+
+class InboundValidationTests(SimpleTestCase):
+    actions = ['play', 'ack', 'resync']
+
+    def assertRefused(self, data, reason, message):
+        with self.assertRaisesMessage(InboundError, message) as context:
+            validate_message(data, self.actions)
+        self.assertEqual(context.exception.reason, reason)
+
+    def test_known_fields_are_kept(self):
+        data = {'action': 'play', 'card': card('7H'), 'player': 2, 'extra': 'x' * 100}
+        self.assertEqual(validate_message(data, self.actions), {'action': 'play', 'card': card('7H')})
+        ack = {'action': 'ack', 'version': 5}
+        self.assertEqual(validate_message(ack, self.actions), ack)
+
+    def test_bad_messages(self):
+        self.assertRefused(['play'], 'schema', 'not an object')
+        self.assertRefused({'card': card('7H')}, 'schema', 'no "action" field')
+        self.assertRefused({'action': 'start'}, 'action', 'unknown action: start')
+        self.assertRefused({'action': ['play']}, 'action', 'unknown action')
+        self.assertRefused({'action': 'play', 'card': {'rank': 15, 'suit': 'H'}}, 'schema', 'invalid "card" field')
+        self.assertRefused({'action': 'play', 'card': {'rank': 7, 'suit': 'X'}}, 'schema', 'invalid "card" field')
+        self.assertRefused({'action': 'ack', 'version': -1}, 'schema', 'invalid "version" field')
+        self.assertRefused({'action': 'ack', 'version': True}, 'schema', 'invalid "version" field')
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=0.001, burst=3)
+        self.assertEqual([bucket.take() for _ in range(4)], [True, True, True, False])
+
+
+@override_settings(MATCHMAKING_WIDEN_SECONDS=10)
+class MatchmakingQueueTests(SimpleTestCase):
+    def make_queue(self, *tickets):
+        queue = MatchmakingQueue()
+        for ticket in tickets:
+            self.assertTrue(queue.join(ticket))
+        return queue
+
+    def test_players_of_a_bucket_are_matched(self):
+        queue = self.make_queue(
+            Ticket('c1', 1, rating=1010, queued_at=0),
+            Ticket('c2', 2, rating=1500, queued_at=0),
+            Ticket('c3', 3, rating=1090, queued_at=1),
+            Ticket('c4', 4, rating=1050, size=3, queued_at=0),
+        )
+        tables = queue.match(now=2)
+        self.assertEqual([[ticket.user_id for ticket in table] for table in tables], [[1, 3]])
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.depth[2], 1)
+
+    def test_neighbouring_buckets_after_waiting(self):
+        queue = self.make_queue(
+            Ticket('c1', 1, rating=1000, queued_at=0),
+            Ticket('c2', 2, rating=1150, queued_at=5),
+            Ticket('c3', 3, rating=1250, queued_at=0),
+        )
+        self.assertEqual(queue.match(now=9), [])
+        # Ten seconds - one bucket around
+        tables = queue.match(now=10)
+        self.assertEqual([[ticket.user_id for ticket in table] for table in tables], [[1, 2]])
+        self.assertEqual(list(queue.tickets), ['c3'])
+
+    def test_user_waits_once(self):
+        queue = self.make_queue(Ticket('c1', 1))
+        self.assertFalse(queue.join(Ticket('c2', 1)))
+        self.assertFalse(queue.join(Ticket('c1', 2)))
+        self.assertEqual(queue.leave('c1').user_id, 1)
+        self.assertIsNone(queue.leave('c1'))
+        self.assertEqual(queue.buckets, {})
+        self.assertTrue(queue.join(Ticket('c2', 1)))
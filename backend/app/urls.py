@@ -3,4 +3,5 @@ from . import views
 
 urlpatterns = [
     path('', views.index, name='index'),
+    path('rooms/', views.RoomsView.as_view(), name='rooms'),
 ]
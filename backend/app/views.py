@@ -1,5 +1,32 @@
+from django.db.models import Count
 from django.http import HttpResponse
+from rest_framework import status, views
+from rest_framework.response import Response
+
+from app.models import Game
+from app.serializers import RoomSerializer
+from app.services.presence import presence
+from app.services.rooms import room_registry
 
 
 def index(request):
     return HttpResponse("Welcome to the game!")
+
+
+class RoomsView(views.APIView):
+    def get(self, request):
+        rooms = list(Game.objects.annotate(visitors_count=Count('visitors')).order_by('name'))
+        room_names = [room.name for room in rooms]
+        workers = room_registry.get_rooms_workers(room_names)
+        online = presence.count_rooms(room_names)
+        for room in rooms:
+            room.worker = workers[room.name]
+            room.online_count = online[room.name]
+        return Response(RoomSerializer(rooms, many=True).data)
+
+    def post(self, request):
+        serializer = RoomSerializer(data=request.data)
+        if serializer.is_valid():
+            serializer.save()
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -9,11 +9,14 @@ django.setup()
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.urls import path
 from app import consumers
+from app.middleware import TokenAuthMiddleware
 
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
-    'websocket': URLRouter([
-        path('ws/game/', consumers.GameConsumer.as_asgi()),
-    ]),
+    'websocket': TokenAuthMiddleware(URLRouter([
+        path('ws/game/<slug:room_name>/', consumers.GameConsumer.as_asgi()),
+        path('ws/game/<slug:room_name>/watch/', consumers.SpectatorConsumer.as_asgi()),
+        path('ws/matchmaking/', consumers.MatchmakingConsumer.as_asgi()),
+    ])),
 })
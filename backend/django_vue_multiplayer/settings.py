@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
 import os
+import socket
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -92,6 +93,46 @@ CHANNEL_LAYERS = {
 
 DAPHNE_CONFIG = 'django_vue_multiplayer.asgi:application'
 
+# Id of this process in the ring of the game workers, unique per process unless set
+GAME_WORKER_ID = os.getenv('GAME_WORKER_ID') or f'{socket.gethostname()}-{os.getpid()}'
+# Worker processes the rooms are placed on until any worker has registered in Redis (see app.services.rooms.RoomRegistry)
+GAME_WORKERS = os.getenv('GAME_WORKERS', GAME_WORKER_ID).split(',')
+# A worker that has not refreshed its entry for WORKER_TTL_SECONDS is out of the ring, its rooms go to the others;
+# a call forwarded to the owner of a room fails after ROOM_CALL_TIMEOUT_SECONDS (see app.services.cluster)
+WORKER_TTL_SECONDS = int(os.getenv('WORKER_TTL_SECONDS', '15'))
+ROOM_CALL_TIMEOUT_SECONDS = float(os.getenv('ROOM_CALL_TIMEOUT_SECONDS', '10'))
+# Seconds a disconnected participant has to reconnect before forfeiting the game
+RECONNECT_GRACE_SECONDS = int(os.getenv('RECONNECT_GRACE_SECONDS', '30'))
+# How often the spectators of a room get the state (the updates in between are coalesced)
+SPECTATOR_UPDATES_PER_SECOND = float(os.getenv('SPECTATOR_UPDATES_PER_SECOND', '2'))
+# Presence entries of the connections expire if not refreshed for this long (a dead worker's connections)
+PRESENCE_TTL_SECONDS = int(os.getenv('PRESENCE_TTL_SECONDS', '60'))
+# Changed games are written to the DB in one batch every WRITE_BEHIND_FLUSH_MS (see app.services.live_games),
+# 0 - every action is written at once
+WRITE_BEHIND_FLUSH_MS = int(os.getenv('WRITE_BEHIND_FLUSH_MS', '200'))
+# Input of a game connection (see app.services.inbound): frames of up to INBOUND_MAX_FRAME_BYTES,
+# INBOUND_MESSAGES_PER_SECOND on average with bursts of INBOUND_BURST, at most INBOUND_QUEUE_SIZE waiting;
+# a connection over the queue size is closed (INBOUND_OVERFLOW=close) or its message dropped (drop)
+INBOUND_MAX_FRAME_BYTES = int(os.getenv('INBOUND_MAX_FRAME_BYTES', '4096'))
+INBOUND_MESSAGES_PER_SECOND = float(os.getenv('INBOUND_MESSAGES_PER_SECOND', '10'))
+INBOUND_BURST = int(os.getenv('INBOUND_BURST', '20'))
+INBOUND_QUEUE_SIZE = int(os.getenv('INBOUND_QUEUE_SIZE', '8'))
+INBOUND_OVERFLOW = os.getenv('INBOUND_OVERFLOW', 'close')
+# Output of a game connection (see app.services.outbound): at most OUTBOUND_QUEUE_SIZE state frames are sent
+# ahead of the client's ack; over OUTBOUND_QUEUE_SIZE frames waiting the state frames are replaced by the full state,
+# a client that leaves a state frame unacked for OUTBOUND_SLOW_SECONDS is closed
+OUTBOUND_QUEUE_SIZE = int(os.getenv('OUTBOUND_QUEUE_SIZE', '32'))
+OUTBOUND_SLOW_SECONDS = float(os.getenv('OUTBOUND_SLOW_SECONDS', '10'))
+# Token -> user cache of the websocket authentication (see app.services.auth): in Redis for AUTH_CACHE_SECONDS,
+# in the LRU of every process (AUTH_LOCAL_CACHE_SIZE tokens) for AUTH_LOCAL_CACHE_SECONDS
+AUTH_CACHE_SECONDS = int(os.getenv('AUTH_CACHE_SECONDS', '3600'))
+AUTH_LOCAL_CACHE_SECONDS = int(os.getenv('AUTH_LOCAL_CACHE_SECONDS', '60'))
+AUTH_LOCAL_CACHE_SIZE = int(os.getenv('AUTH_LOCAL_CACHE_SIZE', '10000'))
+# Matchmaking (see app.services.matchmaking): tables are formed every tick,
+# the rating range of a waiting player widens by one bucket every MATCHMAKING_WIDEN_SECONDS
+MATCHMAKING_TICK_SECONDS = float(os.getenv('MATCHMAKING_TICK_SECONDS', '1'))
+MATCHMAKING_WIDEN_SECONDS = float(os.getenv('MATCHMAKING_WIDEN_SECONDS', '10'))
+
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
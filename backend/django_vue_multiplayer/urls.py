@@ -17,13 +17,21 @@ from django.contrib import admin
 from django.http import HttpResponse
 from django.urls import path, include
 
+from app.services.metrics import export_metrics
+
 
 def health_check(request):
     return HttpResponse('OK')
 
 
+def metrics(request):
+    body, content_type = export_metrics()
+    return HttpResponse(body, content_type=content_type)
+
+
 urlpatterns = [
     path('', health_check),
+    path('metrics', metrics),
     path('admin/', admin.site.urls),
     path('api/', include('app.urls')),
     path('api/user_auth/', include('user_auth.urls')),
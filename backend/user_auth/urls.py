@@ -7,4 +7,6 @@ from . import views
 urlpatterns = [
     path('register/', views.RegisterView.as_view(), name='register'),
     path('login/', views.LoginView.as_view(), name='login'),
+    path('logout/', views.LogoutView.as_view(), name='logout'),
+    path('rotate_token/', views.RotateTokenView.as_view(), name='rotate_token'),
 ]
@@ -1,6 +1,9 @@
 from django.contrib.auth import authenticate
+from django.db import transaction
 from rest_framework import status, views
+from rest_framework.authentication import TokenAuthentication
 from rest_framework.authtoken.models import Token
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
 from .serializers import UserSerializer
@@ -27,3 +30,25 @@ class LoginView(views.APIView):
             token, created = Token.objects.get_or_create(user=user)
             return Response({'token': token.key})
         return Response({'error': 'Invalid credentials'}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class LogoutView(views.APIView):
+    # The token is dropped from the websocket token cache too (see app.signals)
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        request.auth.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class RotateTokenView(views.APIView):
+    # New token for the user, the old one stops working
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        with transaction.atomic():
+            request.auth.delete()
+            token = Token.objects.create(user=request.user)
+        return Response({'token': token.key})
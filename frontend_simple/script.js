@@ -1,23 +1,75 @@
-const socket = new WebSocket("ws://localhost:8000/ws/game/");
+const socket = new WebSocket("ws://localhost:8000/ws/game/main/");
+
+// Game state and hand of the last version, kept up to date by the deltas
+let gameState = null;
+let version = null;
+let hand = [];
 
 socket.addEventListener("open", (event) => {
   // The WebSocket connection is now open, and you can safely send data
   // For example:
-  // socket.send(JSON.stringify({ action: "join", username: "player1" }));
+  // socket.send(JSON.stringify({ action: "authenticate", token: "<token>" }));
   sendMove();
 });
 
 socket.addEventListener("message", (event) => {
-  // const data = JSON.parse(event.data);
-  console.log(event.data);
-  // Update the game state in your Vue component based on the received data
+  const data = JSON.parse(event.data);
+  // All the messages of one server action come in one batch
+  const messages = data.action === "batch" ? data.messages : [data];
+  messages.forEach(handleMessage);
+  // The server sends the next state updates only as far as they are acked
+  const versions = messages.filter((message) => message.version !== undefined).map((message) => message.version);
+  if (versions.length) {
+    socket.send(JSON.stringify({ action: "ack", version: Math.max(...versions) }));
+  }
+  console.log(version, gameState, hand);
 });
 
+function handleMessage(data) {
+  console.log(data);
+  if (data.action === "game_state") {
+    gameState = data;
+    version = data.version;
+  } else if (data.action === "game_delta") {
+    applyGameDelta(data);
+  } else if (data.action === "hand") {
+    hand = data.cards;
+  } else if (data.action === "hand_delta") {
+    applyHandDelta(data);
+  }
+}
+
+function applyGameDelta(delta) {
+  // Old delta or no full state yet
+  if (version === null || delta.version <= version) return;
+  // Some deltas were missed - the server sends the full state again
+  if (delta.base_version !== version) {
+    socket.send(JSON.stringify({ action: "resync" }));
+    return;
+  }
+  const { table, ...changes } = delta.changes;
+  gameState = { ...gameState, ...changes, version: delta.version };
+  if (table) {
+    gameState.table = table.set ? table.set : [...gameState.table, ...table.append];
+  }
+  version = delta.version;
+}
+
+function applyHandDelta(delta) {
+  // Goes together with the game delta of the same version
+  if (delta.version !== version) return;
+  delta.remove.forEach((card) => {
+    const idx = hand.findIndex((c) => c.rank === card.rank && c.suit === card.suit);
+    if (idx !== -1) hand.splice(idx, 1);
+  });
+  hand = [...hand, ...delta.add];
+}
+
 // Wrap the send action in a function
 function sendMove() {
   if (socket.readyState === WebSocket.OPEN) {
-    // socket.send(JSON.stringify({ action: "move" }));
-    socket.send('0');
+    // Asks for the full state of the game
+    socket.send(JSON.stringify({ action: "resync" }));
   } else {
     console.error("WebSocket is not open. readyState:", socket.readyState);
   }